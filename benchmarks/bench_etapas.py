@@ -0,0 +1,175 @@
+# Benchmark por etapa del camino de descarga: base64 → ZIP → parseo → guardado en SQLite
+#
+#   python benchmarks/bench_etapas.py [--megas 5 50] [--conceptos 5] [--complementos]
+#                                     [--json resultados.json] [--base anterior.json --tolerancia 25]
+#
+# Usa las funciones reales del servidor sobre paquetes sintéticos (generador_cfdi) y reporta
+# throughput, latencia por factura y pico de memoria (tracemalloc) de cada etapa. Con --base
+# compara contra una corrida anterior y termina con código 1 si alguna etapa perdió más de la
+# tolerancia, para detectar regresiones; con --megas del tamaño de los paquetes del RFC más
+# grande sirve para dimensionar workers.
+import argparse
+import atexit
+import io
+import itertools
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+import zipfile
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+# Base de datos y archivo de XML temporales: el benchmark no toca los del servidor
+_TEMPORAL = tempfile.mkdtemp(prefix='bench_etapas_')
+atexit.register(shutil.rmtree, _TEMPORAL, ignore_errors=True)
+os.environ.setdefault('SAT_ARCHIVO_XML_DIR', os.path.join(_TEMPORAL, 'archivo_xml'))
+import database
+database.DB_PATH = os.path.join(_TEMPORAL, 'bench.db')
+
+import logging
+logging.disable(logging.WARNING)
+
+import cfdi_parser
+import invoice_store
+import server
+from generador_cfdi import cantidad_para_megas, generar_paquete
+
+def etapas(paquete_b64, rfc):
+    """Etapas en el orden en que corren al descargar; cada una recibe lo que produjo la anterior"""
+    def decodificar(_):
+        archivo = server._decodificar_a_archivo(paquete_b64)
+        datos = archivo.read()
+        archivo.close()
+        return datos
+
+    def leer_zip(zip_data):
+        with zipfile.ZipFile(io.BytesIO(zip_data)) as zip_file:
+            return [zip_file.read(nombre) for nombre in zip_file.namelist() if nombre.endswith('.xml')]
+
+    def parsear(xmls):
+        return [cfdi_parser.extraer_factura(xml_content) for xml_content in xmls]
+
+    def paquete_completo(zip_data):
+        # Lo mismo que SATClient.parsear_facturas_de_zip, sin crear un cliente con FIEL
+        return list(cfdi_parser.iterar_facturas_de_zip(zip_data))
+
+    corridas = itertools.count()
+
+    def guardar(facturas):
+        # Un RFC distinto en cada corrida para medir inserciones y no actualizaciones
+        invoice_store.guardar_facturas(f'{rfc}{next(corridas)}', 'recibidas', facturas)
+        return facturas
+
+    return [
+        ('base64', decodificar, None),
+        ('zip', leer_zip, 'base64'),
+        ('parseo', parsear, 'zip'),
+        ('zip+parseo', paquete_completo, 'base64'),
+        ('sqlite', guardar, 'zip+parseo')
+    ]
+
+def _medir(funcion, entrada, repeticiones):
+    """Mejor tiempo de varias corridas y el resultado de la última"""
+    mejor = float('inf')
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        salida = funcion(entrada)
+        mejor = min(mejor, time.perf_counter() - inicio)
+    return mejor, salida
+
+def _pico_memoria(funcion, entrada):
+    """Pico de memoria asignada por Python durante la etapa, en MB (corrida aparte: tracemalloc la hace lenta)"""
+    tracemalloc.start()
+    try:
+        funcion(entrada)
+        return tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+    finally:
+        tracemalloc.stop()
+
+def _latencias(xmls):
+    """Percentiles de latencia del parseo de una factura, en microsegundos"""
+    tiempos = []
+    for xml_content in xmls:
+        inicio = time.perf_counter()
+        cfdi_parser.extraer_factura(xml_content)
+        tiempos.append((time.perf_counter() - inicio) * 1_000_000)
+    percentiles = statistics.quantiles(tiempos, n=100)
+    return {'p50': percentiles[49], 'p95': percentiles[94], 'p99': percentiles[98]}
+
+def correr(megas, conceptos, complementos, repeticiones):
+    cantidad = cantidad_para_megas(megas, conceptos=conceptos, complementos=complementos)
+    paquete_b64 = generar_paquete(cantidad, conceptos=conceptos, complementos=complementos)
+    resultados = {}
+    salidas = {None: None}
+    for nombre, funcion, entrada in etapas(paquete_b64, rfc=f'BENCH{megas}'):
+        segundos, salidas[nombre] = _medir(funcion, salidas[entrada], repeticiones)
+        resultados[nombre] = {
+            'facturas_por_segundo': cantidad / segundos,
+            'mb_por_segundo': len(paquete_b64) / (1024 * 1024) / segundos,
+            'us_por_factura': segundos / cantidad * 1_000_000,
+            'pico_mb': _pico_memoria(funcion, salidas[entrada])
+        }
+    resultados['parseo'].update(_latencias(salidas['zip']))
+    return cantidad, len(paquete_b64), resultados
+
+def comparar(actual, base, tolerancia):
+    """Etapas cuyo throughput cayó más de 'tolerancia' % respecto a la corrida base"""
+    regresiones = []
+    for escenario, etapas_base in base.items():
+        for etapa, datos in etapas_base.get('etapas', {}).items():
+            nuevo = actual.get(escenario, {}).get('etapas', {}).get(etapa)
+            if not nuevo:
+                continue
+            caida = (1 - nuevo['facturas_por_segundo'] / datos['facturas_por_segundo']) * 100
+            if caida > tolerancia:
+                regresiones.append(f"{escenario} / {etapa}: {caida:.0f}% más lento")
+    return regresiones
+
+def main():
+    parser = argparse.ArgumentParser(description='Throughput, latencia y memoria por etapa del parseo de paquetes')
+    parser.add_argument('--megas', type=float, nargs='+', default=[5, 50],
+                        help='Tamaño aproximado del ZIP de cada escenario, en MB')
+    parser.add_argument('--conceptos', type=int, default=5)
+    parser.add_argument('--complementos', action='store_true', help='Incluir complementos de pagos/impuestos locales')
+    parser.add_argument('--repeticiones', type=int, default=3)
+    parser.add_argument('--json', help='Guardar los resultados en este archivo')
+    parser.add_argument('--base', help='Resultados de una corrida anterior para detectar regresiones')
+    parser.add_argument('--tolerancia', type=float, default=25, help='Caída de throughput permitida, en %%')
+    args = parser.parse_args()
+
+    database.init_db()
+    invoice_store.init_db()
+
+    todos = {}
+    for megas in args.megas:
+        cantidad, tamano_b64, resultados = correr(megas, args.conceptos, args.complementos, args.repeticiones)
+        escenario = f'{megas:g}MB-{args.conceptos}c' + ('-complementos' if args.complementos else '')
+        todos[escenario] = {'facturas': cantidad, 'bytes_base64': tamano_b64, 'etapas': resultados}
+
+        print(f"\n{escenario}: {cantidad:,} XMLs, {tamano_b64 / (1024 * 1024):.1f} MB en base64")
+        print(f"{'etapa':>12} {'facturas/s':>12} {'MB b64/s':>9} {'µs/factura':>11} {'pico MB':>9}")
+        for etapa, datos in resultados.items():
+            print(f"{etapa:>12} {datos['facturas_por_segundo']:>12,.0f} {datos['mb_por_segundo']:>9.1f} "
+                  f"{datos['us_por_factura']:>11.1f} {datos['pico_mb']:>9.1f}")
+        parseo = resultados['parseo']
+        print(f"  parseo por factura: p50 {parseo['p50']:.1f} µs, p95 {parseo['p95']:.1f} µs, p99 {parseo['p99']:.1f} µs")
+
+    if args.json:
+        with open(args.json, 'w') as archivo:
+            json.dump(todos, archivo, indent=2)
+    if args.base:
+        with open(args.base) as archivo:
+            regresiones = comparar(todos, json.load(archivo), args.tolerancia)
+        if regresiones:
+            print('\nRegresiones:\n  ' + '\n  '.join(regresiones))
+            sys.exit(1)
+        print(f'\nSin regresiones mayores a {args.tolerancia:g}% contra {args.base}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+# Punto de cruce entre parseo en serie y en pool de procesos según el tamaño del paquete
+#
+#   python benchmarks/bench_parseo_paralelo.py [--procesos 4] [--tamanos 500 2000 5000 10000]
+#
+# El umbral SAT_PARSEO_UMBRAL debería quedar cerca del primer tamaño donde el pool gana.
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cfdi_parser
+from generador_cfdi import generar_zip
+
+def medir(zip_data, procesos):
+    inicio = time.perf_counter()
+    facturas = list(cfdi_parser.iterar_facturas_de_zip(zip_data, procesos=procesos, umbral=0))
+    return time.perf_counter() - inicio, facturas
+
+def main():
+    parser = argparse.ArgumentParser(description='Compara parseo en serie contra pool de procesos')
+    parser.add_argument('--procesos', type=int, default=os.cpu_count() or 2)
+    parser.add_argument('--tamanos', type=int, nargs='+', default=[250, 1000, 2500, 5000, 10000, 20000])
+    parser.add_argument('--conceptos', type=int, default=5)
+    args = parser.parse_args()
+
+    # Calentar el pool para no cobrarle el arranque de procesos a la primera medición
+    list(cfdi_parser.iterar_facturas_de_zip(generar_zip(args.procesos), procesos=args.procesos, umbral=0))
+
+    print(f"Procesos: {args.procesos}, conceptos por XML: {args.conceptos}")
+    print(f"{'XMLs':>8} {'serie (s)':>10} {'pool (s)':>10} {'aceleración':>12}")
+    cruce = None
+    for tamano in args.tamanos:
+        zip_data = generar_zip(tamano, conceptos=args.conceptos)
+        serie, facturas_serie = medir(zip_data, 1)
+        pool, facturas_pool = medir(zip_data, args.procesos)
+        assert facturas_serie == facturas_pool, 'El pool debe conservar el orden y el contenido'
+        aceleracion = serie / pool
+        # Se pide una ganancia clara (10%) para no confundir ruido con cruce
+        if cruce is None and aceleracion >= 1.1:
+            cruce = tamano
+        print(f"{tamano:>8} {serie:>10.3f} {pool:>10.3f} {aceleracion:>11.2f}x")
+
+    if cruce:
+        print(f"\nEl pool empieza a ganar alrededor de {cruce} XMLs por paquete")
+    else:
+        print("\nEl pool no ganó en ningún tamaño probado; conviene dejarlo desactivado")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+# Benchmark del extractor de CFDI contra la implementación anterior de parsear_xml_factura
+# (copia íntegra de la versión previa, no un recorte)
+#
+#   python benchmarks/bench_parser.py [--xmls 2000] [--conceptos 5 30 100]
+import argparse
+import os
+import sys
+import time
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cfdi_parser
+from generador_cfdi import generar_xml
+
+# parsear_xml_factura tal como estaba en server.py antes del extractor (método de SATClient; aquí
+# sin self), sin recortar: mismos 14 campos, incluidos timbre y FechaCancelacion
+def parsear_xml_original(xml_content):
+    """Parsea un XML de factura y extrae la información principal"""
+    try:
+        # Parsear el XML
+        root = ET.fromstring(xml_content)
+
+        # Namespaces del SAT
+        ns = {
+            'cfdi': 'http://www.sat.gob.mx/cfd/4',
+            'cfdi3': 'http://www.sat.gob.mx/cfd/3',
+            'tfd': 'http://www.sat.gob.mx/TimbreFiscalDigital'
+        }
+
+        # Intentar con namespace 4.0 primero, luego 3.3
+        comprobante = root
+
+        # Extraer datos del comprobante
+        fecha = comprobante.get('Fecha', '')
+        folio = comprobante.get('Folio', 'N/A')
+        serie = comprobante.get('Serie', '')
+        total = comprobante.get('Total', '0')
+        subtotal = comprobante.get('SubTotal', '0')
+        moneda = comprobante.get('Moneda', 'MXN')
+        tipo_comprobante = comprobante.get('TipoDeComprobante', 'I')
+
+        # Emisor
+        emisor = comprobante.find('cfdi:Emisor', ns) or comprobante.find('cfdi3:Emisor', ns)
+        rfc_emisor = emisor.get('Rfc', '') if emisor is not None else ''
+        nombre_emisor = emisor.get('Nombre', '') if emisor is not None else ''
+
+        # Receptor
+        receptor = comprobante.find('cfdi:Receptor', ns) or comprobante.find('cfdi3:Receptor', ns)
+        rfc_receptor = receptor.get('Rfc', '') if receptor is not None else ''
+        nombre_receptor = receptor.get('Nombre', '') if receptor is not None else ''
+
+        # Timbre Fiscal (UUID)
+        complemento = comprobante.find('.//cfdi:Complemento', ns) or comprobante.find('.//cfdi3:Complemento', ns)
+        uuid = ''
+        fecha_cancelacion = None
+        if complemento is not None:
+            timbre = complemento.find('tfd:TimbreFiscalDigital', ns)
+            if timbre is not None:
+                uuid = timbre.get('UUID', '')
+                fecha_cancelacion = timbre.get('FechaCancelacion', None)
+
+        # Determinar estado: si no tiene fecha de cancelación, está vigente
+        estado = 'Cancelado' if fecha_cancelacion else 'Vigente'
+
+        return {
+            'uuid': uuid,
+            'fecha': fecha,
+            'serie': serie,
+            'folio': folio,
+            'rfcEmisor': rfc_emisor,
+            'nombreEmisor': nombre_emisor,
+            'rfcReceptor': rfc_receptor,
+            'nombreReceptor': nombre_receptor,
+            'subtotal': float(subtotal),
+            'total': float(total),
+            'moneda': moneda,
+            'tipoComprobante': tipo_comprobante,
+            'estado': estado,
+            'fechaCancelacion': fecha_cancelacion
+        }
+
+    except Exception as e:
+        print(f"❌ Error al parsear XML: {e}")
+        return None
+
+def medir(funcion, xmls, repeticiones=3):
+    """Mejor tiempo de varias corridas, en XMLs por segundo"""
+    mejor = float('inf')
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        for xml_content in xmls:
+            funcion(xml_content)
+        mejor = min(mejor, time.perf_counter() - inicio)
+    return len(xmls) / mejor
+
+def main():
+    parser = argparse.ArgumentParser(description='Compara XMLs/segundo del extractor contra el parseo anterior')
+    parser.add_argument('--xmls', type=int, default=2000)
+    parser.add_argument('--conceptos', type=int, nargs='+', default=[5, 30, 100])
+    args = parser.parse_args()
+
+    print(f"{'versión':>8} {'conceptos':>10} {'original XML/s':>15} {'extractor XML/s':>16} {'mejora':>8}")
+    for version in ('3.3', '4.0'):
+        for conceptos in args.conceptos:
+            xmls = [generar_xml(i, version=version, conceptos=conceptos) for i in range(args.xmls)]
+
+            # El extractor debe dar los mismos datos que el parseo con árbol
+            muestra = cfdi_parser.extraer_factura(xmls[0])
+            assert muestra['uuid'] and muestra['rfcEmisor'] and muestra['rfcReceptor'], muestra
+            assert muestra == cfdi_parser._extraer_con_arbol(xmls[0])
+            # y los mismos campos que la función anterior; solo difieren emisor y receptor cuando la
+            # anterior los perdía (find(...) or find(...) con un nodo sin hijos, que es falso)
+            anterior = parsear_xml_original(xmls[0])
+            assert anterior.keys() == muestra.keys(), anterior
+            diferentes = {campo for campo in muestra if muestra[campo] != anterior[campo]}
+            assert diferentes <= {'rfcEmisor', 'nombreEmisor', 'rfcReceptor', 'nombreReceptor'}, diferentes
+
+            original = medir(parsear_xml_original, xmls)
+            extractor = medir(cfdi_parser.extraer_factura, xmls)
+            print(f"{version:>8} {conceptos:>10} {original:>15,.0f} {extractor:>16,.0f} {extractor / original:>7.1f}x")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,300 @@
+# Prueba de carga de la API con usuarios virtuales y reporte de latencias contra SLOs
+#
+#   python benchmarks/carga.py --levantar --workers 4 --usuarios 30 --rampa 30 --duracion 120
+#   python benchmarks/carga.py --url http://localhost:5001 --usuarios 10 --slo consultar-facturas:p95=3000
+#
+# Cada usuario virtual se registra, guarda una FIEL de prueba y después repite el flujo de la app:
+# login → obtener-fiscales → consultar-facturas (meses al azar de 2024) → logout, con pausas
+# entre pasos. Los usuarios arrancan escalonados durante la rampa.
+#
+# Con --levantar se inician el simulador del SAT (sat_mock.py) y el servidor con gunicorn sobre
+# una base de datos y directorios temporales; sin él, el servidor de --url debe estar corriendo
+# con SAT_SOAP_URL apuntando a un simulador (nunca al SAT real).
+#
+# Reporta por endpoint p50/p95/p99, throughput y tasa de error (5xx o sin respuesta; los 4xx se
+# cuentan aparte porque incluyen rechazos simulados del SAT). Termina con código 1 si no se
+# cumple algún SLO o la tasa de error global pasa de --max-errores.
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from sat_mock import generar_fiel
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# SLOs por defecto (ms); se pueden reemplazar con --slo endpoint:percentil=ms
+SLOS = {
+    'login': {'p95': 500, 'p99': 1000},
+    'obtener-fiscales': {'p95': 300, 'p99': 800},
+    'consultar-facturas': {'p95': 5000, 'p99': 10000},
+    'logout': {'p95': 200}
+}
+PASSWORD_USUARIO = 'carga-12345'
+PASSWORD_FIEL = '12345678a'
+
+class Mediciones:
+    """Latencias y resultados de todas las peticiones, compartidas por los usuarios virtuales"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.registros = []  # (endpoint, inicio, ms, estatus); estatus None = sin respuesta
+
+    def agregar(self, endpoint, inicio, ms, estatus):
+        with self._lock:
+            self.registros.append((endpoint, inicio, ms, estatus))
+
+class UsuarioVirtual:
+    def __init__(self, indice, url, mediciones, fiel, pausa, consultas, rng, prefijo):
+        self.indice = indice
+        self.url = url.rstrip('/')
+        self.mediciones = mediciones
+        self.fiel = fiel
+        self.pausa = pausa
+        self.consultas = consultas
+        self.rng = rng
+        self.email = f'{prefijo}-{indice}@carga.local'
+        self.rfc = f'CAR{indice:06d}AA{indice % 10}'
+        self.http = requests.Session()
+
+    def _peticion(self, endpoint, metodo, ruta, **kwargs):
+        inicio = time.time()
+        t0 = time.perf_counter()
+        try:
+            respuesta = self.http.request(metodo, self.url + ruta, timeout=120, **kwargs)
+            estatus = respuesta.status_code
+        except requests.RequestException:
+            respuesta, estatus = None, None
+        self.mediciones.agregar(endpoint, inicio, (time.perf_counter() - t0) * 1000, estatus)
+        return respuesta
+
+    def _recordar_sesion(self, respuesta):
+        # La cookie de sesión es Secure: requests no la devolvería por http, se manda a mano
+        if respuesta is not None and respuesta.cookies.get('sat_session'):
+            self.http.headers['Cookie'] = f"sat_session={respuesta.cookies.get('sat_session')}"
+
+    def _pensar(self):
+        if self.pausa:
+            time.sleep(self.rng.uniform(0, self.pausa))
+
+    def preparar(self):
+        """Registro, login y FIEL guardada; se mide aparte del flujo"""
+        self._peticion('register', 'POST', '/api/register', json={
+            'nombre': f'Usuario de carga {self.indice}', 'email': self.email,
+            'telefono': '5500000000', 'password': PASSWORD_USUARIO
+        })
+        self.login()
+        cer_der, key_der = self.fiel
+        self._peticion('guardar-fiscales', 'POST', '/api/guardar-fiscales',
+                       data={'rfc': self.rfc, 'password': PASSWORD_FIEL},
+                       files={'certificado': (f'{self.rfc}.cer', cer_der), 'llave': (f'{self.rfc}.key', key_der)})
+
+    def login(self):
+        respuesta = self._peticion('login', 'POST', '/api/login',
+                                   json={'email': self.email, 'password': PASSWORD_USUARIO})
+        self._recordar_sesion(respuesta)
+
+    def flujo(self):
+        self.login()
+        self._pensar()
+        self._peticion('obtener-fiscales', 'GET', '/api/obtener-fiscales')
+        for _ in range(self.consultas):
+            self._pensar()
+            mes = self.rng.randint(1, 12)
+            self._peticion('consultar-facturas', 'POST', '/api/consultar-facturas', json={
+                'rfc': self.rfc,
+                'tipo': self.rng.choice(['emitidas', 'recibidas']),
+                'fechaInicial': f'2024-{mes:02d}-01',
+                'fechaFinal': f'2024-{mes:02d}-28',
+                'usarDatosGuardados': True
+            })
+        self._pensar()
+        self._peticion('logout', 'POST', '/api/logout')
+        self.http.headers.pop('Cookie', None)
+
+    def correr(self, arranque, fin):
+        time.sleep(max(0, arranque - time.time()))
+        self.preparar()
+        while time.time() < fin:
+            self.flujo()
+
+def _percentil(ordenados, p):
+    if not ordenados:
+        return 0.0
+    return ordenados[min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))]
+
+def resumir(mediciones, inicio, fin):
+    """Estadísticas por endpoint dentro de la ventana de medición"""
+    por_endpoint = {}
+    for endpoint, momento, ms, estatus in mediciones.registros:
+        if inicio <= momento <= fin:
+            por_endpoint.setdefault(endpoint, []).append((ms, estatus))
+    segundos = max(fin - inicio, 1e-9)
+    resumen = {}
+    for endpoint, datos in sorted(por_endpoint.items()):
+        latencias = sorted(ms for ms, _ in datos)
+        errores = sum(1 for _, estatus in datos if estatus is None or estatus >= 500)
+        resumen[endpoint] = {
+            'peticiones': len(datos),
+            'por_segundo': len(datos) / segundos,
+            'p50': _percentil(latencias, 50),
+            'p95': _percentil(latencias, 95),
+            'p99': _percentil(latencias, 99),
+            'max': latencias[-1],
+            'errores': errores,
+            'tasa_error': errores / len(datos) * 100,
+            'rechazos_4xx': sum(1 for _, estatus in datos if estatus and 400 <= estatus < 500)
+        }
+    return resumen
+
+def evaluar(resumen, slos, max_errores):
+    """Lista de SLOs incumplidos (vacía = pasa)"""
+    fallas = []
+    for endpoint, objetivos in slos.items():
+        datos = resumen.get(endpoint)
+        if not datos:
+            continue
+        for percentil, limite in objetivos.items():
+            if datos[percentil] > limite:
+                fallas.append(f'{endpoint} {percentil} {datos[percentil]:.0f} ms > {limite:g} ms')
+    total = sum(d['peticiones'] for d in resumen.values())
+    errores = sum(d['errores'] for d in resumen.values())
+    if total and errores / total * 100 > max_errores:
+        fallas.append(f'tasa de error {errores / total * 100:.2f}% > {max_errores:g}%')
+    return fallas
+
+def _slo(texto):
+    """'consultar-facturas:p95=3000' -> ('consultar-facturas', 'p95', 3000.0)"""
+    try:
+        endpoint, objetivo = texto.split(':', 1)
+        percentil, limite = objetivo.split('=', 1)
+        if percentil not in ('p50', 'p95', 'p99', 'max'):
+            raise ValueError(percentil)
+        return endpoint, percentil, float(limite)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'SLO inválido: {texto} (formato endpoint:p95=ms)')
+
+def _esperar_listo(url, limite=60):
+    fin = time.time() + limite
+    while time.time() < fin:
+        try:
+            requests.get(url, timeout=2)
+            return True
+        except requests.RequestException:
+            time.sleep(0.5)
+    return False
+
+def levantar(args):
+    """Simulador del SAT y servidor con gunicorn en un directorio temporal; regresa (url, procesos, temporal)"""
+    temporal = tempfile.mkdtemp(prefix='carga_')
+    entorno = dict(
+        os.environ,
+        SAT_SOAP_URL=f'http://127.0.0.1:{args.puerto_mock}',
+        SAT_DB_PATH=os.path.join(temporal, 'carga.db'),
+        SAT_CERTS_DIR=os.path.join(temporal, 'certificados_usuarios'),
+        SAT_ARCHIVO_XML_DIR=os.path.join(temporal, 'archivo_xml'),
+        LOG_LEVEL=os.environ.get('LOG_LEVEL', 'WARNING')
+    )
+    mock = subprocess.Popen([
+        sys.executable, os.path.join(RAIZ, 'benchmarks', 'sat_mock.py'), '--puerto', str(args.puerto_mock),
+        '--latencia', str(args.mock_latencia), '--paquetes', str(args.mock_paquetes),
+        '--facturas-por-paquete', str(args.mock_facturas), '--verificaciones', '0'
+    ], env=entorno, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    servidor = subprocess.Popen([
+        sys.executable, '-m', 'gunicorn', '--workers', str(args.workers), '--threads', str(args.hilos),
+        '--bind', f'127.0.0.1:{args.puerto}', '--chdir', temporal, '--pythonpath', RAIZ,
+        '--timeout', '300', 'server:app'
+    ], env=entorno, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f'http://127.0.0.1:{args.puerto}'
+    if not (_esperar_listo(f'http://127.0.0.1:{args.puerto_mock}/estadisticas') and _esperar_listo(f'{url}/api/session')):
+        for proceso in (mock, servidor):
+            proceso.terminate()
+        sys.exit('No arrancó el simulador o el servidor')
+    return url, (mock, servidor), temporal
+
+def main():
+    parser = argparse.ArgumentParser(description='Prueba de carga de la API con reporte de SLOs')
+    parser.add_argument('--url', default='http://127.0.0.1:5001')
+    parser.add_argument('--usuarios', type=int, default=10)
+    parser.add_argument('--rampa', type=float, default=10, help='Segundos para arrancar a todos los usuarios')
+    parser.add_argument('--duracion', type=float, default=60, help='Segundos totales, incluida la rampa')
+    parser.add_argument('--pausa', type=float, default=1.0, help='Pausa máxima entre pasos (s)')
+    parser.add_argument('--consultas', type=int, default=2, help='Consultas de facturas por flujo')
+    parser.add_argument('--slo', type=_slo, action='append', default=[], help='endpoint:p95=ms (repetible)')
+    parser.add_argument('--max-errores', type=float, default=1.0, help='Tasa de error global permitida, en %%')
+    parser.add_argument('--semilla', type=int, default=0)
+    parser.add_argument('--json', help='Guardar el reporte en este archivo')
+    parser.add_argument('--levantar', action='store_true', help='Iniciar simulador y servidor temporales')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--hilos', type=int, default=4, help='Hilos por worker de gunicorn')
+    parser.add_argument('--puerto', type=int, default=5101)
+    parser.add_argument('--puerto-mock', type=int, default=5099)
+    parser.add_argument('--mock-latencia', type=float, default=0.2)
+    parser.add_argument('--mock-paquetes', type=int, default=1)
+    parser.add_argument('--mock-facturas', type=int, default=200)
+    args = parser.parse_args()
+
+    slos = {endpoint: dict(objetivos) for endpoint, objetivos in SLOS.items()}
+    for endpoint, percentil, limite in args.slo:
+        slos.setdefault(endpoint, {})[percentil] = limite
+
+    procesos, temporal, url = (), None, args.url
+    if args.levantar:
+        url, procesos, temporal = levantar(args)
+    try:
+        # Una sola FIEL para todos: generar llaves RSA por usuario alargaría la preparación
+        fiel = generar_fiel('CAR000000AA0', PASSWORD_FIEL)
+        mediciones = Mediciones()
+        inicio = time.time()
+        fin = inicio + args.duracion
+        prefijo = f'carga{int(inicio)}'
+        hilos = []
+        for i in range(args.usuarios):
+            usuario = UsuarioVirtual(i, url, mediciones, fiel, args.pausa, args.consultas,
+                                     random.Random(args.semilla * 100_003 + i), prefijo)
+            arranque = inicio + (args.rampa * i / args.usuarios if args.usuarios else 0)
+            hilo = threading.Thread(target=usuario.correr, args=(arranque, fin), daemon=True)
+            hilo.start()
+            hilos.append(hilo)
+        for hilo in hilos:
+            hilo.join()
+        termino = time.time()
+    finally:
+        for proceso in procesos:
+            proceso.terminate()
+            proceso.wait(timeout=30)
+        if temporal:
+            shutil.rmtree(temporal, ignore_errors=True)
+
+    resumen = resumir(mediciones, inicio, termino)
+    fallas = evaluar(resumen, slos, args.max_errores)
+
+    print(f"{args.usuarios} usuarios, {termino - inicio:.0f} s" + (f", {args.workers} workers x {args.hilos} hilos" if args.levantar else ''))
+    print(f"{'endpoint':>20} {'peticiones':>10} {'req/s':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'max ms':>8} {'error %':>8} {'4xx':>5}")
+    for endpoint, datos in resumen.items():
+        print(f"{endpoint:>20} {datos['peticiones']:>10} {datos['por_segundo']:>7.1f} {datos['p50']:>8.0f} "
+              f"{datos['p95']:>8.0f} {datos['p99']:>8.0f} {datos['max']:>8.0f} {datos['tasa_error']:>8.2f} "
+              f"{datos['rechazos_4xx']:>5}")
+    total = sum(d['peticiones'] for d in resumen.values())
+    print(f"\nTotal: {total} peticiones, {total / max(termino - inicio, 1e-9):.1f} req/s")
+
+    if args.json:
+        with open(args.json, 'w') as archivo:
+            json.dump({'resumen': resumen, 'slos': slos, 'fallas': fallas}, archivo, indent=2)
+    if fallas:
+        print('\nNO PASA:\n  ' + '\n  '.join(fallas))
+        sys.exit(1)
+    print('\nPASA: todos los SLOs se cumplen')
+
+if __name__ == '__main__':
+    main()
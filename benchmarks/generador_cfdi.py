@@ -0,0 +1,140 @@
+# Generador determinista de CFDI sintéticos para los benchmarks (no usa datos reales)
+import base64
+import io
+import random
+import zipfile
+from datetime import timedelta
+
+NAMESPACES = {
+    '4.0': 'http://www.sat.gob.mx/cfd/4',
+    '3.3': 'http://www.sat.gob.mx/cfd/3'
+}
+
+# Complemento de pagos según la versión del comprobante
+_PAGOS = {
+    '4.0': ('pago20', 'http://www.sat.gob.mx/Pagos20', '2.0'),
+    '3.3': ('pago10', 'http://www.sat.gob.mx/Pagos', '1.0')
+}
+NS_IMPLOCAL = 'http://www.sat.gob.mx/implocal'
+
+_NOMBRES = ['COMERCIALIZADORA DEL NORTE', 'SERVICIOS INTEGRALES MX', 'DISTRIBUIDORA OCCIDENTE',
+            'CONSTRUCTORA DEL BAJIO', 'FARMACIAS & ASOCIADOS', 'TRANSPORTES PENINSULARES']
+
+def _rfc(rng):
+    letras = ''.join(rng.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ') for _ in range(3))
+    return f'{letras}{rng.randint(0, 99):02d}{rng.randint(1, 12):02d}{rng.randint(1, 28):02d}{rng.choice("ABC")}{rng.randint(1, 9)}{rng.choice("ABC")}'
+
+def _uuid(rng):
+    return '%08X-%04X-%04X-%04X-%012X' % (
+        rng.getrandbits(32), rng.getrandbits(16), rng.getrandbits(16), rng.getrandbits(16), rng.getrandbits(48)
+    )
+
+def _complementos(rng, version, tipo, subtotal, fecha):
+    """Complementos previos al timbre: pagos en los tipo P e impuestos locales en el resto"""
+    if tipo == 'P':
+        prefijo, ns, version_pagos = _PAGOS[version]
+        documentos = ''.join(
+            f'<{prefijo}:DoctoRelacionado IdDocumento="{_uuid(rng)}" MonedaDR="MXN" NumParcialidad="1" '
+            f'ImpSaldoAnt="{subtotal:.2f}" ImpPagado="{subtotal:.2f}" ImpSaldoInsoluto="0.00" ObjetoImpDR="01"/>'
+            for _ in range(rng.randint(1, 4))
+        )
+        return (
+            f'<{prefijo}:Pagos xmlns:{prefijo}="{ns}" Version="{version_pagos}">'
+            f'<{prefijo}:Totales MontoTotalPagos="{subtotal:.2f}"/>'
+            f'<{prefijo}:Pago FechaPago="{fecha}" FormaDePagoP="03" MonedaP="MXN" TipoCambioP="1" '
+            f'Monto="{subtotal:.2f}">{documentos}</{prefijo}:Pago></{prefijo}:Pagos>'
+        )
+    retencion = subtotal * 0.02
+    return (
+        f'<implocal:ImpuestosLocales xmlns:implocal="{NS_IMPLOCAL}" version="1.0" '
+        f'TotaldeRetenciones="{retencion:.2f}" TotaldeTraslados="0.00">'
+        f'<implocal:RetencionesLocales ImpLocRetenido="ISN" TasadeRetencion="2.00" Importe="{retencion:.2f}"/>'
+        f'</implocal:ImpuestosLocales>'
+    )
+
+def generar_xml(indice, version='4.0', conceptos=5, semilla=0, complementos=False,
+                rango=None, emisor=None, receptor=None):
+    """
+    Genera el XML (bytes) de un CFDI con timbre; el mismo índice y semilla dan el mismo XML.
+    Con complementos=True el timbre queda después de un complemento de pagos o de impuestos locales.
+    rango=(desde, hasta) pone la fecha dentro de ese intervalo (si no, cualquier día de 2024) y
+    emisor/receptor fijan esos RFC, como en lo que entrega el SAT para una solicitud
+    """
+    rng = random.Random(semilla * 1_000_003 + indice)
+    ns = NAMESPACES[version]
+    uuid = _uuid(rng)
+    if rango:
+        desde, hasta = rango
+        segundos = max(int((hasta - desde).total_seconds()), 0)
+        fecha = (desde + timedelta(seconds=rng.randint(0, segundos))).strftime('%Y-%m-%dT%H:%M:%S')
+    else:
+        fecha = f'2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}T{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:00'
+    sello = ''.join(rng.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/') for _ in range(344))
+
+    partidas = []
+    subtotal = 0.0
+    for _ in range(conceptos):
+        importe = round(rng.uniform(10, 5000), 2)
+        subtotal += importe
+        partidas.append(
+            f'<cfdi:Concepto ClaveProdServ="{rng.randint(10000000, 99999999)}" Cantidad="1" ClaveUnidad="H87" '
+            f'Descripcion="Producto {rng.randint(1, 9999)}" ValorUnitario="{importe:.2f}" Importe="{importe:.2f}" ObjetoImp="02">'
+            f'<cfdi:Impuestos><cfdi:Traslados><cfdi:Traslado Base="{importe:.2f}" Impuesto="002" TipoFactor="Tasa" '
+            f'TasaOCuota="0.160000" Importe="{importe * 0.16:.2f}"/></cfdi:Traslados></cfdi:Impuestos></cfdi:Concepto>'
+        )
+    total = subtotal * 1.16
+    nombre_emisor = rng.choice(_NOMBRES)
+    nombre_receptor = rng.choice(_NOMBRES)
+    tipo = rng.choice('IIIIEP')
+    extra = _complementos(rng, version, tipo, subtotal, fecha) if complementos else ''
+    rfc_emisor = emisor or _rfc(rng)
+    rfc_receptor = receptor or _rfc(rng)
+
+    xml = (
+        f'<?xml version="1.0" encoding="UTF-8"?>'
+        f'<cfdi:Comprobante xmlns:cfdi="{ns}" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+        f'xmlns:tfd="http://www.sat.gob.mx/TimbreFiscalDigital" '
+        f'xsi:schemaLocation="{ns} {ns}/cfdv{version.replace(".", "")}.xsd http://www.sat.gob.mx/TimbreFiscalDigital '
+        f'http://www.sat.gob.mx/sitio_internet/cfd/TimbreFiscalDigital/TimbreFiscalDigitalv11.xsd" '
+        f'Version="{version}" Serie="A" Folio="{indice}" Fecha="{fecha}" Sello="{sello}" FormaPago="03" '
+        f'NoCertificado="30001000000400002434" SubTotal="{subtotal:.2f}" Moneda="MXN" Total="{total:.2f}" '
+        f'TipoDeComprobante="{tipo}" MetodoPago="PUE" LugarExpedicion="64000">'
+        f'<cfdi:Emisor Rfc="{rfc_emisor}" Nombre="{nombre_emisor.replace("&", "&amp;")}" RegimenFiscal="601"/>'
+        f'<cfdi:Receptor Rfc="{rfc_receptor}" Nombre="{nombre_receptor.replace("&", "&amp;")}" UsoCFDI="G03"/>'
+        f'<cfdi:Conceptos>{"".join(partidas)}</cfdi:Conceptos>'
+        f'<cfdi:Impuestos TotalImpuestosTrasladados="{subtotal * 0.16:.2f}"/>'
+        f'<cfdi:Complemento>{extra}<tfd:TimbreFiscalDigital Version="1.1" UUID="{uuid}" FechaTimbrado="{fecha}" '
+        f'RfcProvCertif="SAT970701NN3" SelloCFD="{sello}" NoCertificadoSAT="00001000000505211329" '
+        f'SelloSAT="{sello}"/></cfdi:Complemento>'
+        f'</cfdi:Comprobante>'
+    )
+    return xml.encode('utf-8')
+
+def generar_zip(cantidad, version='4.0', conceptos=5, semilla=0, inicio=0, complementos=False, **solicitud):
+    """
+    ZIP (bytes) con 'cantidad' XML nombrados por UUID, como los paquetes del SAT.
+    solicitud (rango, emisor, receptor) se pasa a generar_xml
+    """
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        for indice in range(inicio, inicio + cantidad):
+            zip_file.writestr(f'{indice:08d}.xml',
+                              generar_xml(indice, version, conceptos, semilla, complementos, **solicitud))
+    return buffer.getvalue()
+
+def generar_paquete(cantidad, version='4.0', conceptos=5, semilla=0, complementos=False, ancho_linea=None, inicio=0,
+                    **solicitud):
+    """
+    Paquete como lo entrega DescargaMasiva: el ZIP en base64 (str). Con ancho_linea el texto
+    se parte en renglones, como algunos clientes SOAP, y se ejercita la decodificación de respaldo
+    """
+    texto = base64.b64encode(generar_zip(cantidad, version, conceptos, semilla, inicio, complementos,
+                                         **solicitud)).decode()
+    if ancho_linea:
+        texto = '\n'.join(texto[i:i + ancho_linea] for i in range(0, len(texto), ancho_linea))
+    return texto
+
+def cantidad_para_megas(megas, version='4.0', conceptos=5, complementos=False, muestra=200):
+    """XMLs que hacen falta para un ZIP de aproximadamente 'megas' MB (estimado con una muestra)"""
+    tamano = len(generar_zip(muestra, version, conceptos, semilla=1, complementos=complementos)) / muestra
+    return max(1, int(megas * 1024 * 1024 / tamano))
@@ -0,0 +1,343 @@
+# Simulador local de los servicios web de descarga masiva del SAT (Autenticacion, SolicitaDescarga,
+# VerificaSolicitudDescarga y DescargaMasiva) para pruebas de carga sin ir al SAT.
+#
+#   python benchmarks/sat_mock.py [--puerto 5099] [--latencia 0.2 --variacion 0.1]
+#                                 [--paquetes 2 --facturas-por-paquete 500 --conceptos 5]
+#                                 [--verificaciones 1] [--fallos 5002=0.01,301=0.05] [--fallo-http 0.01]
+#   SAT_SOAP_URL=http://localhost:5099 python server.py
+#
+# Para los certificados de prueba (el simulador no valida firmas, pero SATClient firma con ellos):
+#
+#   python benchmarks/sat_mock.py --generar-fiel certificados_prueba --rfc AAA010101AAA --password 12345678a
+#
+# Responde con los mismos sobres SOAP que el SAT para que cfdiclient los lea sin cambios. Las
+# solicitudes pasan por EstadoSolicitud 1 (aceptada) → 2 (en proceso) → 3 (terminada) según las
+# verificaciones; los paquetes se generan con generador_cfdi y el mismo rango da las mismas facturas,
+# fechadas dentro de FechaInicial–FechaFinal y con el RfcSolicitante como emisor (emitidos) o
+# receptor (recibidos).
+import argparse
+import datetime
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+import zlib
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+from xml.sax.saxutils import quoteattr
+
+from flask import Flask, Response, request
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from generador_cfdi import generar_paquete
+
+NS_SOAP = 'http://schemas.xmlsoap.org/soap/envelope/'
+NS_AUTENTICACION = 'http://DescargaMasivaTerceros.gob.mx'
+NS_DESCARGA = 'http://DescargaMasivaTerceros.sat.gob.mx'
+NS_UTILIDAD = 'http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-utility-1.0.xsd'
+NS_SEGURIDAD = 'http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-secext-1.0.xsd'
+
+# Códigos que se pueden inyectar en SolicitaDescarga y su mensaje
+MENSAJES = {
+    '5000': 'Solicitud Aceptada',
+    '300': 'Usuario No Válido',
+    '301': 'XML Mal Formado',
+    '305': 'Solicitud duplicada',
+    '404': 'Error no Controlado',
+    '5002': 'Se han agotado las solicitudes de por vida',
+    '5004': 'No se encontró la información'
+}
+# Paquetes generados que se conservan (generar uno grande cuesta más que servirlo)
+PAQUETES_EN_CACHE = 16
+
+class Configuracion:
+    def __init__(self, latencia=0.0, variacion=0.0, paquetes=1, facturas_por_paquete=100, conceptos=5,
+                 verificaciones=1, fallos=None, fallo_http=0.0, vigencia_token=300, semilla=None):
+        self.latencia = latencia  # segundos fijos por llamada
+        self.variacion = variacion  # segundos aleatorios (0..variacion) que se suman a la latencia
+        self.paquetes = paquetes
+        self.facturas_por_paquete = facturas_por_paquete
+        self.conceptos = conceptos
+        # Verificaciones que tarda una solicitud en terminar (0 = lista en la primera)
+        self.verificaciones = verificaciones
+        self.fallos = fallos or {}  # código -> probabilidad en SolicitaDescarga
+        self.fallo_http = fallo_http  # probabilidad de responder 500 con soap:Fault en cualquier servicio
+        self.vigencia_token = vigencia_token
+        self.rng = random.Random(semilla)
+
+class _Estado:
+    """Tokens emitidos, solicitudes con su avance y paquetes generados; compartido entre hilos"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tokens = {}  # token -> expira
+        self.solicitudes = {}  # id -> {'rfc', 'servicio', 'rango', 'semilla', 'verificaciones'}
+        self.por_rango = {}  # (rfc, servicio, inicio, fin) -> id, para las duplicadas (305)
+        self.paquetes = OrderedDict()
+        self.llamadas = {}
+
+def _sobre(cuerpo, encabezado=''):
+    return (f'<s:Envelope xmlns:s="{NS_SOAP}" xmlns:u="{NS_UTILIDAD}">'
+            f'<s:Header>{encabezado}</s:Header><s:Body>{cuerpo}</s:Body></s:Envelope>')
+
+def _respuesta(xml, estatus=200):
+    return Response(xml, status=estatus, mimetype='text/xml')
+
+def _falla(mensaje, estatus=500):
+    # cfdiclient busca faultstring en el namespace por defecto del servicio
+    ns = NS_AUTENTICACION if request.path.startswith('/Autenticacion') else NS_DESCARGA
+    return _respuesta(_sobre(f'<s:Fault><faultcode>s:Server</faultcode>'
+                             f'<faultstring xmlns="{ns}">{mensaje}</faultstring></s:Fault>'), estatus)
+
+def _rango_solicitud(atributos):
+    """(FechaInicial, FechaFinal) de la solicitud como datetime; None si no vienen o no se leen"""
+    try:
+        return tuple(datetime.datetime.strptime(atributos[campo], '%Y-%m-%dT%H:%M:%S')
+                     for campo in ('FechaInicial', 'FechaFinal'))
+    except (KeyError, ValueError):
+        return None
+
+def _atributos_solicitud(cuerpo):
+    """Atributos del nodo 'solicitud'/'peticionDescarga' firmado por cfdiclient"""
+    for nodo in ET.fromstring(cuerpo).iter():
+        if nodo.get('RfcSolicitante'):
+            return dict(nodo.attrib)
+    return {}
+
+def crear_app(config=None):
+    """App Flask que atiende las rutas de los servicios del SAT con la configuración dada"""
+    config = config or Configuracion()
+    estado = _Estado()
+    app = Flask(__name__)
+    app.config['SAT_MOCK_ESTADO'] = estado
+
+    def esperar():
+        time.sleep(config.latencia + config.rng.uniform(0, config.variacion))
+
+    def token_valido():
+        encabezado = request.headers.get('Authorization', '')
+        token = encabezado.split('"')[1] if '"' in encabezado else ''
+        with estado.lock:
+            return estado.tokens.get(token, 0) > time.time()
+
+    @app.before_request
+    def antes():
+        with estado.lock:
+            estado.llamadas[request.path] = estado.llamadas.get(request.path, 0) + 1
+        esperar()
+        if config.fallo_http and config.rng.random() < config.fallo_http:
+            return _falla('Error simulado del servicio')
+
+    @app.route('/Autenticacion/Autenticacion.svc', methods=['POST'])
+    def autenticacion():
+        token = f'mock-{uuid.uuid4()}'
+        creado = datetime.datetime.utcnow()
+        expira = creado + datetime.timedelta(seconds=config.vigencia_token)
+        with estado.lock:
+            estado.tokens[token] = time.time() + config.vigencia_token
+        formato = '%Y-%m-%dT%H:%M:%S.%fZ'
+        encabezado = (f'<o:Security xmlns:o="{NS_SEGURIDAD}"><u:Timestamp u:Id="_0">'
+                      f'<u:Created>{creado.strftime(formato)}</u:Created><u:Expires>{expira.strftime(formato)}</u:Expires>'
+                      f'</u:Timestamp></o:Security>')
+        return _respuesta(_sobre(f'<AutenticaResponse xmlns="{NS_AUTENTICACION}">'
+                                 f'<AutenticaResult>{token}</AutenticaResult></AutenticaResponse>', encabezado))
+
+    @app.route('/SolicitaDescargaService.svc', methods=['POST'])
+    def solicitar():
+        servicio = 'Emitidos' if request.headers.get('SOAPAction', '').endswith('Emitidos') else 'Recibidos'
+        nombre = f'SolicitaDescarga{servicio}'
+
+        def resultado(cod_estatus, id_solicitud=''):
+            return _respuesta(_sobre(
+                f'<{nombre}Response xmlns="{NS_DESCARGA}"><{nombre}Result IdSolicitud="{id_solicitud}" '
+                f'CodEstatus="{cod_estatus}" Mensaje={quoteattr(MENSAJES[cod_estatus])}/></{nombre}Response>'
+            ))
+
+        if not token_valido():
+            return resultado('300')
+        atributos = _atributos_solicitud(request.get_data())
+        rango = (atributos.get('RfcSolicitante'), servicio, atributos.get('FechaInicial'), atributos.get('FechaFinal'))
+        for cod_estatus, probabilidad in config.fallos.items():
+            if config.rng.random() < probabilidad:
+                with estado.lock:
+                    previa = estado.por_rango.get(rango, '') if cod_estatus == '305' else ''
+                return resultado(cod_estatus, previa)
+
+        id_solicitud = str(uuid.uuid4())
+        with estado.lock:
+            estado.solicitudes[id_solicitud] = {
+                'rfc': rango[0],
+                'servicio': servicio,
+                'rango': _rango_solicitud(atributos),
+                # El mismo rango produce las mismas facturas, como en el SAT
+                'semilla': zlib.crc32('|'.join(map(str, rango)).encode()),
+                'verificaciones': 0
+            }
+            estado.por_rango[rango] = id_solicitud
+        return resultado('5000', id_solicitud)
+
+    @app.route('/VerificaSolicitudDescargaService.svc', methods=['POST'])
+    def verificar():
+        def resultado(cod_estatus, estado_solicitud='', numero_cfdis=0, paquetes=(), mensaje=None):
+            ids = ''.join(f'<IdsPaquetes>{paquete}</IdsPaquetes>' for paquete in paquetes)
+            return _respuesta(_sobre(
+                f'<VerificaSolicitudDescargaResponse xmlns="{NS_DESCARGA}"><VerificaSolicitudDescargaResult '
+                f'CodEstatus="{cod_estatus}" EstadoSolicitud="{estado_solicitud}" CodigoEstadoSolicitud="5000" '
+                f'NumeroCFDIs="{numero_cfdis}" Mensaje={quoteattr(mensaje or MENSAJES[cod_estatus])}>'
+                f'{ids}</VerificaSolicitudDescargaResult></VerificaSolicitudDescargaResponse>'
+            ))
+
+        if not token_valido():
+            return resultado('300')
+        id_solicitud = _atributos_solicitud(request.get_data()).get('IdSolicitud')
+        with estado.lock:
+            solicitud = estado.solicitudes.get(id_solicitud)
+            if solicitud is None:
+                return resultado('5000', '5', mensaje='Solicitud rechazada: no existe')
+            solicitud['verificaciones'] += 1
+            avance = solicitud['verificaciones']
+        if avance <= config.verificaciones:
+            # Aceptada en la primera verificación, en proceso en las siguientes
+            return resultado('5000', '1' if avance == 1 else '2')
+        paquetes = [f'{id_solicitud}_{i:02d}'.upper() for i in range(1, config.paquetes + 1)]
+        return resultado('5000', '3', config.paquetes * config.facturas_por_paquete, paquetes)
+
+    @app.route('/DescargaMasivaService.svc', methods=['POST'])
+    def descargar():
+        def resultado(cod_estatus, paquete_b64='', mensaje=None):
+            encabezado = (f'<h:respuesta xmlns:h="{NS_DESCARGA}" CodEstatus="{cod_estatus}" '
+                          f'Mensaje={quoteattr(mensaje or MENSAJES[cod_estatus])}/>')
+            return _respuesta(_sobre(
+                f'<RespuestaDescargaMasivaTercerosSalida xmlns="{NS_DESCARGA}">'
+                f'<Paquete>{paquete_b64}</Paquete></RespuestaDescargaMasivaTercerosSalida>', encabezado
+            ))
+
+        if not token_valido():
+            return resultado('300')
+        id_paquete = _atributos_solicitud(request.get_data()).get('IdPaquete', '')
+        id_solicitud, _, numero = id_paquete.lower().rpartition('_')
+        with estado.lock:
+            solicitud = estado.solicitudes.get(id_solicitud)
+        if solicitud is None or not numero.isdigit():
+            return resultado('5000', mensaje='No existe el paquete solicitado')
+        return resultado('5000', _paquete(estado, config, solicitud, int(numero)))
+
+    @app.route('/estadisticas', methods=['GET'])
+    def estadisticas():
+        """Llamadas recibidas por servicio (para cruzar con lo que reporta la prueba de carga)"""
+        with estado.lock:
+            return {'llamadas': dict(estado.llamadas), 'solicitudes': len(estado.solicitudes)}
+
+    return app
+
+def _paquete(estado, config, solicitud, numero):
+    """
+    Base64 del paquete 'numero' de una solicitud: facturas del rango pedido, emitidas o recibidas
+    por el solicitante. Los más recientes se conservan en caché
+    """
+    semilla = solicitud['semilla']
+    clave = (semilla, numero, config.facturas_por_paquete, config.conceptos)
+    with estado.lock:
+        paquete = estado.paquetes.get(clave)
+        if paquete is not None:
+            estado.paquetes.move_to_end(clave)
+            return paquete
+    parte = 'emisor' if solicitud['servicio'] == 'Emitidos' else 'receptor'
+    paquete = generar_paquete(config.facturas_por_paquete, conceptos=config.conceptos, semilla=semilla,
+                              inicio=(numero - 1) * config.facturas_por_paquete,
+                              rango=solicitud['rango'], **{parte: solicitud['rfc']})
+    with estado.lock:
+        estado.paquetes[clave] = paquete
+        while len(estado.paquetes) > PAQUETES_EN_CACHE:
+            estado.paquetes.popitem(last=False)
+    return paquete
+
+def generar_fiel(rfc, password):
+    """
+    Certificado autofirmado (DER) y llave PKCS#8 cifrada (DER) con el RFC en el sujeto, como una
+    e.firma del SAT pero solo útil contra este simulador
+    """
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from cryptography.x509.oid import NameOID
+
+    llave = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    sujeto = x509.Name([
+        x509.NameAttribute(NameOID.COMMON_NAME, f'CONTRIBUYENTE DE PRUEBA {rfc}'),
+        x509.NameAttribute(NameOID.X500_UNIQUE_IDENTIFIER, rfc)
+    ])
+    certificado = (
+        x509.CertificateBuilder()
+        .subject_name(sujeto)
+        .issuer_name(sujeto)
+        .public_key(llave.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(datetime.datetime.utcnow() - datetime.timedelta(days=1))
+        .not_valid_after(datetime.datetime.utcnow() + datetime.timedelta(days=4 * 365))
+        .sign(llave, hashes.SHA256())
+    )
+    return (
+        certificado.public_bytes(serialization.Encoding.DER),
+        llave.private_bytes(serialization.Encoding.DER, serialization.PrivateFormat.PKCS8,
+                            serialization.BestAvailableEncryption(password.encode()))
+    )
+
+def guardar_fiel(directorio, rfc, password):
+    """Escribe <rfc>.cer y <rfc>.key en el directorio y regresa sus rutas"""
+    os.makedirs(directorio, exist_ok=True)
+    cer_der, key_der = generar_fiel(rfc, password)
+    rutas = (os.path.join(directorio, f'{rfc}.cer'), os.path.join(directorio, f'{rfc}.key'))
+    for ruta, datos in zip(rutas, (cer_der, key_der)):
+        with open(ruta, 'wb') as archivo:
+            archivo.write(datos)
+    return rutas
+
+def _fallos(texto):
+    """'5002=0.01,301=0.05' -> {'5002': 0.01, '301': 0.05}"""
+    fallos = {}
+    for parte in filter(None, (texto or '').split(',')):
+        codigo, _, probabilidad = parte.partition('=')
+        if codigo.strip() not in MENSAJES:
+            raise argparse.ArgumentTypeError(f'Código no simulado: {codigo}. Disponibles: {", ".join(MENSAJES)}')
+        fallos[codigo.strip()] = float(probabilidad)
+    return fallos
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulador local de los servicios web de descarga masiva del SAT')
+    parser.add_argument('--puerto', type=int, default=5099)
+    parser.add_argument('--latencia', type=float, default=0.0, help='Segundos por llamada')
+    parser.add_argument('--variacion', type=float, default=0.0, help='Segundos aleatorios extra por llamada')
+    parser.add_argument('--paquetes', type=int, default=1, help='Paquetes por solicitud')
+    parser.add_argument('--facturas-por-paquete', type=int, default=100)
+    parser.add_argument('--conceptos', type=int, default=5)
+    parser.add_argument('--verificaciones', type=int, default=1,
+                        help='Verificaciones antes de que la solicitud quede terminada')
+    parser.add_argument('--fallos', type=_fallos, default={},
+                        help='Probabilidad por código en SolicitaDescarga, p. ej. 5002=0.01,301=0.05,5004=0.1')
+    parser.add_argument('--fallo-http', type=float, default=0.0, help='Probabilidad de responder 500')
+    parser.add_argument('--vigencia-token', type=int, default=300)
+    parser.add_argument('--semilla', type=int)
+    parser.add_argument('--generar-fiel', metavar='DIRECTORIO', help='Solo escribir un .cer/.key de prueba y salir')
+    parser.add_argument('--rfc', default='AAA010101AAA')
+    parser.add_argument('--password', default='12345678a')
+    args = parser.parse_args()
+
+    if args.generar_fiel:
+        cer, key = guardar_fiel(args.generar_fiel, args.rfc, args.password)
+        print(f'Certificado: {cer}\nLlave: {key}\nContraseña: {args.password}')
+        return
+
+    config = Configuracion(
+        latencia=args.latencia, variacion=args.variacion, paquetes=args.paquetes,
+        facturas_por_paquete=args.facturas_por_paquete, conceptos=args.conceptos,
+        verificaciones=args.verificaciones, fallos=args.fallos, fallo_http=args.fallo_http,
+        vigencia_token=args.vigencia_token, semilla=args.semilla
+    )
+    print(f'Simulador del SAT en http://localhost:{args.puerto} (usar SAT_SOAP_URL=http://localhost:{args.puerto})')
+    crear_app(config).run(host='0.0.0.0', port=args.puerto, threaded=True)
+
+if __name__ == '__main__':
+    main()
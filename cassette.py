@@ -0,0 +1,198 @@
+import base64
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import deque
+import sat_token
+
+logger = logging.getLogger(__name__)
+
+# Grabación y reproducción de las llamadas de SATClient a cfdiclient (opcional):
+#   'grabar'     = se llama al SAT y cada respuesta se guarda en disco con lo que tardó
+#   'reproducir' = no se llama al SAT (ni se necesita la FIEL): se responde con lo grabado
+# Las grabaciones traen paquetes reales con facturas de clientes: tratarlas como datos confidenciales
+MODO = os.environ.get('SAT_CASSETTE', '')
+DIRECTORIO = os.environ.get('SAT_CASSETTE_DIR', os.path.join(os.path.dirname(__file__), 'cassettes'))
+# Al reproducir se espera lo que tardó la llamada original multiplicado por esto (0 = sin esperas)
+VELOCIDAD = float(os.environ.get('SAT_CASSETTE_VELOCIDAD', 1))
+
+# Métodos de los servicios de cfdiclient que se graban
+METODOS = ('obtener_token', 'solicitar_descarga', 'verificar_descarga', 'descargar_paquete')
+TOKEN_GRABADO = 'token-grabado'
+
+_cassettes = {}
+_cassettes_lock = threading.Lock()
+
+class SinGrabacion(Exception):
+    """Al reproducir, la llamada no se grabó (otros parámetros o otra solicitud)"""
+
+def _clave(metodo, args, kwargs):
+    """Identifica la llamada por sus parámetros, sin el token (cambia en cada sesión)"""
+    kwargs = {k: v for k, v in kwargs.items() if k != 'token'}
+    if metodo != 'obtener_token' and args:
+        args = args[1:]  # verificar_descarga / descargar_paquete reciben el token primero
+    return json.dumps([list(args), kwargs], default=str, sort_keys=True)
+
+def _detalle_error(error):
+    """(estatus_http, faultcode) de una falla del SAT: deciden si se reautentica (sat_token)"""
+    if isinstance(error, sat_token.ErrorSAT):
+        return error.estatus_http, error.faultcode
+    respuesta = getattr(error, 'response', None)  # requests.HTTPError
+    return getattr(respuesta, 'status_code', None), None
+
+def _abrir_privado(ruta, modo):
+    """Archivo legible solo por el dueño (las grabaciones contienen facturas reales)"""
+    bandera = os.O_WRONLY | os.O_CREAT | (os.O_APPEND if 'a' in modo else os.O_TRUNC)
+    return os.fdopen(os.open(ruta, bandera, 0o600), modo)
+
+class Cassette:
+    """Grabaciones de un RFC: interacciones.jsonl con cada llamada y los paquetes como .zip aparte"""
+
+    def __init__(self, directorio, rfc):
+        # El RFC forma parte de la ruta: no debe poder salir del directorio de grabaciones
+        if not re.fullmatch(r'[A-Z0-9&Ñ]+', rfc, re.IGNORECASE):
+            raise ValueError(f'RFC inválido para grabar: {rfc!r}')
+        self.directorio = os.path.join(directorio, rfc)
+        self.indice = os.path.join(self.directorio, 'interacciones.jsonl')
+        self._lock = threading.Lock()
+        self._pendientes = None  # (servicio, clave) -> deque de interacciones por reproducir
+
+    def grabar(self, servicio, clave, duracion, resultado=None, error=None):
+        """
+        Agrega una interacción; el token se reemplaza y el paquete se guarda decodificado en su .zip.
+        De un error (la excepción) se guardan el mensaje, el estatus HTTP y el faultcode
+        """
+        if isinstance(resultado, str) and servicio == 'Autenticacion':
+            resultado = TOKEN_GRABADO
+        paquete = None
+        if isinstance(resultado, dict) and resultado.get('paquete_b64'):
+            resultado = dict(resultado)
+            datos = base64.b64decode(resultado.pop('paquete_b64'))
+            paquete = hashlib.sha256(datos).hexdigest()[:32] + '.zip'
+        estatus_http, faultcode = _detalle_error(error) if error is not None else (None, None)
+        interaccion = {
+            'servicio': servicio,
+            'clave': clave,
+            'duracion': round(duracion, 4),
+            'resultado': resultado,
+            'error': str(error) if error is not None else None,
+            'estatus_http': estatus_http,
+            'faultcode': faultcode,
+            'paquete': paquete,
+            'fecha': time.strftime('%Y-%m-%dT%H:%M:%S')
+        }
+        with self._lock:
+            os.makedirs(os.path.join(self.directorio, 'paquetes'), mode=0o700, exist_ok=True)
+            if paquete:
+                with _abrir_privado(os.path.join(self.directorio, 'paquetes', paquete), 'wb') as archivo:
+                    archivo.write(datos)
+            with _abrir_privado(self.indice, 'a') as archivo:
+                archivo.write(json.dumps(interaccion, ensure_ascii=False, default=str) + '\n')
+
+    def _cargar(self):
+        pendientes = {}
+        try:
+            with open(self.indice, encoding='utf-8') as archivo:
+                for linea in archivo:
+                    if linea.strip():
+                        interaccion = json.loads(linea)
+                        pendientes.setdefault((interaccion['servicio'], interaccion['clave']), deque()).append(interaccion)
+        except FileNotFoundError:
+            logger.warning(f"No hay grabaciones en {self.directorio}")
+        return pendientes
+
+    def siguiente(self, servicio, clave):
+        """
+        Interacción grabada para esta llamada. Las repetidas (p. ej. verificar la misma solicitud
+        mientras avanza) salen en el orden en que se grabaron y la última se repite
+        """
+        with self._lock:
+            if self._pendientes is None:
+                self._pendientes = self._cargar()
+            cola = self._pendientes.get((servicio, clave))
+            if not cola:
+                raise SinGrabacion(f'Sin grabación de {servicio} para {clave}')
+            return cola.popleft() if len(cola) > 1 else cola[0]
+
+    def leer_paquete(self, nombre):
+        """Paquete grabado otra vez en base64, como lo entrega cfdiclient"""
+        with open(os.path.join(self.directorio, 'paquetes', nombre), 'rb') as archivo:
+            return base64.b64encode(archivo.read()).decode()
+
+def obtener(rfc, directorio=None):
+    """Cassette compartido del RFC (todas las llamadas del proceso escriben/leen el mismo)"""
+    directorio = directorio or DIRECTORIO
+    with _cassettes_lock:
+        return _cassettes.setdefault((directorio, rfc), Cassette(directorio, rfc))
+
+class _Grabador:
+    """Envuelve un servicio de cfdiclient: llama al SAT y graba resultado, error y duración"""
+
+    def __init__(self, servicio, nombre, cassette):
+        self._servicio = servicio
+        self._nombre = nombre
+        self._cassette = cassette
+
+    def __getattr__(self, metodo):
+        original = getattr(self._servicio, metodo)
+        if metodo not in METODOS:
+            return original
+
+        def grabado(*args, **kwargs):
+            clave = _clave(metodo, args, kwargs)
+            inicio = time.perf_counter()
+            try:
+                resultado = original(*args, **kwargs)
+            except Exception as e:
+                self._cassette.grabar(self._nombre, clave, time.perf_counter() - inicio, error=e)
+                raise
+            self._cassette.grabar(self._nombre, clave, time.perf_counter() - inicio, resultado=resultado)
+            return resultado
+        return grabado
+
+class _Reproductor:
+    """Ocupa el lugar de un servicio de cfdiclient y responde con lo grabado, con los mismos tiempos"""
+
+    def __init__(self, nombre, cassette, velocidad):
+        self._nombre = nombre
+        self._cassette = cassette
+        self._velocidad = velocidad
+
+    def __getattr__(self, metodo):
+        if metodo not in METODOS:
+            raise AttributeError(metodo)
+
+        def reproducido(*args, **kwargs):
+            interaccion = self._cassette.siguiente(self._nombre, _clave(metodo, args, kwargs))
+            if self._velocidad:
+                time.sleep(interaccion['duracion'] * self._velocidad)
+            if interaccion['error'] is not None:
+                estatus_http, faultcode = interaccion.get('estatus_http'), interaccion.get('faultcode')
+                if estatus_http is None and faultcode is None:
+                    raise Exception(interaccion['error'])  # grabaciones anteriores sin el detalle
+                # Como ErrorSAT, para que un 401/403 o fault de seguridad grabado vuelva a reautenticar
+                raise sat_token.ErrorSAT(interaccion['error'], estatus_http, faultcode)
+            resultado = interaccion['resultado']
+            if interaccion['paquete']:
+                resultado = dict(resultado, paquete_b64=self._cassette.leer_paquete(interaccion['paquete']))
+            return resultado
+        return reproducido
+
+def reproduciendo():
+    return MODO == 'reproducir'
+
+def envolver(clase, rfc, crear):
+    """
+    Servicio de cfdiclient según el modo: el real (crear()), el real con grabación, o un
+    reproductor que no necesita FIEL ni red
+    """
+    if MODO == 'reproducir':
+        return _Reproductor(clase.__name__, obtener(rfc), VELOCIDAD)
+    servicio = crear()
+    if MODO == 'grabar':
+        return _Grabador(servicio, clase.__name__, obtener(rfc))
+    return servicio
@@ -0,0 +1,260 @@
+import io
+import logging
+import multiprocessing
+import os
+import threading
+import xml.etree.ElementTree as ET
+import xml.parsers.expat
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Namespaces del SAT → versión de CFDI
+NS_CFDI = {
+    'http://www.sat.gob.mx/cfd/4': '4.0',
+    'http://www.sat.gob.mx/cfd/3': '3.3'
+}
+NS_TFD = 'http://www.sat.gob.mx/TimbreFiscalDigital'
+
+# Los XML se le dan a expat por bloques para que deje de leer en cuanto tiene lo necesario
+TAMANO_BLOQUE = 4096
+_TIMBRE = b'TimbreFiscalDigital'
+
+# En CFDI 3.2 los atributos van en camelCase y el tipo de comprobante con nombre completo
+_ATRIBUTOS_32 = {
+    'Fecha': 'fecha',
+    'Folio': 'folio',
+    'Serie': 'serie',
+    'Total': 'total',
+    'SubTotal': 'subTotal',
+    'TipoDeComprobante': 'tipoDeComprobante',
+    'Rfc': 'rfc',
+    'Nombre': 'nombre'
+}
+_TIPOS_32 = {'ingreso': 'I', 'egreso': 'E', 'traslado': 'T'}
+
+# Parseo en paralelo de paquetes grandes (opcional): 0 procesos = siempre en serie.
+# Abajo del umbral el costo de mandar los XML a otro proceso supera lo que se gana
+# (ver benchmarks/bench_parseo_paralelo.py para medir el punto de cruce en cada servidor)
+PROCESOS_PARSEO = int(os.environ.get('SAT_PARSEO_PROCESOS', 0))
+UMBRAL_PARSEO_PARALELO = int(os.environ.get('SAT_PARSEO_UMBRAL', 5000))  # XMLs por paquete
+XMLS_POR_TAREA = int(os.environ.get('SAT_PARSEO_LOTE', 500))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+class _Fin(Exception):
+    """Detiene expat en cuanto ya se leyeron los nodos necesarios"""
+
+def extraer_factura(xml_content):
+    """
+    Extrae los datos principales de un CFDI sin construir el árbol completo.
+
+    El encabezado (Comprobante, Emisor, Receptor) se lee con expat y se detiene al llegar
+    a Conceptos; el timbre se localiza en los bytes a partir de ahí y solo se parsea su etiqueta.
+    Así el costo no depende del número de conceptos. Si algo no cuadra (XML atípico),
+    se recurre al parseo con ElementTree.
+    """
+    try:
+        nodos = {}
+        fin_encabezado = [0]
+
+        def inicio_encabezado(nombre, atributos):
+            local = nombre[nombre.find(':') + 1:]
+            if local == 'Conceptos':
+                fin_encabezado[0] = parser.CurrentByteIndex
+                raise _Fin
+            if local in ('Comprobante', 'Emisor', 'Receptor'):
+                nodos[local] = (nombre, atributos)
+
+        parser = xml.parsers.expat.ParserCreate()
+        parser.StartElementHandler = inicio_encabezado
+        _parsear_por_bloques(parser, xml_content, 0)
+
+        if 'Comprobante' not in nodos:
+            return _extraer_con_arbol(xml_content)
+        nombre_raiz, comprobante = nodos['Comprobante']
+
+        # El namespace de la raíz determina la versión; no es CFDI si no es del SAT
+        prefijo = nombre_raiz[:nombre_raiz.find(':')] if ':' in nombre_raiz else ''
+        namespace = comprobante.get(f'xmlns:{prefijo}' if prefijo else 'xmlns')
+        if namespace not in NS_CFDI:
+            return _extraer_con_arbol(xml_content)
+
+        emisor = _del_namespace(nodos.get('Emisor'), prefijo)
+        receptor = _del_namespace(nodos.get('Receptor'), prefijo)
+
+        timbre = {}
+        inicio_timbre = _buscar_timbre(xml_content, fin_encabezado[0])
+        if inicio_timbre is not None:
+            def al_abrir_timbre(nombre, atributos):
+                timbre.update(atributos)
+                raise _Fin
+
+            parser = xml.parsers.expat.ParserCreate()
+            parser.StartElementHandler = al_abrir_timbre
+            _parsear_por_bloques(parser, xml_content, inicio_timbre)
+
+        return _armar_factura(comprobante, emisor, receptor, timbre)
+
+    except xml.parsers.expat.ExpatError:
+        return _extraer_con_arbol(xml_content)
+    except Exception as e:
+        logger.error(f"Error al parsear XML: {e}")
+        return None
+
+def _parsear_por_bloques(parser, xml_content, inicio):
+    """Alimenta expat desde 'inicio' hasta que un manejador lance _Fin"""
+    posicion = inicio
+    total = len(xml_content)
+    try:
+        while posicion < total:
+            fin = posicion + TAMANO_BLOQUE
+            parser.Parse(xml_content[posicion:fin], fin >= total)
+            posicion = fin
+    except _Fin:
+        pass
+
+def _buscar_timbre(xml_content, desde):
+    """Posición del '<' que abre la etiqueta TimbreFiscalDigital (con o sin prefijo)"""
+    posicion = xml_content.find(_TIMBRE, desde)
+    while posicion != -1:
+        # Descartar apariciones dentro de atributos (xmlns, schemaLocation) o en la etiqueta de cierre
+        apertura = xml_content.rfind(b'<', 0, posicion)
+        etiqueta = xml_content[apertura + 1:posicion]
+        if b' ' not in etiqueta and b'/' not in etiqueta and (not etiqueta or etiqueta.endswith(b':')):
+            return apertura
+        posicion = xml_content.find(_TIMBRE, posicion + len(_TIMBRE))
+    return None
+
+def _del_namespace(nodo, prefijo):
+    """Regresa los atributos del nodo solo si pertenece al mismo namespace que el Comprobante"""
+    if nodo is None:
+        return None
+    nombre, atributos = nodo
+    esperado = f'{prefijo}:' if prefijo else ''
+    return atributos if nombre[:nombre.find(':') + 1] == esperado else None
+
+def _extraer_con_arbol(xml_content):
+    """Parseo de respaldo con ElementTree recorriendo solo los hijos directos"""
+    try:
+        root = ET.fromstring(xml_content)
+        namespace = root.tag[1:root.tag.find('}')] if root.tag.startswith('{') else ''
+        if namespace not in NS_CFDI:
+            return None
+
+        emisor = receptor = None
+        timbre = {}
+        for hijo in root:
+            if hijo.tag == f'{{{namespace}}}Emisor':
+                emisor = hijo.attrib
+            elif hijo.tag == f'{{{namespace}}}Receptor':
+                receptor = hijo.attrib
+            elif hijo.tag == f'{{{namespace}}}Complemento':
+                nodo_timbre = hijo.find(f'{{{NS_TFD}}}TimbreFiscalDigital')
+                if nodo_timbre is not None:
+                    timbre = nodo_timbre.attrib
+
+        return _armar_factura(root.attrib, emisor, receptor, timbre)
+    except Exception as e:
+        logger.error(f"Error al parsear XML: {e}")
+        return None
+
+def _armar_factura(comprobante, emisor, receptor, timbre):
+    """Construye el diccionario de factura a partir de los atributos ya extraídos"""
+    version = comprobante.get('Version') or comprobante.get('version', '')
+    if version.startswith('3.2'):
+        def atributo(nodo, nombre, defecto=''):
+            return nodo.get(_ATRIBUTOS_32.get(nombre, nombre), defecto) if nodo is not None else defecto
+    else:
+        def atributo(nodo, nombre, defecto=''):
+            return nodo.get(nombre, defecto) if nodo is not None else defecto
+
+    tipo_comprobante = atributo(comprobante, 'TipoDeComprobante', 'I')
+    tipo_comprobante = _TIPOS_32.get(tipo_comprobante, tipo_comprobante)
+
+    fecha_cancelacion = timbre.get('FechaCancelacion')
+    # Determinar estado: si no tiene fecha de cancelación, está vigente
+    estado = 'Cancelado' if fecha_cancelacion else 'Vigente'
+
+    return {
+        'uuid': timbre.get('UUID', ''),
+        'fecha': atributo(comprobante, 'Fecha'),
+        'serie': atributo(comprobante, 'Serie'),
+        'folio': atributo(comprobante, 'Folio', 'N/A'),
+        'rfcEmisor': atributo(emisor, 'Rfc'),
+        'nombreEmisor': atributo(emisor, 'Nombre'),
+        'rfcReceptor': atributo(receptor, 'Rfc'),
+        'nombreReceptor': atributo(receptor, 'Nombre'),
+        'subtotal': float(atributo(comprobante, 'SubTotal', '0')),
+        'total': float(atributo(comprobante, 'Total', '0')),
+        'moneda': comprobante.get('Moneda', 'MXN'),
+        'tipoComprobante': tipo_comprobante,
+        'estado': estado,
+        'fechaCancelacion': fecha_cancelacion
+    }
+
+def iterar_facturas_de_zip(zip_data, procesos=None, umbral=None, con_xml=False):
+    """
+    Entrega una por una, en el orden del ZIP, las facturas de un paquete (bytes o archivo).
+    Si el paquete tiene al menos 'umbral' XML y hay procesos configurados, el parseo se
+    reparte en un pool de procesos; si no, se parsea en serie leyendo un XML a la vez.
+    Con con_xml=True entrega tuplas (factura, xml original) para poder archivarlo.
+    """
+    procesos = PROCESOS_PARSEO if procesos is None else procesos
+    umbral = UMBRAL_PARSEO_PARALELO if umbral is None else umbral
+    try:
+        origen = zip_data if hasattr(zip_data, 'read') else io.BytesIO(zip_data)
+        with zipfile.ZipFile(origen) as zip_file:
+            nombres = [nombre for nombre in zip_file.namelist() if nombre.endswith('.xml')]
+            if procesos > 1 and len(nombres) >= umbral:
+                yield from _parsear_en_pool(zip_file, nombres, procesos, con_xml)
+                return
+
+            for filename in nombres:
+                xml_content = zip_file.read(filename)
+                try:
+                    factura = extraer_factura(xml_content)
+                except Exception as e:
+                    logger.warning(f"Error al parsear {filename}: {e}")
+                    continue
+                if factura:
+                    yield (factura, xml_content) if con_xml else factura
+    except zipfile.BadZipFile as e:
+        logger.error(f"Error al abrir ZIP: {e}")
+
+def _obtener_pool(procesos):
+    """Pool de procesos compartido, creado la primera vez que se necesita"""
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool._max_workers != procesos:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            # 'spawn' para no heredar hilos ni conexiones del proceso del servidor
+            _pool = ProcessPoolExecutor(max_workers=procesos, mp_context=multiprocessing.get_context('spawn'))
+        return _pool
+
+def _parsear_lote(xmls):
+    """Tarea de un proceso del pool: parsea una lista de XML; None donde el XML no es válido"""
+    return list(map(extraer_factura, xmls))
+
+def _parsear_en_pool(zip_file, nombres, procesos, con_xml=False):
+    """Reparte los XML por lotes en el pool manteniendo pocos lotes en vuelo y el orden original"""
+    pool = _obtener_pool(procesos)
+    en_vuelo = deque()
+
+    def resultados(lote, futuro):
+        for factura, xml_content in zip(futuro.result(), lote):
+            if factura:
+                yield (factura, xml_content) if con_xml else factura
+
+    for inicio in range(0, len(nombres), XMLS_POR_TAREA):
+        lote = [zip_file.read(nombre) for nombre in nombres[inicio:inicio + XMLS_POR_TAREA]]
+        en_vuelo.append((lote, pool.submit(_parsear_lote, lote)))
+        # Con 2 lotes por proceso los procesos no esperan y la memoria queda acotada
+        if len(en_vuelo) >= procesos * 2:
+            yield from resultados(*en_vuelo.popleft())
+    while en_vuelo:
+        yield from resultados(*en_vuelo.popleft())
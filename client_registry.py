@@ -0,0 +1,146 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Clientes del SAT (con su FIEL descifrada) que se conservan en memoria por worker
+MAX_CLIENTES = int(os.environ.get('SAT_CLIENTES_MAX', 500))
+# Segundos sin uso tras los que un cliente se descarta; la siguiente consulta lo vuelve a crear
+INACTIVIDAD_CLIENTE = int(os.environ.get('SAT_CLIENTES_INACTIVIDAD', 30 * 60))
+
+class RegistroClientes:
+    """
+    SATClient por RFC con tamaño máximo (LRU) y vigencia por inactividad.
+    La creación de un cliente se serializa por RFC: dos requests simultáneos del mismo RFC
+    no leen ni descifran la FIEL dos veces; los de RFCs distintos no se esperan entre sí.
+    """
+
+    def __init__(self, maximo=MAX_CLIENTES, inactividad=INACTIVIDAD_CLIENTE):
+        self.maximo = maximo
+        self.inactividad = inactividad
+        self._clientes = OrderedDict()  # rfc -> (cliente, último uso); el menos usado al inicio
+        self._lock = threading.Lock()
+        self._locks_rfc = {}  # rfc -> [lock, hilos que lo usan]
+        self._contadores = {'aciertos': 0, 'fallos': 0, 'desalojos': 0, 'vencidos': 0}
+
+    @contextmanager
+    def _bloqueo_rfc(self, rfc):
+        with self._lock:
+            entrada = self._locks_rfc.setdefault(rfc, [threading.Lock(), 0])
+            entrada[1] += 1
+        try:
+            with entrada[0]:
+                yield
+        finally:
+            with self._lock:
+                entrada[1] -= 1
+                if not entrada[1]:
+                    del self._locks_rfc[rfc]
+
+    def _vencido(self, ultimo_uso, ahora):
+        return self.inactividad and ahora - ultimo_uso > self.inactividad
+
+    def _descartar(self, rfc, cliente, contador):
+        # Sin esto el timer de renovación del token mantendría vivo al cliente (y su FIEL)
+        cliente.tokens.detener()
+        self._contadores[contador] += 1
+        logger.debug(f"Cliente SAT de {rfc} descartado ({contador})")
+
+    def _purgar(self, ahora):
+        """Quita los vencidos del inicio y los que excedan el máximo; se llama con self._lock"""
+        while self._clientes:
+            rfc, (cliente, ultimo_uso) = next(iter(self._clientes.items()))
+            if len(self._clientes) > self.maximo:
+                contador = 'desalojos'
+            elif self._vencido(ultimo_uso, ahora):
+                contador = 'vencidos'
+            else:
+                break
+            del self._clientes[rfc]
+            self._descartar(rfc, cliente, contador)
+
+    def _tomar(self, rfc):
+        """Cliente vigente del RFC (marcándolo como usado) o None; se llama con self._lock"""
+        ahora = time.time()
+        entrada = self._clientes.get(rfc)
+        if entrada and self._vencido(entrada[1], ahora):
+            del self._clientes[rfc]
+            self._descartar(rfc, entrada[0], 'vencidos')
+            entrada = None
+        if not entrada:
+            return None
+        self._clientes[rfc] = (entrada[0], ahora)
+        self._clientes.move_to_end(rfc)
+        return entrada[0]
+
+    def obtener(self, rfc):
+        """Regresa el cliente del RFC o None si no está (o ya venció)"""
+        with self._lock:
+            cliente = self._tomar(rfc)
+            self._contadores['aciertos' if cliente else 'fallos'] += 1
+            return cliente
+
+    def obtener_o_crear(self, rfc, crear):
+        """
+        Regresa el cliente del RFC; si no está, lo crea con crear() una sola vez aunque haya
+        varios requests esperando. Si crear() regresa None no se registra nada.
+        """
+        with self._lock:
+            cliente = self._tomar(rfc)
+        if not cliente:
+            with self._bloqueo_rfc(rfc):
+                # Otro hilo pudo haberlo creado mientras se esperaba el lock
+                with self._lock:
+                    cliente = self._tomar(rfc)
+                if not cliente:
+                    return self._crear(rfc, crear)
+        with self._lock:
+            self._contadores['aciertos'] += 1
+        return cliente
+
+    def _crear(self, rfc, crear):
+        """Crea y registra el cliente; se llama con el lock del RFC tomado"""
+        with self._lock:
+            self._contadores['fallos'] += 1
+        cliente = crear()
+        if cliente:
+            self._guardar(rfc, cliente)
+        return cliente
+
+    def registrar(self, rfc, cliente):
+        """Guarda (o reemplaza) el cliente de un RFC, por ejemplo al subir certificados nuevos"""
+        with self._bloqueo_rfc(rfc):
+            self._guardar(rfc, cliente)
+
+    def _guardar(self, rfc, cliente):
+        with self._lock:
+            anterior = self._clientes.pop(rfc, None)
+            if anterior and anterior[0] is not cliente:
+                anterior[0].tokens.detener()
+            self._clientes[rfc] = (cliente, time.time())
+            self._purgar(time.time())
+
+    def descartar(self, rfc):
+        """Quita el cliente de un RFC (certificados o contraseña cambiaron)"""
+        with self._lock:
+            entrada = self._clientes.pop(rfc, None)
+            if entrada:
+                entrada[0].tokens.detener()
+
+    def __contains__(self, rfc):
+        with self._lock:
+            entrada = self._clientes.get(rfc)
+            return bool(entrada) and not self._vencido(entrada[1], time.time())
+
+    def __len__(self):
+        return len(self._clientes)
+
+    def estadisticas(self):
+        """Tamaño actual y contadores de aciertos, fallos, desalojos (LRU) y vencidos (inactividad)"""
+        with self._lock:
+            self._purgar(time.time())
+            return {'clientes': len(self._clientes), 'maximo': self.maximo, **self._contadores}
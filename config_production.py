@@ -21,6 +21,12 @@ ALLOWED_ORIGINS = [
     'http://localhost',  # Solo para pruebas locales
 ]
 
+# Clave maestra para cifrar en la base las llaves de FIEL en caché y la contraseña de las FIEL
+# subidas (tabla certificados_subidos). OBLIGATORIA en producción: sin ella la contraseña queda
+# en texto plano. Generar una con:
+#   python -c "from cryptography.fernet import Fernet; print(Fernet.generate_key().decode())"
+FIEL_CACHE_CLAVE = os.environ.get('FIEL_CACHE_CLAVE')
+
 # Base de datos
 DB_PATH = os.path.join(os.path.dirname(__file__), 'sat_users.db')
 
@@ -28,8 +34,6 @@ DB_PATH = os.path.join(os.path.dirname(__file__), 'sat_users.db')
 CERTS_DIR = os.path.join(os.path.dirname(__file__), 'certificados_usuarios')
 
 # Sesiones
-SESSION_TYPE = 'filesystem'
-SESSION_FILE_DIR = os.path.join(os.path.dirname(__file__), 'flask_session')
+SESSION_TYPE = 'sqlite'  # 'sqlite' (compartido entre workers) o 'memoria' (un solo worker)
 SESSION_PERMANENT = True
-SESSION_USE_SIGNER = True
 PERMANENT_SESSION_LIFETIME = 86400  # 24 horas
@@ -1,13 +1,73 @@
 import sqlite3
 import hashlib
+import logging
 import os
+import threading
+from contextlib import contextmanager
 from datetime import datetime
 
-DB_PATH = os.path.join(os.path.dirname(__file__), 'sat_users.db')
+logger = logging.getLogger(__name__)
+
+# Configurables para correr instancias aisladas (p. ej. benchmarks/carga.py con --levantar)
+DB_PATH = os.environ.get('SAT_DB_PATH', os.path.join(os.path.dirname(__file__), 'sat_users.db'))
+CERTS_DIR = os.environ.get('SAT_CERTS_DIR', os.path.join(os.path.dirname(__file__), 'certificados_usuarios'))
+
+# Ajustes de SQLite para cada conexión: WAL deja leer mientras otro hilo escribe y
+# synchronous=NORMAL es seguro con WAL (solo se puede perder la última transacción ante un corte de luz)
+PRAGMAS = (
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA busy_timeout = 30000',
+    'PRAGMA cache_size = -16000',  # KB (16 MB)
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA mmap_size = 134217728'  # 128 MB
+)
+# Sentencias preparadas que cada conexión mantiene en caché
+SENTENCIAS_EN_CACHE = 256
+
+_local = threading.local()
+
+def obtener_conexion():
+    """
+    Conexión de SQLite del hilo actual, abierta la primera vez y reutilizada después.
+    Quien la usa no debe cerrarla; para escribir se usa 'with conn:' (commit o rollback).
+    """
+    conn = getattr(_local, 'conn', None)
+    # Un worker creado con fork hereda el objeto pero no debe usar la conexión del padre
+    if conn is None or _local.pid != os.getpid():
+        conn = sqlite3.connect(DB_PATH, timeout=30, cached_statements=SENTENCIAS_EN_CACHE)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        _local.conn = conn
+        _local.pid = os.getpid()
+    return conn
+
+def cerrar_conexion():
+    """Cierra la conexión del hilo actual (por ejemplo, antes de borrar el archivo de la base)"""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+
+@contextmanager
+def cambio_de_esquema(conn):
+    """
+    Transacción BEGIN IMMEDIATE para las migraciones de init_db que revisan el esquema y luego lo
+    alteran: si varios workers arrancan a la vez, los demás esperan al primero y al entrar ya ven
+    el esquema migrado (cada DDL suelto se confirma por separado y dejaría ver estados intermedios)
+    """
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
 
 def init_db():
     """Inicializa la base de datos con las tablas necesarias"""
-    conn = sqlite3.connect(DB_PATH)
+    conn = obtener_conexion()
+    # El modo WAL queda guardado en el archivo; basta con activarlo una vez
+    conn.execute('PRAGMA journal_mode = WAL')
     cursor = conn.cursor()
     
     # Tabla de usuarios
@@ -36,10 +96,13 @@ def init_db():
             UNIQUE(usuario_id, rfc)
         )
     ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_datos_fiscales_usuario_fecha
+        ON datos_fiscales (usuario_id, fecha_subida)
+    ''')
     
     conn.commit()
-    conn.close()
-    print("✅ Base de datos inicializada")
+    logger.info("Base de datos inicializada")
 
 def hash_password(password):
     """Genera un hash SHA-256 de la contraseña"""
@@ -48,19 +111,16 @@ def hash_password(password):
 def registrar_usuario(nombre, email, telefono, password):
     """Registra un nuevo usuario"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
+        conn = obtener_conexion()
         
         password_hash = hash_password(password)
         
-        cursor.execute('''
-            INSERT INTO usuarios (nombre, email, telefono, password_hash)
-            VALUES (?, ?, ?, ?)
-        ''', (nombre, email, telefono, password_hash))
-        
-        conn.commit()
+        with conn:
+            cursor = conn.execute('''
+                INSERT INTO usuarios (nombre, email, telefono, password_hash)
+                VALUES (?, ?, ?, ?)
+            ''', (nombre, email, telefono, password_hash))
         usuario_id = cursor.lastrowid
-        conn.close()
         
         return {'success': True, 'usuario_id': usuario_id}
     except sqlite3.IntegrityError:
@@ -71,19 +131,13 @@ def registrar_usuario(nombre, email, telefono, password):
 def validar_login(email, password):
     """Valida las credenciales de login"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
         password_hash = hash_password(password)
         
-        cursor.execute('''
+        usuario = obtener_conexion().execute('''
             SELECT id, nombre, email, telefono
             FROM usuarios
             WHERE email = ? AND password_hash = ?
-        ''', (email, password_hash))
-        
-        usuario = cursor.fetchone()
-        conn.close()
+        ''', (email, password_hash)).fetchone()
         
         if usuario:
             return {
@@ -104,7 +158,7 @@ def guardar_datos_fiscales(usuario_id, rfc, certificado_data, llave_data, passwo
     """Guarda los datos fiscales del usuario"""
     try:
         # Crear directorio para certificados si no existe
-        certs_dir = os.path.join(os.path.dirname(__file__), 'certificados_usuarios', str(usuario_id))
+        certs_dir = os.path.join(CERTS_DIR, str(usuario_id))
         os.makedirs(certs_dir, exist_ok=True)
         
         # Guardar archivos de certificado y llave
@@ -122,37 +176,35 @@ def guardar_datos_fiscales(usuario_id, rfc, certificado_data, llave_data, passwo
         # TODO: Implementar cifrado AES con una clave maestra
         password_encrypted = password_fiscal  # Temporal: sin cifrar
         
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
         # Actualizar o insertar datos fiscales
-        cursor.execute('''
-            INSERT INTO datos_fiscales (usuario_id, rfc, certificado_path, llave_path, password_encrypted)
-            VALUES (?, ?, ?, ?, ?)
-            ON CONFLICT(usuario_id, rfc) DO UPDATE SET
-                certificado_path = excluded.certificado_path,
-                llave_path = excluded.llave_path,
-                password_encrypted = excluded.password_encrypted,
-                fecha_subida = CURRENT_TIMESTAMP
-        ''', (usuario_id, rfc, cert_path, key_path, password_encrypted))
-        
-        conn.commit()
-        conn.close()
-        
-        print(f"✅ Datos fiscales guardados en DB para usuario {usuario_id}, RFC {rfc}")
-        print(f"   - Cert: {cert_path}")
-        print(f"   - Key: {key_path}")
-        
-        return {'success': True, 'message': 'Datos fiscales guardados correctamente'}
+        with obtener_conexion() as conn:
+            conn.execute('''
+                INSERT INTO datos_fiscales (usuario_id, rfc, certificado_path, llave_path, password_encrypted)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(usuario_id, rfc) DO UPDATE SET
+                    certificado_path = excluded.certificado_path,
+                    llave_path = excluded.llave_path,
+                    password_encrypted = excluded.password_encrypted,
+                    fecha_subida = CURRENT_TIMESTAMP
+            ''', (usuario_id, rfc, cert_path, key_path, password_encrypted))
+        
+        logger.info(f"Datos fiscales guardados en DB para usuario {usuario_id}, RFC {rfc}",
+                    extra={'datos': {'certificado_path': cert_path, 'llave_path': key_path}})
+        
+        return {
+            'success': True,
+            'message': 'Datos fiscales guardados correctamente',
+            'certificado_path': cert_path,
+            'llave_path': key_path
+        }
     except Exception as e:
         return {'success': False, 'message': str(e)}
 
 def obtener_datos_fiscales(usuario_id, rfc=None):
     """Obtiene los datos fiscales de un usuario"""
     try:
-        print(f"🔍 DEBUG obtener_datos_fiscales - usuario_id: {usuario_id}, rfc: {rfc}")
-        conn = sqlite3.connect(DB_PATH, timeout=30)
-        cursor = conn.cursor()
+        logger.debug("obtener_datos_fiscales - usuario_id: %s, rfc: %s", usuario_id, rfc)
+        cursor = obtener_conexion().cursor()
         
         if rfc:
             cursor.execute('''
@@ -169,15 +221,7 @@ def obtener_datos_fiscales(usuario_id, rfc=None):
             ''', (usuario_id,))
         
         resultados = cursor.fetchall()
-        print(f"🔍 DEBUG - Resultados de la query: {resultados}")
-        print(f"🔍 DEBUG - Cantidad de resultados: {len(resultados)}")
-        
-        # Verificar qué hay en la tabla
-        cursor.execute('SELECT usuario_id, rfc FROM datos_fiscales')
-        todos = cursor.fetchall()
-        print(f"🔍 DEBUG - TODOS los registros en datos_fiscales: {todos}")
-        
-        conn.close()
+        logger.debug("Cantidad de resultados: %s", len(resultados))
         
         if resultados:
             datos = []
@@ -188,15 +232,13 @@ def obtener_datos_fiscales(usuario_id, rfc=None):
                     'llave_path': row[2],
                     'password_encrypted': row[3]
                 })
-            print(f"✅ DEBUG - Datos encontrados: {datos}")
+            logger.debug("Datos encontrados", extra={'datos': {'datos_fiscales': datos}})
             return {'success': True, 'datos': datos if not rfc else datos[0]}
         else:
-            print(f"❌ DEBUG - No se encontraron datos fiscales para usuario_id={usuario_id}")
+            logger.info(f"No se encontraron datos fiscales para usuario_id={usuario_id}")
             return {'success': False, 'message': 'No se encontraron datos fiscales'}
     except Exception as e:
-        print(f"❌ DEBUG - Error en obtener_datos_fiscales: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception(f"Error en obtener_datos_fiscales: {e}")
         return {'success': False, 'message': str(e)}
 
 # Inicializar la base de datos al importar el módulo
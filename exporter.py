@@ -0,0 +1,156 @@
+import csv
+import io
+import zipfile
+from xml.sax.saxutils import escape
+
+# Columnas exportables (llave de la factura -> encabezado), en el orden por defecto
+COLUMNAS = {
+    'uuid': 'UUID',
+    'fecha': 'Fecha',
+    'serie': 'Serie',
+    'folio': 'Folio',
+    'rfcEmisor': 'RFC emisor',
+    'nombreEmisor': 'Nombre emisor',
+    'rfcReceptor': 'RFC receptor',
+    'nombreReceptor': 'Nombre receptor',
+    'subtotal': 'Subtotal',
+    'total': 'Total',
+    'moneda': 'Moneda',
+    'tipoComprobante': 'Tipo de comprobante',
+    'estado': 'Estado',
+    'fechaCancelacion': 'Fecha de cancelación'
+}
+COLUMNAS_NUMERICAS = ('subtotal', 'total')
+
+# Filas que se acumulan antes de entregar un bloque de la respuesta
+FILAS_POR_BLOQUE = 500
+
+TIPOS_CONTENIDO = {
+    'csv': 'text/csv; charset=utf-8',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+}
+
+def elegir_columnas(texto):
+    """Lista de columnas a partir de 'uuid,fecha,total' (None o vacío = todas); ValueError si alguna no existe"""
+    if not texto:
+        return list(COLUMNAS)
+    columnas = [c.strip() for c in texto.split(',') if c.strip()]
+    desconocidas = [c for c in columnas if c not in COLUMNAS]
+    if desconocidas or not columnas:
+        raise ValueError(f"Columnas no válidas: {', '.join(desconocidas) or texto}. "
+                         f"Disponibles: {', '.join(COLUMNAS)}")
+    return columnas
+
+def exportar_csv(facturas, columnas):
+    """Genera el CSV por bloques de texto a partir de cualquier iterable de facturas"""
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer)
+    # BOM para que Excel reconozca el UTF-8 (acentos en nombres)
+    buffer.write('\ufeff')
+    escritor.writerow([COLUMNAS[c] for c in columnas])
+    for i, factura in enumerate(facturas, 1):
+        escritor.writerow([factura.get(c) for c in columnas])
+        if i % FILAS_POR_BLOQUE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+class SalidaEnBloques:
+    """Destino de escritura no posicionable para ZipFile: acumula bytes hasta que se vacían"""
+
+    def __init__(self):
+        self._partes = []
+
+    def write(self, datos):
+        self._partes.append(bytes(datos))
+        return len(datos)
+
+    def flush(self):
+        pass
+
+    def vaciar(self):
+        datos = b''.join(self._partes)
+        self._partes = []
+        return datos
+
+_CONTENT_TYPES = '''<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+<Default Extension="xml" ContentType="application/xml"/>
+<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>
+<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>
+<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>
+</Types>'''
+
+_RELS = '''<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>
+</Relationships>'''
+
+_WORKBOOK = '''<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">
+<sheets><sheet name="Facturas" sheetId="1" r:id="rId1"/></sheets>
+</workbook>'''
+
+_WORKBOOK_RELS = '''<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>
+<Relationship Id="rId2" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>
+</Relationships>'''
+
+_STYLES = '''<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">
+<fonts count="1"><font><sz val="11"/><name val="Calibri"/></font></fonts>
+<fills count="1"><fill><patternFill patternType="none"/></fill></fills>
+<borders count="1"><border/></borders>
+<cellStyleXfs count="1"><xf/></cellStyleXfs>
+<cellXfs count="1"><xf/></cellXfs>
+</styleSheet>'''
+
+def _celda(valor, numerica):
+    if valor is None or valor == '':
+        return '<c/>'
+    if numerica and isinstance(valor, (int, float)):
+        return f'<c><v>{valor}</v></c>'
+    # Cadenas en línea: sin tabla de cadenas compartidas que habría que tener completa en memoria
+    return f'<c t="inlineStr"><is><t xml:space="preserve">{escape(str(valor))}</t></is></c>'
+
+def _fila(valores, numericas):
+    return '<row>' + ''.join(_celda(v, n) for v, n in zip(valores, numericas)) + '</row>'
+
+def exportar_xlsx(facturas, columnas):
+    """
+    Genera un XLSX por bloques de bytes sin tener el libro en memoria: la hoja se escribe
+    fila por fila dentro del ZIP y lo comprimido se entrega conforme se produce
+    """
+    salida = SalidaEnBloques()
+    with zipfile.ZipFile(salida, 'w', zipfile.ZIP_DEFLATED) as libro:
+        libro.writestr('[Content_Types].xml', _CONTENT_TYPES)
+        libro.writestr('_rels/.rels', _RELS)
+        libro.writestr('xl/workbook.xml', _WORKBOOK)
+        libro.writestr('xl/_rels/workbook.xml.rels', _WORKBOOK_RELS)
+        libro.writestr('xl/styles.xml', _STYLES)
+        yield salida.vaciar()
+
+        with libro.open('xl/worksheets/sheet1.xml', 'w', force_zip64=True) as hoja:
+            hoja.write(b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                       b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>')
+            numericas = [c in COLUMNAS_NUMERICAS for c in columnas]
+            filas = [_fila([COLUMNAS[c] for c in columnas], [False] * len(columnas))]
+            for factura in facturas:
+                filas.append(_fila([factura.get(c) for c in columnas], numericas))
+                if len(filas) >= FILAS_POR_BLOQUE:
+                    hoja.write(''.join(filas).encode())
+                    filas = []
+                    datos = salida.vaciar()
+                    if datos:
+                        yield datos
+            hoja.write((''.join(filas) + '</sheetData></worksheet>').encode())
+    yield salida.vaciar()
+
+def exportar(facturas, formato, columnas):
+    """Generador de bloques del archivo en el formato pedido ('csv' o 'xlsx')"""
+    if formato == 'xlsx':
+        return exportar_xlsx(facturas, columnas)
+    return exportar_csv(facturas, columnas)
@@ -0,0 +1,143 @@
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from cfdiclient import Fiel
+from cryptography.fernet import Fernet, InvalidToken
+import database
+
+logger = logging.getLogger(__name__)
+
+# FIELs ya descifradas que se conservan en memoria por worker
+MAX_FIELS_MEMORIA = int(os.environ.get('FIEL_CACHE_MAX', 500))
+# Clave maestra (Fernet, 32 bytes en base64 urlsafe) para guardar la llave PEM cifrada en la base.
+# Sin ella el caché solo vive en memoria y cada reinicio vuelve a descifrar la .key
+CLAVE_MAESTRA = os.environ.get('FIEL_CACHE_CLAVE')
+# Días que se conserva en la base una llave que no se ha vuelto a usar
+DIAS_CACHE_BASE = int(os.environ.get('FIEL_CACHE_DIAS', 30))
+
+_fiels = OrderedDict()  # huella -> Fiel; la menos usada al inicio
+_por_ruta = {}  # ruta de la .key -> huella, para invalidar cuando se sobrescribe el archivo
+_lock = threading.Lock()
+_fernet = None
+
+def _crear_fernet():
+    if not CLAVE_MAESTRA:
+        return None
+    try:
+        return Fernet(CLAVE_MAESTRA.encode())
+    except Exception as e:
+        logger.warning(f"FIEL_CACHE_CLAVE inválida, el caché de FIEL queda solo en memoria: {e}")
+        return None
+
+def init_db():
+    """Crea la tabla de llaves cifradas (solo si hay clave maestra) y borra las que no se han usado"""
+    global _fernet
+    _fernet = _crear_fernet()
+    if not _fernet:
+        return
+    conn = database.obtener_conexion()
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS fiel_cache (
+            huella TEXT PRIMARY KEY,
+            ruta TEXT,
+            llave_cifrada BLOB NOT NULL,
+            fecha_uso TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_fiel_cache_ruta ON fiel_cache (ruta)')
+    cursor.execute("DELETE FROM fiel_cache WHERE fecha_uso < datetime('now', ?)", (f'-{DIAS_CACHE_BASE} days',))
+    conn.commit()
+    logger.info("Caché de FIEL en base de datos inicializado")
+
+def huella(cer_der, key_der, password):
+    """Identifica el par certificado/llave y la contraseña con la que se descifró"""
+    h = hashlib.sha256()
+    for parte in (cer_der, key_der, (password or '').encode()):
+        h.update(hashlib.sha256(parte).digest())
+    return h.hexdigest()
+
+def _recordar(clave, fiel, ruta):
+    """Guarda la FIEL en el LRU de memoria; se llama con _lock"""
+    _fiels[clave] = fiel
+    _fiels.move_to_end(clave)
+    while len(_fiels) > MAX_FIELS_MEMORIA:
+        _fiels.popitem(last=False)
+    if ruta:
+        _por_ruta[ruta] = clave
+
+def obtener(cer_der, key_der, password, ruta=None):
+    """Regresa la Fiel ya descifrada de este certificado/llave/contraseña, o None si no está en caché"""
+    clave = huella(cer_der, key_der, password)
+    with _lock:
+        fiel = _fiels.get(clave)
+        if fiel is not None:
+            _fiels.move_to_end(clave)
+            return fiel
+    if not _fernet:
+        return None
+
+    try:
+        conn = database.obtener_conexion()
+        row = conn.execute('SELECT llave_cifrada FROM fiel_cache WHERE huella = ?', (clave,)).fetchone()
+        if not row:
+            return None
+        fiel = Fiel(cer_der, _fernet.decrypt(row[0]), b'')
+        with conn:
+            conn.execute('UPDATE fiel_cache SET fecha_uso = CURRENT_TIMESTAMP WHERE huella = ?', (clave,))
+    except InvalidToken:
+        logger.warning("Llave en caché cifrada con otra clave maestra, se descarta")
+        with database.obtener_conexion() as conn:
+            conn.execute('DELETE FROM fiel_cache WHERE huella = ?', (clave,))
+        return None
+    except Exception as e:
+        logger.error(f"Error al leer FIEL del caché: {e}")
+        return None
+
+    with _lock:
+        _recordar(clave, fiel, ruta)
+    return fiel
+
+def guardar(cer_der, key_der, password, key_pem, fiel, ruta=None):
+    """Guarda una FIEL recién descifrada en memoria y, con clave maestra, cifrada en la base"""
+    clave = huella(cer_der, key_der, password)
+    with _lock:
+        _recordar(clave, fiel, ruta)
+    if not _fernet:
+        return
+    try:
+        with database.obtener_conexion() as conn:
+            conn.execute('''
+                INSERT INTO fiel_cache (huella, ruta, llave_cifrada) VALUES (?, ?, ?)
+                ON CONFLICT(huella) DO UPDATE SET ruta = excluded.ruta, fecha_uso = CURRENT_TIMESTAMP
+            ''', (clave, ruta, _fernet.encrypt(key_pem)))
+    except Exception as e:
+        logger.error(f"Error al guardar FIEL en caché: {e}")
+
+def invalidar(ruta):
+    """Olvida la FIEL cargada desde la .key de esta ruta (el archivo se va a sobrescribir)"""
+    with _lock:
+        clave = _por_ruta.pop(ruta, None)
+        if clave:
+            _fiels.pop(clave, None)
+    if not _fernet:
+        return
+    try:
+        with database.obtener_conexion() as conn:
+            conn.execute('DELETE FROM fiel_cache WHERE ruta = ?', (ruta,))
+    except Exception as e:
+        logger.error(f"Error al invalidar FIEL en caché: {e}")
+
+def cifrado_activo():
+    """True si hay clave maestra válida y cifrar() realmente cifra"""
+    return _fernet is not None
+
+def cifrar(datos):
+    """Cifra con la clave maestra; sin ella regresa los datos tal cual (igual que datos_fiscales)"""
+    return _fernet.encrypt(datos) if _fernet else datos
+
+def descifrar(datos):
+    """Inverso de cifrar(); lanza InvalidToken si se cifraron con otra clave maestra"""
+    return _fernet.decrypt(datos) if _fernet else bytes(datos)
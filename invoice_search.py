@@ -0,0 +1,209 @@
+import logging
+import re
+import database
+import invoice_store
+
+logger = logging.getLogger(__name__)
+
+# Campos de texto indexados con FTS5 (nombres, RFC de las contrapartes, serie y folio)
+COLUMNAS_TEXTO = ('nombre_emisor', 'nombre_receptor', 'rfc_emisor', 'rfc_receptor', 'serie', 'folio')
+# Parámetro de búsqueda → columna, para filtros de igualdad y conteos por faceta
+# El orden coincide con idx_facturas_facetas para que el GROUP BY recorra el índice sin ordenar
+FACETAS = {
+    'estado': 'estado',
+    'moneda': 'moneda',
+    'tipoComprobante': 'tipo_comprobante'
+}
+LIMITE_MAXIMO = 500
+# Con menos coincidencias del FTS que esto la búsqueda parte de ellas; con más, recorre los
+# índices del RFC y solo consulta el FTS como conjunto (el costo queda acotado en ambos casos)
+UMBRAL_FTS = 5000
+
+def init_db():
+    """Crea el índice FTS5 sobre facturas (sincronizado por triggers) y los índices de los filtros"""
+    conn = database.obtener_conexion()
+    # Todo en una transacción: workers que arrancan juntos no chocan al rehacer el FTS o el trigger,
+    # y ninguna actualización de facturas ocurre mientras el trigger no existe
+    with database.cambio_de_esquema(conn):
+        _crear_indices(conn)
+    logger.info("Índice de búsqueda de facturas inicializado")
+
+def _crear_indices(conn):
+    cursor = conn.cursor()
+    existia = cursor.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'facturas_fts'"
+    ).fetchone()
+    if existia and "content_rowid='id'" not in existia[0]:
+        # Índice creado sobre el rowid implícito (antes de que facturas tuviera id): se rehace
+        cursor.execute('DROP TABLE facturas_fts')
+        existia = None
+    columnas = ', '.join(COLUMNAS_TEXTO)
+    # Tabla de contenido externo: el texto vive en facturas y el FTS solo guarda el índice.
+    # remove_diacritics permite encontrar "Pérez" buscando "perez"
+    cursor.execute(f'''
+        CREATE VIRTUAL TABLE IF NOT EXISTS facturas_fts USING fts5(
+            {columnas}, content='facturas', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+    ''')
+    nuevos = ', '.join(f'new.{c}' for c in COLUMNAS_TEXTO)
+    viejos = ', '.join(f'old.{c}' for c in COLUMNAS_TEXTO)
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS facturas_fts_insertar AFTER INSERT ON facturas BEGIN
+            INSERT INTO facturas_fts (rowid, {columnas}) VALUES (new.id, {nuevos});
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS facturas_fts_borrar AFTER DELETE ON facturas BEGIN
+            INSERT INTO facturas_fts (facturas_fts, rowid, {columnas}) VALUES ('delete', old.id, {viejos});
+        END
+    ''')
+    # 'UPDATE OF' dispara aunque el valor no cambie (el upsert asigna todas las columnas): el WHEN
+    # evita reescribir el índice cuando se vuelve a descargar un paquete sin cambios.
+    # Solo se recrea si falta o es la versión anterior, que no tenía la condición
+    actualizar = cursor.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = 'facturas_fts_actualizar'"
+    ).fetchone()
+    if not actualizar or not re.search(r'\bWHEN\b', actualizar[0]):
+        cambios = ' OR '.join(f'old.{c} IS NOT new.{c}' for c in COLUMNAS_TEXTO)
+        cursor.execute('DROP TRIGGER IF EXISTS facturas_fts_actualizar')
+        cursor.execute(f'''
+            CREATE TRIGGER facturas_fts_actualizar AFTER UPDATE OF {columnas} ON facturas
+            WHEN {cambios} BEGIN
+                INSERT INTO facturas_fts (facturas_fts, rowid, {columnas}) VALUES ('delete', old.id, {viejos});
+                INSERT INTO facturas_fts (rowid, {columnas}) VALUES (new.id, {nuevos});
+            END
+        ''')
+    if not existia:
+        # Facturas guardadas antes de que existiera el índice
+        cursor.execute("INSERT INTO facturas_fts (facturas_fts) VALUES ('rebuild')")
+    # Facetas primero (el GROUP BY sale en orden del índice) y luego los filtros, para que total y
+    # conteos se resuelvan sin leer la tabla
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_facturas_facetas
+        ON facturas (rfc, estado, moneda, tipo_comprobante, tipo, fecha, total)
+    ''')
+    # Páginas ordenadas por fecha cuando no se filtra por tipo
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_facturas_rfc_fecha_uuid ON facturas (rfc, fecha, uuid)')
+
+def consulta_fts(texto):
+    """
+    Convierte lo que escribe el usuario en una consulta FTS5 segura: cada palabra como prefijo
+    entre comillas y todas requeridas ("acme 2024" → "acme"* "2024"*)
+    """
+    palabras = re.findall(r'\w+', texto or '')
+    return ' '.join('"' + palabra + '"*' for palabra in palabras)
+
+def _frase(valor):
+    return '"' + valor.replace('"', '""') + '"'
+
+def _pocas_coincidencias(conn, consulta):
+    return conn.execute(
+        'SELECT COUNT(*) FROM (SELECT 1 FROM facturas_fts WHERE facturas_fts MATCH ? LIMIT ?)',
+        (consulta, UMBRAL_FTS)
+    ).fetchone()[0] < UMBRAL_FTS
+
+def _filtros(conn, rfc, filtros):
+    """
+    FROM, WHERE y parámetros comunes a la búsqueda, el total y las facetas.
+    Texto, contraparte, serie y folio se resuelven con el índice FTS5 y se confirman con igualdad exacta
+    """
+    coincidencias = []
+    condiciones = []
+    parametros = []
+    texto = consulta_fts(filtros.get('q'))
+    if texto:
+        coincidencias.append(texto)
+    if filtros.get('contraparte'):
+        contraparte = filtros['contraparte'].upper()
+        coincidencias.append('{rfc_emisor rfc_receptor} : ' + _frase(contraparte))
+        condiciones.append('(f.rfc_emisor = ? OR f.rfc_receptor = ?)')
+        parametros.extend([contraparte] * 2)
+    for campo in ('serie', 'folio'):
+        if filtros.get(campo):
+            coincidencias.append(f'{campo} : ' + _frase(filtros[campo]))
+            condiciones.append(f'f.{campo} = ?')
+            parametros.append(filtros[campo])
+
+    consulta = ' '.join(coincidencias)
+    if consulta and _pocas_coincidencias(conn, consulta):
+        # CROSS JOIN fija el orden: primero el FTS y después cada factura por id.
+        # '+f.rfc' evita que SQLite prefiera recorrer todas las facturas del RFC por su índice
+        origen = 'facturas_fts CROSS JOIN facturas f ON f.id = facturas_fts.rowid'
+        condiciones[:0] = ['facturas_fts MATCH ?', '+f.rfc = ?']
+        parametros[:0] = [consulta, rfc]
+    elif consulta:
+        origen = 'facturas f'
+        condiciones[:0] = ['f.rfc = ?', 'f.id IN (SELECT rowid FROM facturas_fts WHERE facturas_fts MATCH ?)']
+        parametros[:0] = [rfc, consulta]
+    else:
+        origen = 'facturas f'
+        condiciones.insert(0, 'f.rfc = ?')
+        parametros.insert(0, rfc)
+
+    if filtros.get('tipo'):
+        condiciones.append('f.tipo = ?')
+        parametros.append(filtros['tipo'])
+    if filtros.get('desde'):
+        condiciones.append('f.fecha >= ?')
+        parametros.append(filtros['desde'])
+    if filtros.get('hasta'):
+        # Una fecha sin hora incluye todo ese día
+        condiciones.append('f.fecha <= ?')
+        parametros.append(filtros['hasta'] + ('T23:59:59' if len(filtros['hasta']) == 10 else ''))
+    if filtros.get('totalMin') is not None:
+        condiciones.append('f.total >= ?')
+        parametros.append(filtros['totalMin'])
+    if filtros.get('totalMax') is not None:
+        condiciones.append('f.total <= ?')
+        parametros.append(filtros['totalMax'])
+    for parametro, columna in FACETAS.items():
+        if filtros.get(parametro):
+            condiciones.append(f'f.{columna} = ?')
+            parametros.append(filtros[parametro])
+    return origen, ' AND '.join(condiciones), parametros
+
+def _contar(conn, origen, where, parametros):
+    """Total y conteo por faceta en una sola pasada: pocas combinaciones que se suman aquí"""
+    columnas = ', '.join(f'f.{columna}' for columna in FACETAS.values())
+    total = 0
+    facetas = {parametro: {} for parametro in FACETAS}
+    for *valores, cuenta in conn.execute(
+        f'SELECT {columnas}, COUNT(*) FROM {origen} WHERE {where} GROUP BY {columnas}', parametros
+    ):
+        total += cuenta
+        for parametro, valor in zip(FACETAS, valores):
+            facetas[parametro][valor or ''] = facetas[parametro].get(valor or '', 0) + cuenta
+    return total, {
+        parametro: dict(sorted(conteo.items(), key=lambda par: -par[1]))
+        for parametro, conteo in facetas.items()
+    }
+
+def buscar(rfc, filtros, limite=50, despues_de=None, descendente=True, contar=True):
+    """
+    Busca facturas almacenadas de un RFC. filtros: q (texto), tipo, desde, hasta, totalMin, totalMax,
+    contraparte (RFC), serie, folio, moneda, tipoComprobante, estado.
+    Regresa {'facturas', 'total', 'facetas', 'siguiente_cursor'}; pagina por (fecha, uuid).
+    Con contar=False (páginas siguientes, los conteos no cambian) total y facetas quedan en None.
+    """
+    conn = database.obtener_conexion()
+    origen, where, parametros = _filtros(conn, rfc, filtros)
+    total, facetas = _contar(conn, origen, where, parametros) if contar else (None, None)
+
+    orden = 'DESC' if descendente else 'ASC'
+    columnas_factura = ', '.join('f.' + c.strip() for c in invoice_store.COLUMNAS_FACTURA.split(','))
+    consulta = f'SELECT {columnas_factura} FROM {origen} WHERE {where}'
+    parametros_pagina = list(parametros)
+    if despues_de:
+        consulta += f" AND (f.fecha, f.uuid) {'<' if descendente else '>'} (?, ?)"
+        parametros_pagina.extend(despues_de)
+    # Una de más para saber si hay otra página
+    consulta += f' ORDER BY f.fecha {orden}, f.uuid {orden} LIMIT ?'
+    parametros_pagina.append(min(limite, LIMITE_MAXIMO) + 1)
+    facturas = [invoice_store.fila_a_factura(row) for row in conn.execute(consulta, parametros_pagina)]
+
+    siguiente = None
+    if len(facturas) > min(limite, LIMITE_MAXIMO):
+        facturas.pop()
+        siguiente = invoice_store.codificar_cursor(facturas[-1])
+    return {'facturas': facturas, 'total': total, 'facetas': facetas, 'siguiente_cursor': siguiente}
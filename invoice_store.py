@@ -0,0 +1,339 @@
+import base64
+import json
+import logging
+from datetime import datetime, timedelta
+import database
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Un rango solo se considera "cerrado" (y por lo tanto cacheable) cuando su fecha final
+# es más antigua que este margen: el SAT puede tardar hasta 72 horas en reflejar CFDIs nuevos
+DIAS_MARGEN_COBERTURA = 3
+
+FORMATO_FECHA = '%Y-%m-%dT%H:%M:%S'
+
+# Facturas que se acumulan antes de escribirlas en una sola transacción
+TAMANO_LOTE = 500
+
+# Facturas parseadas de los paquetes del SAT.
+# Un mismo UUID puede aparecer como emitida para un RFC y recibida para otro,
+# por eso la llave incluye el RFC dueño de la consulta y el tipo.
+# id es explícito porque el índice FTS5 (invoice_search.py) apunta a él: el rowid implícito
+# de una tabla sin INTEGER PRIMARY KEY puede cambiar con VACUUM.
+# estado_comprobante es el filtro con el que se descargó (clave_estado): el XML no trae la
+# cancelación, así que es lo único que distingue lo descargado como vigente de lo cancelado
+_ESQUEMA_FACTURAS = '''
+    CREATE TABLE IF NOT EXISTS {tabla} (
+        id INTEGER PRIMARY KEY,
+        uuid TEXT NOT NULL,
+        rfc TEXT NOT NULL,
+        tipo TEXT NOT NULL,
+        fecha TEXT NOT NULL,
+        serie TEXT,
+        folio TEXT,
+        rfc_emisor TEXT,
+        nombre_emisor TEXT,
+        rfc_receptor TEXT,
+        nombre_receptor TEXT,
+        subtotal REAL,
+        total REAL,
+        moneda TEXT,
+        tipo_comprobante TEXT,
+        estado TEXT,
+        fecha_cancelacion TEXT,
+        estado_comprobante TEXT,
+        fecha_actualizacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE (uuid, rfc, tipo)
+    )
+'''
+
+def _migrar_id(conn):
+    """Bases creadas cuando la llave era solo (uuid, rfc, tipo): se copia la tabla con la columna id"""
+    def columnas_sin_id():
+        columnas = [fila[1] for fila in conn.execute('PRAGMA table_info(facturas)')]
+        return columnas if columnas and 'id' not in columnas else None
+
+    if not columnas_sin_id():
+        return
+    # Si varios workers arrancan a la vez, solo el primero copia
+    with database.cambio_de_esquema(conn):
+        columnas = columnas_sin_id()
+        if columnas:
+            logger.info("Migrando facturas a llave id explícita...")
+            columnas = ', '.join(columnas)
+            conn.execute('DROP TABLE IF EXISTS facturas_migracion')
+            conn.execute(_ESQUEMA_FACTURAS.format(tabla='facturas_migracion'))
+            conn.execute(f'INSERT INTO facturas_migracion ({columnas}) SELECT {columnas} FROM facturas ORDER BY rowid')
+            # Con la tabla se van sus índices y los triggers del FTS; init_db los vuelve a crear
+            conn.execute('DROP TABLE facturas')
+            conn.execute('ALTER TABLE facturas_migracion RENAME TO facturas')
+
+def _migrar_filtro(conn):
+    """
+    Bases anteriores no guardaban con qué filtro se descargó cada factura. En recibidas no se
+    filtra ('todos'); en emitidas no se puede saber, así que se olvida su cobertura y esos rangos
+    se vuelven a descargar una vez (el upsert les asigna el filtro)
+    """
+    def sin_filtro():
+        columnas = [fila[1] for fila in conn.execute('PRAGMA table_info(facturas)')]
+        return columnas and 'estado_comprobante' not in columnas
+
+    if not sin_filtro():
+        return
+    with database.cambio_de_esquema(conn):
+        if not sin_filtro():
+            return
+        logger.info("Agregando a facturas el filtro de estado con el que se descargaron...")
+        conn.execute('ALTER TABLE facturas ADD COLUMN estado_comprobante TEXT')
+        conn.execute("UPDATE facturas SET estado_comprobante = 'todos' WHERE tipo = 'recibidas'")
+        conn.execute("DELETE FROM facturas_cobertura WHERE tipo = 'emitidas'")
+
+def init_db():
+    """Crea las tablas del almacén local de facturas"""
+    conn = database.obtener_conexion()
+    cursor = conn.cursor()
+
+    # Antes de _migrar_id: la tabla que crea ya trae la columna del filtro
+    _migrar_filtro(conn)
+    _migrar_id(conn)
+    cursor.execute(_ESQUEMA_FACTURAS.format(tabla='facturas'))
+    # (fecha, uuid) es el orden de las consultas y la llave de la paginación por cursor
+    cursor.execute('DROP INDEX IF EXISTS idx_facturas_rfc_tipo_fecha')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_facturas_rfc_tipo_fecha_uuid
+        ON facturas (rfc, tipo, fecha, uuid)
+    ''')
+
+    # Rangos de fechas que ya se descargaron completos del SAT
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS facturas_cobertura (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            rfc TEXT NOT NULL,
+            tipo TEXT NOT NULL,
+            estado_comprobante TEXT NOT NULL,
+            fecha_inicial TEXT NOT NULL,
+            fecha_final TEXT NOT NULL,
+            id_solicitud TEXT,
+            fecha_descarga TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_cobertura_rfc_tipo
+        ON facturas_cobertura (rfc, tipo, estado_comprobante, fecha_inicial)
+    ''')
+    conn.commit()
+    logger.info("Almacén de facturas inicializado")
+
+def clave_estado(tipo, estado_comprobante):
+    """Normaliza el filtro de estado tal como se envía al SAT"""
+    # Para emitidas siempre se envía un estado (1 por defecto); para recibidas no se filtra
+    if tipo == 'emitidas':
+        return str(estado_comprobante if estado_comprobante is not None else 1)
+    return 'todos'
+
+def _a_texto(fecha):
+    if isinstance(fecha, datetime):
+        return fecha.strftime(FORMATO_FECHA)
+    return fecha
+
+# Columnas de facturas en el orden que espera fila_a_factura()
+COLUMNAS_FACTURA = '''uuid, fecha, serie, folio, rfc_emisor, nombre_emisor, rfc_receptor,
+               nombre_receptor, subtotal, total, moneda, tipo_comprobante, estado, fecha_cancelacion'''
+
+def fila_a_factura(row):
+    return {
+        'uuid': row[0],
+        'fecha': row[1],
+        'serie': row[2],
+        'folio': row[3],
+        'rfcEmisor': row[4],
+        'nombreEmisor': row[5],
+        'rfcReceptor': row[6],
+        'nombreReceptor': row[7],
+        'subtotal': row[8],
+        'total': row[9],
+        'moneda': row[10],
+        'tipoComprobante': row[11],
+        'estado': row[12],
+        'fechaCancelacion': row[13]
+    }
+
+def guardar_facturas(rfc, tipo, facturas, estado_comprobante=None):
+    """
+    Inserta o actualiza (por UUID) las facturas parseadas de un paquete, junto con el filtro de
+    estado con el que se pidieron al SAT
+    """
+    try:
+        filtro = clave_estado(tipo, estado_comprobante)
+        filas = [
+            (
+                f['uuid'], rfc, tipo, f.get('fecha', ''), f.get('serie'), f.get('folio'),
+                f.get('rfcEmisor'), f.get('nombreEmisor'), f.get('rfcReceptor'), f.get('nombreReceptor'),
+                f.get('subtotal'), f.get('total'), f.get('moneda'), f.get('tipoComprobante'),
+                f.get('estado'), f.get('fechaCancelacion'), filtro
+            )
+            for f in facturas if f.get('uuid')
+        ]
+
+        with metrics.medir(metrics.ETAPA_SEGUNDOS, 'guardado'), database.obtener_conexion() as conn:
+            cursor = conn.cursor()
+            cursor.executemany('''
+                INSERT INTO facturas (
+                    uuid, rfc, tipo, fecha, serie, folio, rfc_emisor, nombre_emisor,
+                    rfc_receptor, nombre_receptor, subtotal, total, moneda, tipo_comprobante,
+                    estado, fecha_cancelacion, estado_comprobante
+                )
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(uuid, rfc, tipo) DO UPDATE SET
+                    fecha = excluded.fecha,
+                    serie = excluded.serie,
+                    folio = excluded.folio,
+                    rfc_emisor = excluded.rfc_emisor,
+                    nombre_emisor = excluded.nombre_emisor,
+                    rfc_receptor = excluded.rfc_receptor,
+                    nombre_receptor = excluded.nombre_receptor,
+                    subtotal = excluded.subtotal,
+                    total = excluded.total,
+                    moneda = excluded.moneda,
+                    tipo_comprobante = excluded.tipo_comprobante,
+                    estado = excluded.estado,
+                    fecha_cancelacion = excluded.fecha_cancelacion,
+                    estado_comprobante = excluded.estado_comprobante,
+                    fecha_actualizacion = CURRENT_TIMESTAMP
+            ''', filas)
+
+        return {'success': True, 'guardadas': len(filas)}
+    except Exception as e:
+        logger.error(f"Error al guardar facturas: {e}")
+        return {'success': False, 'message': str(e)}
+
+def guardar_en_lotes(rfc, tipo, facturas, estado_comprobante=None, tamano_lote=TAMANO_LOTE):
+    """
+    Reenvía una por una las facturas de un iterador y las va guardando por lotes,
+    para persistir un flujo de facturas sin tenerlo completo en memoria
+    """
+    lote = []
+    for factura in facturas:
+        lote.append(factura)
+        if len(lote) >= tamano_lote:
+            guardar_facturas(rfc, tipo, lote, estado_comprobante)
+            lote = []
+        yield factura
+    if lote:
+        guardar_facturas(rfc, tipo, lote, estado_comprobante)
+
+def en_rango(factura, fecha_inicial, fecha_final):
+    """Indica si la fecha de una factura cae dentro de [fecha_inicial, fecha_final]"""
+    return _a_texto(fecha_inicial) <= (factura.get('fecha') or '')[:19] <= _a_texto(fecha_final)
+
+def registrar_cobertura(rfc, tipo, estado_comprobante, fecha_inicial, fecha_final, id_solicitud=None):
+    """Marca un rango como descargado completo, solo si el período ya está cerrado"""
+    limite = datetime.now() - timedelta(days=DIAS_MARGEN_COBERTURA)
+    if fecha_final > limite:
+        logger.info(f"Rango abierto (termina después de {limite.date()}), no se marca como cubierto")
+        return False
+
+    try:
+        with database.obtener_conexion() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO facturas_cobertura (rfc, tipo, estado_comprobante, fecha_inicial, fecha_final, id_solicitud)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (rfc, tipo, clave_estado(tipo, estado_comprobante),
+                  _a_texto(fecha_inicial), _a_texto(fecha_final), id_solicitud))
+        return True
+    except Exception as e:
+        logger.error(f"Error al registrar cobertura: {e}")
+        return False
+
+def rango_cubierto(rfc, tipo, estado_comprobante, fecha_inicial, fecha_final):
+    """Indica si la unión de los rangos ya descargados cubre [fecha_inicial, fecha_final]"""
+    inicio = _a_texto(fecha_inicial)
+    fin = _a_texto(fecha_final)
+    try:
+        conn = database.obtener_conexion()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT fecha_inicial, fecha_final
+            FROM facturas_cobertura
+            WHERE rfc = ? AND tipo = ? AND estado_comprobante = ?
+              AND fecha_inicial <= ? AND fecha_final >= ?
+            ORDER BY fecha_inicial
+        ''', (rfc, tipo, clave_estado(tipo, estado_comprobante), fin, inicio))
+        rangos = cursor.fetchall()
+    except Exception as e:
+        logger.error(f"Error al consultar cobertura: {e}")
+        return False
+
+    # Barrido sobre los rangos ordenados: debe existir una cadena continua desde inicio hasta fin
+    alcanzado = inicio
+    for rango_ini, rango_fin in rangos:
+        if rango_ini > alcanzado:
+            return False
+        if rango_fin > alcanzado:
+            alcanzado = rango_fin
+        if alcanzado >= fin:
+            return True
+    return alcanzado >= fin
+
+def obtener_facturas(rfc, tipo, fecha_inicial, fecha_final, estado=None, filtro=None):
+    """Consulta las facturas almacenadas de un RFC en un rango de fechas"""
+    return list(iterar_facturas(rfc, tipo, fecha_inicial, fecha_final, estado, filtro=filtro))
+
+def iterar_facturas(rfc, tipo, fecha_inicial, fecha_final, estado=None, despues_de=None, limite=None, filtro=None):
+    """
+    Recorre las facturas almacenadas en orden (fecha, uuid) sin cargarlas todas en memoria.
+    despues_de es un (fecha, uuid) de la última factura ya entregada (paginación por cursor).
+    filtro (clave_estado) limita a lo descargado con ese filtro de estado del SAT.
+    """
+    consulta = f'''
+        SELECT {COLUMNAS_FACTURA}
+        FROM facturas
+        WHERE rfc = ? AND tipo = ? AND fecha >= ? AND fecha <= ?
+    '''
+    parametros = [rfc, tipo, _a_texto(fecha_inicial), _a_texto(fecha_final)]
+    if estado:
+        consulta += ' AND estado = ?'
+        parametros.append(estado)
+    if filtro:
+        consulta += ' AND estado_comprobante = ?'
+        parametros.append(filtro)
+    if despues_de:
+        consulta += ' AND (fecha, uuid) > (?, ?)'
+        parametros.extend(despues_de)
+    consulta += ' ORDER BY fecha, uuid'
+    if limite:
+        consulta += ' LIMIT ?'
+        parametros.append(limite)
+
+    cursor = database.obtener_conexion().cursor()
+    cursor.execute(consulta, parametros)
+    for row in cursor:
+        yield fila_a_factura(row)
+
+def contar_facturas(rfc, tipo, fecha_inicial, fecha_final, filtro=None):
+    """Número de facturas almacenadas del rango por estado ({'Vigente': n, 'Cancelado': m})"""
+    consulta = '''
+        SELECT estado, COUNT(*) FROM facturas
+        WHERE rfc = ? AND tipo = ? AND fecha >= ? AND fecha <= ?
+    '''
+    parametros = [rfc, tipo, _a_texto(fecha_inicial), _a_texto(fecha_final)]
+    if filtro:
+        consulta += ' AND estado_comprobante = ?'
+        parametros.append(filtro)
+    cursor = database.obtener_conexion().cursor()
+    cursor.execute(consulta + ' GROUP BY estado', parametros)
+    return dict(cursor.fetchall())
+
+def codificar_cursor(factura):
+    """Cursor opaco para continuar después de esta factura"""
+    return base64.urlsafe_b64encode(json.dumps([factura['fecha'], factura['uuid']]).encode()).decode()
+
+def decodificar_cursor(cursor):
+    """(fecha, uuid) de un cursor de codificar_cursor(); ValueError si no es válido"""
+    try:
+        fecha, uuid = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return str(fecha), str(uuid)
+    except Exception:
+        raise ValueError('Cursor de paginación inválido')
@@ -0,0 +1,281 @@
+import logging
+import os
+import socket
+import sqlite3
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import threading
+import database
+import invoice_store
+import query_planner
+
+logger = logging.getLogger(__name__)
+
+# Configuración del procesamiento en segundo plano
+MAX_JOBS_CONCURRENTES = int(os.environ.get('SAT_JOBS_WORKERS', 4))
+INTERVALO_VERIFICACION = int(os.environ.get('SAT_JOBS_INTERVALO', 20))  # segundos
+INTERVALO_VERIFICACION_MAXIMO = int(os.environ.get('SAT_JOBS_INTERVALO_MAX', 120))
+TIEMPO_MAXIMO_JOB = int(os.environ.get('SAT_JOBS_TIEMPO_MAX', 2 * 60 * 60))
+
+# Estados de un job
+PENDIENTE = 'pendiente'
+PROCESANDO = 'procesando'
+COMPLETADO = 'completado'
+PARCIAL = 'parcial'  # Algunas ventanas del plan fallaron; las demás sí están en el almacén
+ERROR = 'error'
+
+# Estados de la solicitud en el SAT (EstadoSolicitud)
+# 1 = Aceptada, 2 = En proceso, 3 = Terminada, 4 = Error, 5 = Rechazada, 6 = Vencida
+ESTADOS_SAT_EN_CURSO = ('1', '2')
+ESTADO_SAT_TERMINADA = '3'
+ESTADOS_EN_CURSO = (PENDIENTE, PROCESANDO)
+
+# Los jobs viven en el executor de un proceso: si ese proceso termina (reinicio, worker reciclado)
+# nadie los retoma. 'proceso' identifica al dueño para detectar los que quedaron huérfanos
+def _proceso():
+    # Se calcula en cada llamada: con --preload los workers se crean con fork después de importar
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+MENSAJE_HUERFANO = 'El servidor se reinició antes de terminar la descarga; vuelve a consultar el rango'
+
+_executor = ThreadPoolExecutor(max_workers=MAX_JOBS_CONCURRENTES, thread_name_prefix='sat-job')
+
+def init_db():
+    """Crea la tabla de jobs de descarga"""
+    conn = database.obtener_conexion()
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS descarga_jobs (
+            id TEXT PRIMARY KEY,
+            usuario_id INTEGER,
+            rfc TEXT NOT NULL,
+            tipo TEXT NOT NULL,
+            fecha_inicial TEXT NOT NULL,
+            fecha_final TEXT NOT NULL,
+            estado_comprobante INTEGER,
+            estado TEXT NOT NULL,
+            id_solicitud TEXT,
+            cod_estatus TEXT,
+            mensaje TEXT,
+            paquetes INTEGER DEFAULT 0,
+            total_facturas INTEGER DEFAULT 0,
+            ventanas_total INTEGER DEFAULT 0,
+            ventanas_completadas INTEGER DEFAULT 0,
+            proceso TEXT,
+            fecha_creacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            fecha_actualizacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.commit()
+    # Columnas agregadas después de la primera versión de la tabla; se revisan dentro de la
+    # transacción para que dos workers que arrancan juntos no agreguen la misma columna
+    with database.cambio_de_esquema(conn):
+        columnas = {row[1] for row in cursor.execute('PRAGMA table_info(descarga_jobs)')}
+        for columna in ('ventanas_total', 'ventanas_completadas'):
+            if columna not in columnas:
+                cursor.execute(f'ALTER TABLE descarga_jobs ADD COLUMN {columna} INTEGER DEFAULT 0')
+        if 'proceso' not in columnas:
+            cursor.execute('ALTER TABLE descarga_jobs ADD COLUMN proceso TEXT')
+    _cerrar_huerfanos()
+    logger.info("Tabla de jobs de descarga inicializada")
+
+def _proceso_vivo(proceso):
+    """
+    Si el proceso dueño de un job sigue corriendo. Solo se puede saber en el mismo host;
+    un job sin dueño registrado viene de una versión anterior y ya no tiene quién lo ejecute
+    """
+    if not proceso:
+        return False
+    host, _, pid = proceso.rpartition(':')
+    if host != socket.gethostname():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, ValueError):
+        return True
+    return True
+
+def _cerrar_huerfanos():
+    """Marca como error los jobs en curso cuyo proceso ya no existe (los clientes dejan de esperar)"""
+    filas = database.obtener_conexion().execute(
+        f"SELECT id, proceso FROM descarga_jobs WHERE estado IN ({', '.join('?' * len(ESTADOS_EN_CURSO))})",
+        ESTADOS_EN_CURSO
+    ).fetchall()
+    huerfanos = [job_id for job_id, proceso in filas if proceso != _proceso() and not _proceso_vivo(proceso)]
+    for job_id in huerfanos:
+        _marcar_huerfano(job_id)
+    if huerfanos:
+        logger.warning(f"{len(huerfanos)} jobs de descarga sin proceso marcados como error")
+
+def _marcar_huerfano(job_id):
+    # Solo si sigue en curso: el dueño pudo terminarlo mientras tanto
+    with database.obtener_conexion() as conn:
+        conn.execute(f'''
+            UPDATE descarga_jobs SET estado = ?, mensaje = ?, fecha_actualizacion = CURRENT_TIMESTAMP
+            WHERE id = ? AND estado IN ({', '.join('?' * len(ESTADOS_EN_CURSO))})
+        ''', (ERROR, MENSAJE_HUERFANO, job_id, *ESTADOS_EN_CURSO))
+
+def _actualizar_job(job_id, **campos):
+    asignaciones = ', '.join(f'{campo} = ?' for campo in campos)
+    with database.obtener_conexion() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            f'UPDATE descarga_jobs SET {asignaciones}, fecha_actualizacion = CURRENT_TIMESTAMP WHERE id = ?',
+            (*campos.values(), job_id)
+        )
+
+def crear_job(client, tipo, fecha_inicial, fecha_final, estado_comprobante=None, usuario_id=None):
+    """Registra un job de descarga y lo encola en el executor; regresa su id"""
+    job_id = uuid.uuid4().hex
+    with database.obtener_conexion() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO descarga_jobs (id, usuario_id, rfc, tipo, fecha_inicial, fecha_final, estado_comprobante, estado, proceso)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (job_id, usuario_id, client.rfc, tipo,
+              fecha_inicial.strftime(invoice_store.FORMATO_FECHA),
+              fecha_final.strftime(invoice_store.FORMATO_FECHA),
+              estado_comprobante, PENDIENTE, _proceso()))
+
+    _executor.submit(_ejecutar_job, job_id, client, tipo, fecha_inicial, fecha_final, estado_comprobante)
+    logger.info(f"Job {job_id} encolado para RFC {client.rfc}")
+    return job_id
+
+def obtener_job(job_id):
+    """Obtiene el estado de un job, o None si no existe"""
+    # row_factory en el cursor: la conexión del hilo la comparten otras consultas
+    cursor = database.obtener_conexion().cursor()
+    cursor.row_factory = sqlite3.Row
+    cursor.execute('SELECT * FROM descarga_jobs WHERE id = ?', (job_id,))
+    row = cursor.fetchone()
+    if not row:
+        return None
+    job = dict(row)
+    # Un worker reciclado deja sus jobs en curso; se detecta al consultarlos sin esperar a otro arranque
+    # El dueño es interno (host y pid): no se regresa al cliente
+    proceso = job.pop('proceso')
+    if job['estado'] in ESTADOS_EN_CURSO and proceso != _proceso() and not _proceso_vivo(proceso):
+        _marcar_huerfano(job_id)
+        job.update(estado=ERROR, mensaje=MENSAJE_HUERFANO)
+    return job
+
+def _ejecutar_job(job_id, client, tipo, fecha_inicial, fecha_final, estado_comprobante):
+    """Ejecuta el rango como un plan de ventanas (por mes, subdividiendo las que el SAT rechaza con 301)"""
+    try:
+        _actualizar_job(job_id, estado=PROCESANDO)
+        progreso = {'paquetes': 0, 'uuids': set(), 'lock': threading.Lock()}
+
+        def procesar(inicio, fin):
+            return _procesar_ventana(job_id, client, tipo, inicio, fin, estado_comprobante, progreso)
+
+        def al_avanzar(resumen):
+            _actualizar_job(
+                job_id,
+                ventanas_total=resumen['ventanas_total'],
+                ventanas_completadas=resumen['ventanas_completadas']
+            )
+
+        resumen = query_planner.ejecutar_plan(fecha_inicial, fecha_final, procesar, al_avanzar=al_avanzar)
+
+        ids_solicitud = [r['id_solicitud'] for r in resumen['resultados'] if r.get('id_solicitud')]
+        campos = {
+            'id_solicitud': ','.join(ids_solicitud) or None,
+            'ventanas_total': resumen['ventanas_total'],
+            'ventanas_completadas': resumen['ventanas_completadas'],
+            'paquetes': progreso['paquetes'],
+            'total_facturas': len(progreso['uuids'])
+        }
+        if len(resumen['resultados']) == 1:
+            campos['cod_estatus'] = resumen['resultados'][0].get('cod_estatus')
+
+        if not resumen['fallidas']:
+            _actualizar_job(job_id, estado=COMPLETADO, **campos)
+        else:
+            mensajes = '; '.join(
+                f"{f['fecha_inicial'].date()} - {f['fecha_final'].date()}: {f.get('mensaje') or f.get('cod_estatus')}"
+                for f in resumen['fallidas']
+            )
+            estado = PARCIAL if resumen['ventanas_completadas'] else ERROR
+            _actualizar_job(job_id, estado=estado, mensaje=mensajes, **campos)
+        logger.info(f"Job {job_id} terminado: {len(progreso['uuids'])} facturas, "
+                    f"{resumen['ventanas_completadas']}/{resumen['ventanas_total']} ventanas, "
+                    f"{resumen['solicitudes']} solicitudes")
+
+    except Exception as e:
+        logger.exception(f"Error en job {job_id}: {e}")
+        _actualizar_job(job_id, estado=ERROR, mensaje=str(e))
+
+def _procesar_ventana(job_id, client, tipo, fecha_inicial, fecha_final, estado_comprobante, progreso):
+    """solicitar → verificar (con reintentos) → descargar → parsear → guardar, para una ventana"""
+    solicitud = client.solicitar_descarga(
+        fecha_inicial,
+        fecha_final,
+        tipo_solicitud=tipo,
+        estado_comprobante=estado_comprobante
+    )
+    if not solicitud:
+        return {'estado': ERROR, 'cod_estatus': None, 'mensaje': 'Error al solicitar descarga'}
+
+    cod_estatus = solicitud.get('cod_estatus', '')
+    id_solicitud = solicitud.get('id_solicitud')
+    resultado = {'cod_estatus': cod_estatus, 'id_solicitud': id_solicitud, 'mensaje': solicitud.get('mensaje')}
+
+    if cod_estatus == '5004':
+        invoice_store.registrar_cobertura(client.rfc, tipo, estado_comprobante, fecha_inicial, fecha_final)
+        return {**resultado, 'estado': COMPLETADO}
+    # 305 (duplicada) puede traer el id de la solicitud previa; en ese caso se continúa con él
+    if cod_estatus not in ('5000', '305') or not id_solicitud:
+        return {**resultado, 'estado': ERROR}
+
+    verificacion = _esperar_solicitud(client, id_solicitud)
+    if not verificacion or verificacion.get('estado_solicitud') != ESTADO_SAT_TERMINADA:
+        mensaje = verificacion.get('mensaje') if verificacion else 'Sin respuesta al verificar'
+        return {**resultado, 'estado': ERROR, 'mensaje': mensaje or 'La solicitud no terminó en el SAT'}
+
+    paquetes_ids = verificacion.get('paquetes') or []
+    estadisticas = {'paquetes': 0, 'facturas': 0}
+    facturas_iter = client.iterar_facturas(id_solicitud, paquetes_ids, estadisticas)
+    paquetes_contados = 0
+    for factura in invoice_store.guardar_en_lotes(client.rfc, tipo, facturas_iter, estado_comprobante):
+        with progreso['lock']:
+            # Las ventanas vecinas comparten el instante de frontera: cada UUID se cuenta una vez.
+            # Una solicitud reutilizada puede cubrir más que la ventana; solo se cuenta lo del rango
+            if invoice_store.en_rango(factura, fecha_inicial, fecha_final):
+                progreso['uuids'].add(factura.get('uuid'))
+            if estadisticas['paquetes'] != paquetes_contados:
+                progreso['paquetes'] += estadisticas['paquetes'] - paquetes_contados
+                paquetes_contados = estadisticas['paquetes']
+                _actualizar_job(job_id, paquetes=progreso['paquetes'], total_facturas=len(progreso['uuids']))
+    with progreso['lock']:
+        progreso['paquetes'] += estadisticas['paquetes'] - paquetes_contados
+
+    if estadisticas['paquetes'] != len(paquetes_ids):
+        return {**resultado, 'estado': ERROR,
+                'mensaje': f"Se descargaron {estadisticas['paquetes']} de {len(paquetes_ids)} paquetes"}
+
+    invoice_store.registrar_cobertura(client.rfc, tipo, estado_comprobante, fecha_inicial, fecha_final, id_solicitud)
+    return {**resultado, 'estado': COMPLETADO}
+
+def _esperar_solicitud(client, id_solicitud):
+    """Verifica periódicamente hasta que el SAT termine la solicitud o se agote el tiempo"""
+    inicio = time.monotonic()
+    intervalo = INTERVALO_VERIFICACION
+    while True:
+        verificacion = client.verificar_solicitud(id_solicitud)
+        if verificacion and verificacion.get('estado_solicitud') not in ESTADOS_SAT_EN_CURSO:
+            return verificacion
+        if time.monotonic() - inicio + intervalo > TIEMPO_MAXIMO_JOB:
+            return verificacion
+        time.sleep(intervalo)
+        intervalo = min(intervalo * 1.5, INTERVALO_VERIFICACION_MAXIMO)
+
+def rango_de_job(job):
+    """(fecha_inicial, fecha_final) de un job como datetime, para consultar sus facturas en el almacén"""
+    return (
+        datetime.strptime(job['fecha_inicial'], invoice_store.FORMATO_FECHA),
+        datetime.strptime(job['fecha_final'], invoice_store.FORMATO_FECHA)
+    )
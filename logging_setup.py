@@ -0,0 +1,144 @@
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import sys
+from datetime import datetime, timezone
+
+# Nivel mínimo que se registra (DEBUG, INFO, WARNING, ERROR)
+NIVEL_LOG = os.environ.get('LOG_LEVEL', 'INFO').upper()
+# 'json' (una línea JSON por evento) o 'texto' (legible para desarrollo)
+FORMATO_LOG = os.environ.get('LOG_FORMATO', 'json')
+# Nivel de las librerías (cfdiclient registra en DEBUG los sobres SOAP con el token del SAT)
+NIVEL_LOG_TERCEROS = os.environ.get('LOG_NIVEL_TERCEROS', 'WARNING').upper()
+LOGGERS_TERCEROS = ('cfdiclient', 'urllib3', 'requests')
+# Fracción de requests cuyo detalle (headers, cookies, sesión) se registra en DEBUG
+MUESTREO_DEBUG = float(os.environ.get('LOG_MUESTREO_DEBUG', 0.01))
+
+# Llaves cuyo valor nunca se escribe en el log
+_LLAVES_SENSIBLES = re.compile(r'pass|token|cookie|secret|llave|key|authorization|session', re.IGNORECASE)
+REDACTADO = '***'
+# Tokens dentro del texto del mensaje (encabezado WRAP/Bearer del SAT, resultado de Autentica)
+_TOKENS_EN_TEXTO = re.compile(
+    r'(access_token=\\?"?|Bearer\s+|<(?:\w+:)?AutenticaResult>)[^"\'<\s,}]+',
+    re.IGNORECASE
+)
+
+_listener = None
+_manejador = None
+
+def redactar_texto(texto):
+    """Texto con los tokens de autenticación reemplazados"""
+    return _TOKENS_EN_TEXTO.sub(lambda m: m.group(1) + REDACTADO, texto)
+
+def redactar(valor):
+    """Copia de un dict/lista con los valores de llaves sensibles reemplazados"""
+    if isinstance(valor, dict):
+        return {
+            llave: REDACTADO if _LLAVES_SENSIBLES.search(str(llave)) else redactar(contenido)
+            for llave, contenido in valor.items()
+        }
+    if isinstance(valor, (list, tuple)):
+        return [redactar(elemento) for elemento in valor]
+    return valor
+
+class FormatoJson(logging.Formatter):
+    """Una línea JSON por evento; los datos estructurados van en 'datos' ya redactados"""
+
+    def format(self, record):
+        entrada = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'nivel': record.levelname,
+            'logger': record.name,
+            'mensaje': record.getMessage(),
+            'hilo': record.threadName
+        }
+        datos = getattr(record, 'datos', None)
+        if datos:
+            entrada['datos'] = redactar(datos)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entrada['excepcion'] = record.exc_text
+        return json.dumps(entrada, ensure_ascii=False, default=str)
+
+class FormatoTexto(logging.Formatter):
+    """Formato legible para desarrollo, con los datos estructurados al final"""
+
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    def format(self, record):
+        linea = super().format(record)
+        datos = getattr(record, 'datos', None)
+        return f'{linea} {json.dumps(redactar(datos), ensure_ascii=False, default=str)}' if datos else linea
+
+class _ManejadorCola(logging.handlers.QueueHandler):
+    """
+    Encola el evento sin formatearlo: en el hilo que registra solo se resuelven el mensaje
+    y la excepción; el JSON y la escritura a stdout ocurren en el hilo del listener
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = redactar_texto(record.getMessage())
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+def configurar_logging(nivel=None, formato=None):
+    """Envía todos los loggers a una cola que un hilo aparte escribe a stdout; idempotente"""
+    global _listener, _manejador
+    if _listener is not None:
+        return
+
+    salida = logging.StreamHandler(sys.stdout)
+    salida.setFormatter(FormatoJson() if (formato or FORMATO_LOG) == 'json' else FormatoTexto())
+
+    cola = queue.SimpleQueue()
+    raiz = logging.getLogger()
+    raiz.setLevel(nivel or NIVEL_LOG)
+    _manejador = _ManejadorCola(cola)
+    raiz.addHandler(_manejador)
+    # El nivel de la raíz también aplicaría a las librerías: se fijan aparte para que LOG_LEVEL=DEBUG
+    # no vuelque sus peticiones completas (además el mensaje se redacta al encolarlo)
+    for nombre in LOGGERS_TERCEROS:
+        logging.getLogger(nombre).setLevel(NIVEL_LOG_TERCEROS)
+
+    _listener = logging.handlers.QueueListener(cola, salida, respect_handler_level=True)
+    _listener.start()
+    atexit.register(detener_logging)
+    # Con --preload los workers son forks del master ya configurado: el hijo no hereda el hilo
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=_reiniciar_en_hijo)
+
+def _reiniciar_en_hijo():
+    """
+    Tras un fork el hilo del listener solo existe en el padre: sin esto la cola del hijo crece sin
+    que nadie la escriba. Cola nueva (lo pendiente del padre lo escribe el padre) y listener propio
+    """
+    global _listener
+    if _listener is None:
+        return
+    cola = queue.SimpleQueue()
+    _manejador.queue = cola
+    _listener = logging.handlers.QueueListener(cola, *_listener.handlers, respect_handler_level=True)
+    _listener.start()
+
+def detener_logging():
+    """Vacía la cola y detiene el hilo del listener"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+def muestrear(logger):
+    """True para una fracción MUESTREO_DEBUG de las llamadas, solo si el logger tiene DEBUG activo"""
+    return logger.isEnabledFor(logging.DEBUG) and random.random() < MUESTREO_DEBUG
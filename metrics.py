@@ -0,0 +1,297 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from contextlib import contextmanager
+import database
+
+logger = logging.getLogger(__name__)
+
+# Métricas en formato de texto de Prometheus para /metrics.
+# Cada worker lleva las suyas en memoria y publica una copia en SQLite cada METRICAS_INTERVALO
+# segundos; /metrics suma las de todos los workers vivos del host (las que no se han publicado
+# en METRICAS_VIGENCIA segundos se descartan, como un reinicio de los contadores)
+METRICAS_INTERVALO = float(os.environ.get('METRICAS_INTERVALO', 15))
+METRICAS_VIGENCIA = float(os.environ.get('METRICAS_VIGENCIA', 120))
+# Si se define, /metrics exige 'Authorization: Bearer <token>'
+METRICAS_TOKEN = os.environ.get('METRICAS_TOKEN')
+
+# Cubetas (segundos y bytes) pensadas para el SAT: de milisegundos a varios minutos por llamada
+CUBETAS_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+CUBETAS_BYTES = tuple(1024 * 2 ** i for i in range(0, 19, 2))  # 1 KB … 256 MB
+
+_metricas = {}  # nombre -> métrica, en orden de registro
+_recolectores = []
+_lock = threading.Lock()
+# Identifica al worker en la tabla (el pid solo se puede repetir tras un reinicio)
+_worker = None
+_publicador_pid = None
+_pid_valores = os.getpid()  # proceso al que pertenecen los valores en memoria
+
+class _Metrica:
+    tipo = None
+
+    def __init__(self, nombre, ayuda, etiquetas=()):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = tuple(etiquetas)
+        self.valores = {}  # tupla de valores de etiquetas -> valor
+        _metricas[nombre] = self
+
+    def _clave(self, etiquetas):
+        if len(etiquetas) != len(self.etiquetas):
+            raise ValueError(f'{self.nombre} espera las etiquetas {self.etiquetas}')
+        return tuple(str(e) for e in etiquetas)
+
+    def fijar(self, valor, *etiquetas):
+        """Reemplaza el valor (para lo que ya cuenta otro módulo, leído por un recolector)"""
+        with _lock:
+            self.valores[self._clave(etiquetas)] = valor
+
+    def _sumar(self, valor, etiquetas):
+        clave = self._clave(etiquetas)
+        with _lock:
+            self.valores[clave] = self.valores.get(clave, 0) + valor
+
+    def _combinar(self, actual, otro):
+        return (actual or 0) + otro
+
+    def _lineas(self, valores):
+        for clave, valor in sorted(valores.items()):
+            yield f'{self.nombre}{_etiquetas(self.etiquetas, clave)} {_numero(valor)}'
+
+class Contador(_Metrica):
+    tipo = 'counter'
+
+    def incrementar(self, *etiquetas, valor=1):
+        self._sumar(valor, etiquetas)
+
+class Indicador(_Metrica):
+    tipo = 'gauge'
+
+    def sumar(self, valor, *etiquetas):
+        self._sumar(valor, etiquetas)
+
+class Histograma(_Metrica):
+    tipo = 'histogram'
+
+    def __init__(self, nombre, ayuda, etiquetas=(), cubetas=CUBETAS_SEGUNDOS):
+        super().__init__(nombre, ayuda, etiquetas)
+        self.cubetas = tuple(cubetas)
+
+    def observar(self, valor, *etiquetas):
+        # Se guarda el conteo de cada cubeta (no acumulado), más la suma y el total al final
+        clave = self._clave(etiquetas)
+        with _lock:
+            conteos = self.valores.get(clave)
+            if conteos is None:
+                conteos = self.valores[clave] = [0] * (len(self.cubetas) + 1) + [0.0]
+            conteos[bisect_left(self.cubetas, valor)] += 1
+            conteos[-1] += valor
+
+    def _combinar(self, actual, otro):
+        return [a + b for a, b in zip(actual, otro)] if actual else list(otro)
+
+    def _lineas(self, valores):
+        for clave, conteos in sorted(valores.items()):
+            acumulado = 0
+            for limite, conteo in zip(self.cubetas + ('+Inf',), conteos):
+                acumulado += conteo
+                yield (f'{self.nombre}_bucket'
+                       f'{_etiquetas(self.etiquetas + ("le",), clave + (_numero(limite),))} {acumulado}')
+            yield f'{self.nombre}_sum{_etiquetas(self.etiquetas, clave)} {_numero(conteos[-1])}'
+            yield f'{self.nombre}_count{_etiquetas(self.etiquetas, clave)} {acumulado}'
+
+def _numero(valor):
+    if isinstance(valor, str):
+        return valor
+    return str(int(valor)) if float(valor).is_integer() else repr(float(valor))
+
+def _etiquetas(nombres, valores):
+    if not nombres:
+        return ''
+    escapados = (v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in valores)
+    return '{' + ','.join(f'{n}="{v}"' for n, v in zip(nombres, escapados)) + '}'
+
+@contextmanager
+def medir(histograma, *etiquetas):
+    """Observa en el histograma los segundos que tarda el bloque"""
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        histograma.observar(time.perf_counter() - inicio, *etiquetas)
+
+def medir_iterador(iterable, histograma, *etiquetas):
+    """
+    Reenvía los elementos de un iterador y observa al final solo el tiempo que pasó dentro de
+    él (no el de quien lo consume, p. ej. guardar en SQLite o enviar la respuesta)
+    """
+    iterador = iter(iterable)
+    segundos = 0.0
+    try:
+        while True:
+            inicio = time.perf_counter()
+            try:
+                elemento = next(iterador)
+            except StopIteration:
+                segundos += time.perf_counter() - inicio
+                return
+            segundos += time.perf_counter() - inicio
+            yield elemento
+    finally:
+        histograma.observar(segundos, *etiquetas)
+
+# --- Métricas de la aplicación ---
+
+SAT_SEGUNDOS = Histograma(
+    'sat_operacion_segundos', 'Duración de cada llamada a los servicios web del SAT', ('operacion', 'cod_estatus')
+)
+SAT_RESPUESTAS = Contador(
+    'sat_respuestas_total', 'Respuestas del SAT por operación y CodEstatus (error = excepción)', ('operacion', 'cod_estatus')
+)
+SAT_VERIFICACIONES = Contador(
+    'sat_verificaciones_total', 'Verificaciones por EstadoSolicitud (1 aceptada … 3 terminada, 5 rechazada)', ('estado_solicitud',)
+)
+SAT_EN_CURSO = Indicador('sat_llamadas_en_curso', 'Llamadas al SAT esperando respuesta', ('operacion',))
+PAQUETE_BYTES = Histograma('sat_paquete_bytes', 'Tamaño de cada paquete ZIP descargado', cubetas=CUBETAS_BYTES)
+ETAPA_SEGUNDOS = Histograma(
+    'procesamiento_segundos', 'Tiempo propio por etapa: base64 y parseo por paquete, guardado por lote', ('etapa',)
+)
+FACTURAS_PARSEADAS = Contador('facturas_parseadas_total', 'Facturas extraídas de los paquetes')
+CONSULTAS = Contador(
+    'consultas_facturas_total', 'Consultas de facturas por origen de la respuesta (almacen = sin ir al SAT)', ('origen',)
+)
+CACHE = Contador('cache_total', 'Aciertos y fallos de los cachés en memoria', ('cache', 'resultado'))
+CLIENTES_SAT = Indicador('clientes_sat', 'Clientes del SAT (con FIEL descifrada) en memoria')
+HTTP_SEGUNDOS = Histograma(
+    'http_peticion_segundos', 'Duración de las peticiones a la API', ('endpoint', 'metodo', 'codigo')
+)
+HTTP_EN_CURSO = Indicador('http_peticiones_en_curso', 'Peticiones a la API en proceso')
+
+# Métodos de los servicios de cfdiclient que se miden
+OPERACIONES_SAT = ('obtener_token', 'solicitar_descarga', 'verificar_descarga', 'descargar_paquete')
+
+class _ServicioMedido:
+    """Envuelve un servicio de cfdiclient y mide cada llamada con el CodEstatus que regresó"""
+
+    def __init__(self, servicio):
+        self._servicio = servicio
+
+    def __getattr__(self, metodo):
+        original = getattr(self._servicio, metodo)
+        if metodo not in OPERACIONES_SAT:
+            return original
+
+        def medido(*args, **kwargs):
+            SAT_EN_CURSO.sumar(1, metodo)
+            inicio = time.perf_counter()
+            cod_estatus = 'error'
+            try:
+                resultado = original(*args, **kwargs)
+                if isinstance(resultado, dict):
+                    cod_estatus = resultado.get('cod_estatus') or 'sin_estatus'
+                    if metodo == 'verificar_descarga':
+                        SAT_VERIFICACIONES.incrementar(resultado.get('estado_solicitud') or 'sin_estado')
+                else:
+                    cod_estatus = 'ok' if resultado else 'sin_respuesta'
+                return resultado
+            finally:
+                SAT_EN_CURSO.sumar(-1, metodo)
+                SAT_SEGUNDOS.observar(time.perf_counter() - inicio, metodo, cod_estatus)
+                SAT_RESPUESTAS.incrementar(metodo, cod_estatus)
+        return medido
+
+def medir_servicio(servicio):
+    return _ServicioMedido(servicio)
+
+def agregar_recolector(funcion):
+    """Función que se llama antes de cada publicación para fijar valores que vienen de otro módulo"""
+    _recolectores.append(funcion)
+
+# --- Publicación entre workers ---
+
+def init_db():
+    """Crea la tabla donde cada worker publica sus métricas"""
+    conn = database.obtener_conexion()
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS metricas_workers (
+            worker TEXT PRIMARY KEY,
+            actualizado REAL NOT NULL,
+            datos TEXT NOT NULL
+        )
+    ''')
+    conn.commit()
+    logger.info("Tabla de métricas inicializada")
+
+def _copia():
+    for funcion in _recolectores:
+        try:
+            funcion()
+        except Exception as e:
+            logger.error(f"Error en recolector de métricas: {e}")
+    with _lock:
+        return {
+            nombre: [[list(clave), valor] for clave, valor in metrica.valores.items()]
+            for nombre, metrica in _metricas.items()
+        }
+
+def publicar():
+    """Escribe la copia de este worker en SQLite"""
+    try:
+        with database.obtener_conexion() as conn:
+            conn.execute('''
+                INSERT INTO metricas_workers (worker, actualizado, datos) VALUES (?, ?, ?)
+                ON CONFLICT(worker) DO UPDATE SET actualizado = excluded.actualizado, datos = excluded.datos
+            ''', (_worker, time.time(), json.dumps(_copia())))
+    except Exception as e:
+        logger.error(f"Error al publicar métricas: {e}")
+
+def _publicar_periodicamente():
+    while True:
+        time.sleep(METRICAS_INTERVALO)
+        publicar()
+
+def asegurar_publicador():
+    """Arranca el hilo de publicación en este proceso (tras un fork el del padre ya no existe)"""
+    global _publicador_pid, _worker, _pid_valores
+    if _publicador_pid == os.getpid():
+        return
+    with _lock:
+        if _publicador_pid == os.getpid():
+            return
+        _publicador_pid = os.getpid()
+        _worker = f'{os.getpid()}-{uuid.uuid4().hex[:8]}'
+        if _pid_valores != os.getpid():
+            # Un hijo empieza con lo que el padre llevaba al hacer fork: no es suyo
+            for metrica in _metricas.values():
+                metrica.valores.clear()
+            _pid_valores = os.getpid()
+    threading.Thread(target=_publicar_periodicamente, name='metricas', daemon=True).start()
+
+def exponer():
+    """Texto de exposición con la suma de las métricas de todos los workers vigentes"""
+    asegurar_publicador()
+    publicar()
+    combinadas = {nombre: {} for nombre in _metricas}
+    with database.obtener_conexion() as conn:
+        conn.execute('DELETE FROM metricas_workers WHERE actualizado < ?', (time.time() - METRICAS_VIGENCIA,))
+        filas = conn.execute('SELECT datos FROM metricas_workers').fetchall()
+    for (datos,) in filas:
+        for nombre, valores in json.loads(datos).items():
+            metrica = _metricas.get(nombre)
+            if metrica is None:
+                continue  # worker con otra versión del código
+            for clave, valor in valores:
+                clave = tuple(clave)
+                combinadas[nombre][clave] = metrica._combinar(combinadas[nombre].get(clave), valor)
+
+    lineas = []
+    for nombre, metrica in _metricas.items():
+        lineas.append(f'# HELP {nombre} {metrica.ayuda}')
+        lineas.append(f'# TYPE {nombre} {metrica.tipo}')
+        lineas.extend(metrica._lineas(combinadas[nombre]))
+    return '\n'.join(lineas) + '\n'
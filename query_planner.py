@@ -0,0 +1,103 @@
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+# Ventanas que se solicitan al SAT al mismo tiempo dentro de un mismo plan
+CONCURRENCIA_PLAN = int(os.environ.get('SAT_PLAN_CONCURRENCIA', 3))
+# Tope de solicitudes que un plan puede gastar (incluyendo las subdivisiones por 301)
+MAX_SOLICITUDES_PLAN = int(os.environ.get('SAT_PLAN_MAX_SOLICITUDES', 36))
+# Una ventana de este tamaño ya no se subdivide
+VENTANA_MINIMA = timedelta(days=1)
+
+COD_RECHAZO_RANGO = '301'
+
+def dividir_en_meses(fecha_inicial, fecha_final):
+    """Parte [fecha_inicial, fecha_final] en ventanas que no cruzan de un mes al siguiente"""
+    ventanas = []
+    inicio = fecha_inicial
+    while inicio < fecha_final:
+        siguiente_mes = (datetime(inicio.year + 1, 1, 1) if inicio.month == 12
+                         else datetime(inicio.year, inicio.month + 1, 1))
+        fin = min(siguiente_mes, fecha_final)
+        ventanas.append((inicio, fin))
+        inicio = fin
+    return ventanas
+
+def dividir_ventana(fecha_inicial, fecha_final):
+    """Parte una ventana a la mitad (en días completos); None si ya es la mínima"""
+    if fecha_final - fecha_inicial <= VENTANA_MINIMA:
+        return None
+    mitad = fecha_inicial + timedelta(days=max((fecha_final - fecha_inicial).days // 2, 1))
+    return [(fecha_inicial, mitad), (mitad, fecha_final)]
+
+def ejecutar_plan(fecha_inicial, fecha_final, procesar_ventana,
+                  concurrencia=CONCURRENCIA_PLAN, max_solicitudes=MAX_SOLICITUDES_PLAN, al_avanzar=None):
+    """
+    Ejecuta un rango como varias solicitudes al SAT, por mes y en paralelo.
+
+    procesar_ventana(inicio, fin) hace una solicitud completa y regresa un dict con al menos
+    'estado' ('completado' o 'error') y 'cod_estatus'. Si el SAT rechaza una ventana con 301,
+    se parte a la mitad y se vuelve a intentar cada mitad hasta llegar a VENTANA_MINIMA.
+    al_avanzar(resumen) se llama cada vez que termina una ventana.
+
+    Regresa un resumen con las ventanas completadas, las fallidas y las solicitudes usadas.
+    """
+    resumen = {
+        'ventanas_total': 0,
+        'ventanas_completadas': 0,
+        'solicitudes': 0,
+        'fallidas': [],
+        'resultados': []
+    }
+
+    pendientes = list(dividir_en_meses(fecha_inicial, fecha_final))
+    resumen['ventanas_total'] = len(pendientes)
+    logger.info(f"Plan de {len(pendientes)} ventanas para {fecha_inicial.date()} - {fecha_final.date()}")
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrencia), thread_name_prefix='sat-plan') as executor:
+        en_curso = {}
+        while pendientes or en_curso:
+            # Lanzar ventanas mientras haya lugar y no se rebase el tope de solicitudes
+            while pendientes and len(en_curso) < concurrencia:
+                ventana = pendientes.pop(0)
+                if resumen['solicitudes'] >= max_solicitudes:
+                    resumen['fallidas'].append({
+                        'fecha_inicial': ventana[0], 'fecha_final': ventana[1],
+                        'mensaje': f'Se alcanzó el tope de {max_solicitudes} solicitudes del plan'
+                    })
+                    continue
+                resumen['solicitudes'] += 1
+                en_curso[executor.submit(procesar_ventana, *ventana)] = ventana
+            if not en_curso:
+                break
+
+            terminados, _ = wait(en_curso, return_when=FIRST_COMPLETED)
+            for futuro in terminados:
+                inicio, fin = en_curso.pop(futuro)
+                try:
+                    resultado = futuro.result()
+                except Exception as e:
+                    resultado = {'estado': 'error', 'cod_estatus': None, 'mensaje': str(e)}
+
+                if resultado.get('cod_estatus') == COD_RECHAZO_RANGO:
+                    mitades = dividir_ventana(inicio, fin)
+                    if mitades:
+                        logger.info(f"301 en {inicio.date()} - {fin.date()}, dividiendo en 2 ventanas")
+                        pendientes[:0] = mitades
+                        resumen['ventanas_total'] += 1
+                        continue
+
+                resultado.update({'fecha_inicial': inicio, 'fecha_final': fin})
+                resumen['resultados'].append(resultado)
+                if resultado.get('estado') == 'completado':
+                    resumen['ventanas_completadas'] += 1
+                else:
+                    resumen['fallidas'].append(resultado)
+
+                if al_avanzar:
+                    al_avanzar(resumen)
+
+    return resumen
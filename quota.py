@@ -0,0 +1,159 @@
+import logging
+import os
+from datetime import datetime, timedelta
+import database
+
+logger = logging.getLogger(__name__)
+
+# Presupuesto de solicitudes al SAT por RFC (0 = sin límite). El SAT no publica los
+# límites exactos, así que se configuran por instalación según el tipo de cuenta
+LIMITE_DIARIO = int(os.environ.get('SAT_CUOTA_DIARIA', 50))
+LIMITE_TOTAL = int(os.environ.get('SAT_CUOTA_TOTAL', 0))
+# Solicitudes que se dejan sin usar para no llegar al límite real (que solo se conoce con el 5002)
+RESERVA = int(os.environ.get('SAT_CUOTA_RESERVA', 2))
+# Después de un 5002 no se vuelve a intentar en este número de horas
+HORAS_BLOQUEO_AGOTADA = int(os.environ.get('SAT_CUOTA_BLOQUEO', 24))
+
+# Código propio con el que SATClient rechaza una solicitud antes de enviarla al SAT
+COD_CUOTA_LOCAL = 'cuota_local'
+COD_SOLICITUDES_AGOTADAS = '5002'
+# Rechazos del SAT que no se cuentan como solicitud consumida (usuario o parámetros inválidos)
+CODIGOS_SIN_CONSUMO = ('300', '301')
+
+_FORMATO = '%Y-%m-%d %H:%M:%S'
+
+def init_db():
+    """Crea las tablas de la bitácora de solicitudes por RFC"""
+    conn = database.obtener_conexion()
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS cuota_solicitudes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            rfc TEXT NOT NULL,
+            tipo TEXT,
+            cod_estatus TEXT,
+            id_solicitud TEXT,
+            fecha TEXT NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_cuota_rfc_fecha
+        ON cuota_solicitudes (rfc, fecha)
+    ''')
+    # Último 5002 recibido por RFC
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS cuota_agotada (
+            rfc TEXT PRIMARY KEY,
+            fecha TEXT NOT NULL,
+            mensaje TEXT
+        )
+    ''')
+    conn.commit()
+    logger.info("Bitácora de cuota del SAT inicializada")
+
+def _estado_cuota(cursor, rfc, ahora):
+    """Calcula el uso y el presupuesto restante de un RFC dentro de una conexión abierta"""
+    inicio_dia = ahora.replace(hour=0, minute=0, second=0, microsecond=0)
+    cursor.execute('''
+        SELECT COUNT(*), COALESCE(SUM(fecha >= ?), 0)
+        FROM cuota_solicitudes WHERE rfc = ?
+    ''', (inicio_dia.strftime(_FORMATO), rfc))
+    usadas_total, usadas_hoy = cursor.fetchone()
+
+    cursor.execute('SELECT fecha, mensaje FROM cuota_agotada WHERE rfc = ?', (rfc,))
+    agotada = cursor.fetchone()
+    bloqueada_hasta = None
+    if agotada:
+        hasta = datetime.strptime(agotada[0], _FORMATO) + timedelta(hours=HORAS_BLOQUEO_AGOTADA)
+        if hasta > ahora:
+            bloqueada_hasta = hasta
+
+    restantes_hoy = max(LIMITE_DIARIO - usadas_hoy, 0) if LIMITE_DIARIO else None
+    restantes_total = max(LIMITE_TOTAL - usadas_total, 0) if LIMITE_TOTAL else None
+
+    # Cuándo se puede volver a intentar: fin del bloqueo por 5002 o el inicio del día siguiente
+    reintentar_en = None
+    if bloqueada_hasta:
+        reintentar_en = bloqueada_hasta
+    elif restantes_hoy is not None and restantes_hoy <= RESERVA:
+        reintentar_en = inicio_dia + timedelta(days=1)
+
+    return {
+        'rfc': rfc,
+        'usadas_hoy': usadas_hoy,
+        'limite_diario': LIMITE_DIARIO or None,
+        'restantes_hoy': restantes_hoy,
+        'usadas_total': usadas_total,
+        'limite_total': LIMITE_TOTAL or None,
+        'restantes_total': restantes_total,
+        'reserva': RESERVA,
+        'agotada_sat': bool(bloqueada_hasta),
+        'mensaje_sat': agotada[1] if bloqueada_hasta else None,
+        'reintentar_en': reintentar_en.strftime(_FORMATO) if reintentar_en else None
+    }
+
+def obtener_cuota(rfc):
+    """Regresa el uso de solicitudes y el presupuesto restante de un RFC"""
+    return _estado_cuota(database.obtener_conexion().cursor(), rfc, datetime.now())
+
+def reservar(rfc, tipo=None):
+    """
+    Admite una solicitud al SAT si el presupuesto del RFC lo permite.
+    La revisión y el registro van en una sola transacción para que dos hilos (o workers)
+    no gasten la misma solicitud restante. Regresa {'success', 'registro', 'cuota', 'message'}.
+    """
+    ahora = datetime.now()
+    conn = database.obtener_conexion()
+    cursor = conn.cursor()
+    try:
+        cursor.execute('BEGIN IMMEDIATE')
+        cuota = _estado_cuota(cursor, rfc, ahora)
+
+        motivo = None
+        if cuota['agotada_sat']:
+            motivo = 'El SAT indicó que se agotaron las solicitudes de este RFC'
+        elif cuota['restantes_total'] is not None and cuota['restantes_total'] <= RESERVA:
+            motivo = 'Se alcanzó el límite total de solicitudes configurado para este RFC'
+        elif cuota['restantes_hoy'] is not None and cuota['restantes_hoy'] <= RESERVA:
+            motivo = 'Se alcanzó el límite diario de solicitudes configurado para este RFC'
+
+        if motivo:
+            conn.rollback()
+            return {'success': False, 'registro': None, 'cuota': cuota, 'message': motivo}
+
+        cursor.execute('''
+            INSERT INTO cuota_solicitudes (rfc, tipo, fecha) VALUES (?, ?, ?)
+        ''', (rfc, tipo, ahora.strftime(_FORMATO)))
+        registro = cursor.lastrowid
+        conn.commit()
+        return {'success': True, 'registro': registro, 'cuota': cuota, 'message': None}
+    except Exception:
+        conn.rollback()
+        raise
+
+def confirmar(registro, rfc, solicitud):
+    """
+    Completa el registro de una solicitud reservada con la respuesta del SAT.
+    Los rechazos que no consumen solicitud se devuelven al presupuesto y un 5002 bloquea al RFC.
+    Si no hubo respuesta (error de red) el registro se conserva: el SAT pudo haberla contado.
+    """
+    if not registro or not solicitud:
+        return
+    cod_estatus = solicitud.get('cod_estatus')
+    try:
+        with database.obtener_conexion() as conn:
+            cursor = conn.cursor()
+            if cod_estatus in CODIGOS_SIN_CONSUMO:
+                cursor.execute('DELETE FROM cuota_solicitudes WHERE id = ?', (registro,))
+            else:
+                cursor.execute('''
+                    UPDATE cuota_solicitudes SET cod_estatus = ?, id_solicitud = ? WHERE id = ?
+                ''', (cod_estatus, solicitud.get('id_solicitud'), registro))
+            if cod_estatus == COD_SOLICITUDES_AGOTADAS:
+                cursor.execute('''
+                    INSERT INTO cuota_agotada (rfc, fecha, mensaje) VALUES (?, ?, ?)
+                    ON CONFLICT(rfc) DO UPDATE SET fecha = excluded.fecha, mensaje = excluded.mensaje
+                ''', (rfc, datetime.now().strftime(_FORMATO), solicitud.get('mensaje')))
+                logger.warning(f"SAT reporta solicitudes agotadas para {rfc}, se bloquean por {HORAS_BLOQUEO_AGOTADA} h")
+    except Exception as e:
+        logger.error(f"Error al registrar cuota de {rfc}: {e}")
@@ -0,0 +1,185 @@
+import logging
+import os
+import threading
+import time
+import types
+import requests
+from lxml import etree
+
+logger = logging.getLogger(__name__)
+
+# El token de Autenticacion del SAT dura 5 minutos (cfdiclient firma el Timestamp con 300 s)
+VIGENCIA_TOKEN = int(os.environ.get('SAT_TOKEN_VIGENCIA', 300))
+# Se considera vencido un poco antes para no enviar un token que expire en tránsito
+MARGEN_RENOVACION = int(os.environ.get('SAT_TOKEN_MARGEN', 30))
+# Renovación en segundo plano (opcional): solo mientras el cliente se haya usado recientemente
+REFRESCO_AUTOMATICO = os.environ.get('SAT_TOKEN_REFRESCO', 'False') == 'True'
+VENTANA_INACTIVIDAD = int(os.environ.get('SAT_TOKEN_INACTIVIDAD', 600))
+
+# Código de estatus con el que el SAT rechaza al usuario/token
+COD_USUARIO_NO_VALIDO = '300'
+
+# faultcode (sin prefijo) de WS-Security con el que se rechaza un token inválido o vencido
+FAULTS_AUTENTICACION = {
+    'InvalidSecurity', 'InvalidSecurityToken', 'FailedAuthentication',
+    'SecurityTokenUnavailable', 'MessageExpired'
+}
+
+class ErrorSAT(Exception):
+    """Respuesta de error de un servicio del SAT con su estatus HTTP y el faultcode del sobre"""
+
+    def __init__(self, mensaje, estatus_http=None, faultcode=None):
+        super().__init__(mensaje)
+        self.estatus_http = estatus_http
+        self.faultcode = faultcode
+
+def es_error_autenticacion(error):
+    """
+    Indica si el SAT rechazó el token: HTTP 401/403 o un fault de seguridad. Otros errores
+    (parseo, red, 500 genérico) no reautentican, porque el reintento gastaría otra solicitud
+    """
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code in (401, 403)
+    if not isinstance(error, ErrorSAT):
+        return False
+    if error.estatus_http in (401, 403):
+        return True
+    return (error.faultcode or '').rpartition(':')[2] in FAULTS_AUTENTICACION
+
+def _request_con_estatus(self, token=None, arguments=None):
+    """
+    WebServiceRequest.request de cfdiclient, pero el error conserva el estatus HTTP y el
+    faultcode (cfdiclient solo lanza Exception con el elemento faultstring)
+    """
+    if arguments:
+        self.signer.sign(self.set_request_arguments(arguments))
+    response = requests.post(
+        self.soap_url,
+        data=self.element_to_bytes(self.element_root),
+        headers=self.get_headers(token),
+        verify=self.verify,
+        timeout=self.timeout,
+    )
+    try:
+        response_xml = etree.fromstring(response.content, parser=etree.XMLParser(huge_tree=True))
+    except etree.XMLSyntaxError:
+        raise ErrorSAT(f'Respuesta no XML del SAT (HTTP {response.status_code})', response.status_code)
+    if response.status_code != requests.codes['ok']:
+        fault = response_xml.find('s:Body/s:Fault', self.external_nsmap)
+        faultcode = fault.findtext('faultcode') if fault is not None else None
+        faultstring = fault.findtext('{*}faultstring') if fault is not None else None
+        raise ErrorSAT(faultstring or f'HTTP {response.status_code}', response.status_code, faultcode)
+    return self.get_element_external(response_xml, self.result_xpath)
+
+def con_errores_tipados(servicio):
+    """Servicio de cfdiclient cuyas fallas se lanzan como ErrorSAT"""
+    servicio.request = types.MethodType(_request_con_estatus, servicio)
+    return servicio
+
+class GestorToken:
+    """
+    Guarda el token del SAT con su vigencia y lo renueva cuando está por expirar.
+    Con 'compartido' (ver shared_state.TokenCompartido) el token se publica para los demás
+    workers y, antes de autenticar, se adopta el que otro worker ya haya obtenido.
+    """
+
+    def __init__(self, obtener_token, vigencia=VIGENCIA_TOKEN, margen=MARGEN_RENOVACION,
+                 refresco_automatico=REFRESCO_AUTOMATICO, compartido=None):
+        self._obtener_token = obtener_token
+        self.compartido = compartido
+        self.vigencia = vigencia
+        self.margen = margen
+        self.refresco_automatico = refresco_automatico
+        self.token = None
+        self.emitido = None
+        self.expira = None
+        self.ultimo_uso = 0
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def vigente(self):
+        """True si hay token y le queda más que el margen de renovación"""
+        return self.token is not None and time.time() < self.expira - self.margen
+
+    def obtener(self):
+        """Regresa un token vigente, autenticando con el SAT solo si es necesario"""
+        with self._lock:
+            self.ultimo_uso = time.time()
+            if not self.vigente():
+                self._renovar()
+            return self.token
+
+    def invalidar(self):
+        """Descarta el token actual (por ejemplo, después de que el SAT lo rechazó)"""
+        with self._lock:
+            if self.compartido and self.token:
+                self.compartido.descartar(self.token)
+            self.token = None
+            self.emitido = None
+            self.expira = None
+
+    def establecer(self, token, emitido, expira):
+        """Adopta un token obtenido en otro lugar con su vigencia original"""
+        with self._lock:
+            self.token = token
+            self.emitido = emitido
+            self.expira = expira
+
+    def detener(self):
+        """Cancela la renovación en segundo plano"""
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+
+    def _adoptar_compartido(self):
+        """Toma el token que otro worker publicó si aún le queda más que el margen"""
+        previo = self.compartido.leer()
+        if previo and time.time() < previo[2] - self.margen:
+            self.token, self.emitido, self.expira = previo
+            return True
+        return False
+
+    def _tomar_compartido(self):
+        if self._adoptar_compartido():
+            return True
+        # Solo un worker autentica a la vez; los demás esperan a que publique su token
+        return not self.compartido.reclamar() and self.compartido.esperar(self._adoptar_compartido)
+
+    def _renovar(self):
+        if not (self.compartido and self._tomar_compartido()):
+            self._autenticar()
+        if self.refresco_automatico:
+            self._programar_refresco()
+
+    def _autenticar(self):
+        try:
+            token = self._obtener_token()
+            if not token:
+                raise Exception('El SAT no devolvió token de autenticación')
+            self.token = token
+            self.emitido = time.time()
+            self.expira = self.emitido + self.vigencia
+            if self.compartido:
+                self.compartido.publicar(self.token, self.emitido, self.expira)
+        finally:
+            if self.compartido:
+                self.compartido.liberar()
+
+    def _programar_refresco(self):
+        self.detener()
+        espera = max(self.expira - self.margen - time.time(), 1)
+        self._timer = threading.Timer(espera, self._refrescar)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _refrescar(self):
+        # Un cliente inactivo deja de renovar; el siguiente uso autenticará de nuevo
+        if time.time() - self.ultimo_uso > VENTANA_INACTIVIDAD:
+            self._timer = None
+            return
+        try:
+            with self._lock:
+                self._renovar()
+            logger.info("Token del SAT renovado en segundo plano")
+        except Exception as e:
+            logger.warning(f"No se pudo renovar el token en segundo plano: {e}")
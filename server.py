@@ -1,27 +1,47 @@
-from flask import Flask, request, jsonify, session
+from flask import Flask, Response, request, jsonify, session, g, stream_with_context
 from flask_cors import CORS
-from flask_session import Session
+import logging
 import os
 from datetime import datetime, timedelta
 from cfdiclient import Autenticacion, SolicitaDescargaEmitidos, SolicitaDescargaRecibidos, VerificaSolicitudDescarga, DescargaMasiva, Fiel
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.backends import default_backend
 import base64
-import zipfile
-import io
-import xml.etree.ElementTree as ET
+import binascii
+import hmac
+import json
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from urllib.parse import urlsplit
 import database
+import cfdi_parser
+import invoice_store
+import jobs
+import solicitudes_registry
+import quota
+import logging_setup
+import session_store
+import client_registry
+import fiel_cache
+import shared_state
+import exporter
+import xml_archive
+import invoice_search
+import cassette
+import metrics
+from sat_token import GestorToken, es_error_autenticacion, con_errores_tipados, COD_USUARIO_NO_VALIDO
+
+logger = logging.getLogger(__name__)
+logging_setup.configurar_logging()
 
 app = Flask(__name__)
 app.secret_key = 'clave_secreta_super_segura_cambiar_en_produccion'  # Cambiar en producción
 
-# Configuración de sesión con Flask-Session (almacenamiento en archivos)
-app.config['SESSION_TYPE'] = 'filesystem'
-app.config['SESSION_FILE_DIR'] = os.path.join(os.path.dirname(__file__), 'flask_session')
+# Configuración de sesión del lado del servidor (SQLite o LRU en memoria, ver session_store.py)
+app.config['SESSION_TYPE'] = session_store.BACKEND_SESION
 app.config['SESSION_PERMANENT'] = True
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(hours=24)
-app.config['SESSION_USE_SIGNER'] = True
-app.config['SESSION_KEY_PREFIX'] = 'sat_session:'
 # Configuración de cookies para producción HTTPS
 app.config['SESSION_COOKIE_NAME'] = 'sat_session'
 app.config['SESSION_COOKIE_SAMESITE'] = 'None'  # None permite CORS cross-site
@@ -30,8 +50,9 @@ app.config['SESSION_COOKIE_HTTPONLY'] = True
 app.config['SESSION_COOKIE_DOMAIN'] = None
 app.config['SESSION_COOKIE_PATH'] = '/'
 
-# Inicializar Flask-Session
-Session(app)
+# Inicializar el almacén de sesiones (la tabla vive en la misma base que los usuarios)
+database.init_db()
+session_store.configurar_sesiones(app, app.config['SESSION_TYPE'])
 
 # Configuración CORS para producción y desarrollo
 CORS(app, 
@@ -50,22 +71,89 @@ CORS(app,
      methods=['GET', 'POST', 'PUT', 'DELETE', 'OPTIONS'],
      expose_headers=['Set-Cookie'])
 
+# Descarga de paquetes: paquetes simultáneos por solicitud, timeout por paquete y reintentos
+DESCARGA_WORKERS = int(os.environ.get('SAT_DESCARGA_WORKERS', 4))
+# Tope de descargas simultáneas de todo el proceso: requests, jobs y ventanas del plan comparten
+# el mismo pool, así que los hilos contra el SAT no se multiplican (jobs × ventanas × paquetes)
+DESCARGA_WORKERS_TOTAL = int(os.environ.get('SAT_DESCARGA_WORKERS_TOTAL', 8))
+DESCARGA_TIMEOUT = int(os.environ.get('SAT_DESCARGA_TIMEOUT', 60))  # segundos
+DESCARGA_REINTENTOS = int(os.environ.get('SAT_DESCARGA_REINTENTOS', 2))
+# Un paquete decodificado se mantiene en memoria hasta este tamaño; arriba de él se pasa a disco
+PAQUETE_MEMORIA_MAXIMA = int(os.environ.get('SAT_PAQUETE_MEMORIA_MAX', 8 * 1024 * 1024))
+BLOQUE_BASE64 = 4 * 256 * 1024  # caracteres (múltiplo de 4) por bloque de decodificación
+# Servidor que atiende los servicios web del SAT en lugar de los reales (p. ej. http://localhost:5099
+# con benchmarks/sat_mock.py para pruebas de carga); vacío = endpoints del SAT
+SAT_SOAP_URL = os.environ.get('SAT_SOAP_URL')
+
 # Inicializar base de datos
-database.init_db()
+invoice_store.init_db()
+invoice_search.init_db()
+fiel_cache.init_db()
+xml_archive.init_db()
+shared_state.init_db()
+jobs.init_db()
+solicitudes_registry.init_db()
+quota.init_db()
+metrics.init_db()
+
+_descargas = ThreadPoolExecutor(max_workers=DESCARGA_WORKERS_TOTAL, thread_name_prefix='sat-paquete')
+
+def _cerrar_descarga(futuro):
+    """Cierra el archivo de una descarga que terminó después de que nadie la esperaba"""
+    if not futuro.cancelled() and futuro.exception() is None and futuro.result() is not None:
+        futuro.result().close()
+
+class _PaqueteTemporal:
+    """Archivo temporal con el ZIP decodificado de un paquete; se borra al cerrarlo"""
+    def __init__(self):
+        self._archivo = tempfile.SpooledTemporaryFile(max_size=PAQUETE_MEMORIA_MAXIMA)
+        self.tamano = 0
+    
+    def __getattr__(self, nombre):
+        return getattr(self._archivo, nombre)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self._archivo.close()
+
+def _decodificar_a_archivo(paquete_b64):
+    """Decodifica el base64 de un paquete por bloques hacia un archivo temporal"""
+    archivo = _PaqueteTemporal()
+    try:
+        for inicio in range(0, len(paquete_b64), BLOQUE_BASE64):
+            archivo.write(base64.b64decode(paquete_b64[inicio:inicio + BLOQUE_BASE64], validate=True))
+    except binascii.Error:
+        # Con saltos de línea los bloques no quedan alineados a 4 caracteres: decodificar de una vez
+        archivo.seek(0)
+        archivo.truncate()
+        archivo.write(base64.b64decode(paquete_b64))
+    archivo.tamano = archivo.tell()
+    archivo.seek(0)
+    return archivo
 
 class SATClient:
-    def __init__(self, rfc, cert_path, key_path, key_password):
+    def __init__(self, rfc, cert_path, key_path, key_password, soap_url=None):
         self.rfc = rfc
         self.cert_path = cert_path
         self.key_path = key_path
         self.key_password = key_password
-        self.token = None
+        self.soap_url = soap_url or SAT_SOAP_URL
         self.fiel = None
+        # El token se reutiliza entre solicitar/verificar/descargar mientras siga vigente y se
+        # publica en SQLite para que los demás workers no vuelvan a autenticar
+        self.tokens = GestorToken(self._solicitar_token, compartido=shared_state.TokenCompartido(rfc))
+    
+    @property
+    def token(self):
+        """Token vigente más reciente (None si no se ha autenticado)"""
+        return self.tokens.token
     
     def inicializar_fiel(self):
         """Inicializa la FIEL usando cfdiclient"""
         try:
-            print(f"🔐 Inicializando FIEL para RFC: {self.rfc}")
+            logger.info(f"Inicializando FIEL para RFC: {self.rfc}")
             
             # Leer certificado
             with open(self.cert_path, 'rb') as f:
@@ -75,12 +163,21 @@ class SATClient:
             with open(self.key_path, 'rb') as f:
                 key_der = f.read()
             
-            print(f"✅ Archivos leídos correctamente")
+            logger.debug("Archivos leídos correctamente")
+            
+            # Si ya se descifró esta misma llave con esta contraseña, evitar repetir el PKCS#8
+            fiel = fiel_cache.obtener(cer_der, key_der, self.key_password, ruta=self.key_path)
+            if fiel is not None:
+                self.fiel = fiel
+                metrics.CACHE.incrementar('fiel', 'acierto')
+                logger.info("FIEL obtenida del caché")
+                return True
+            metrics.CACHE.incrementar('fiel', 'fallo')
             
             # Convertir la llave de formato DER encriptado a PEM
             # (cfdiclient usa pycrypto que necesita formato específico)
             try:
-                print(f"🔄 Convirtiendo llave privada...")
+                logger.debug("Convirtiendo llave privada...")
                 private_key = serialization.load_der_private_key(
                     key_der,
                     password=self.key_password.encode() if self.key_password else None,
@@ -94,73 +191,120 @@ class SATClient:
                     encryption_algorithm=serialization.NoEncryption()
                 )
                 
-                print(f"✅ Llave convertida a PEM")
+                logger.debug("Llave convertida a PEM")
                 
             except Exception as e:
-                print(f"❌ Error al convertir llave: {e}")
+                logger.error(f"Error al convertir llave: {e}")
                 return False
             
             # Crear objeto Fiel con certificado DER y llave PEM
             self.fiel = Fiel(cer_der, key_pem, b'')  # Sin password porque ya desencriptamos
-            print(f"✅ FIEL inicializada correctamente")
+            fiel_cache.guardar(cer_der, key_der, self.key_password, key_pem, self.fiel, ruta=self.key_path)
+            logger.info("FIEL inicializada correctamente")
             return True
             
         except Exception as e:
-            print(f"❌ Error al inicializar FIEL: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.exception(f"Error al inicializar FIEL: {e}")
             return False
     
+    def _servicio(self, clase, **kwargs):
+        """
+        Servicio de cfdiclient; con soap_url se usa la misma ruta en ese servidor.
+        Con SAT_CASSETTE se graban sus respuestas o se reproducen sin ir al SAT (ver cassette.py).
+        Cada llamada queda medida en /metrics por operación y CodEstatus
+        """
+        def crear():
+            # Errores con estatus HTTP y faultcode para decidir si hay que reautenticar
+            servicio = con_errores_tipados(clase(self.fiel, **kwargs))
+            if self.soap_url:
+                servicio.soap_url = self.soap_url.rstrip('/') + urlsplit(clase.soap_url).path
+            return servicio
+        return metrics.medir_servicio(cassette.envolver(clase, self.rfc, crear))
+    
+    def _solicitar_token(self):
+        """Pide un token nuevo al servicio de Autenticacion del SAT"""
+        if not self.fiel and not cassette.reproduciendo():
+            if not self.inicializar_fiel():
+                raise Exception('No se pudo inicializar la FIEL')
+        
+        logger.info("Solicitando token de autenticación...")
+        auth = self._servicio(Autenticacion)
+        return auth.obtener_token()
+    
     def autenticar(self):
-        """Autentica con el SAT usando cfdiclient"""
+        """Autentica con el SAT usando cfdiclient (fuerza un token nuevo)"""
         try:
-            if not self.fiel:
-                if not self.inicializar_fiel():
-                    return False
-            
-            print(f"📤 Solicitando token de autenticación...")
-            
-            # Usar cfdiclient para autenticar
-            auth = Autenticacion(self.fiel)
-            self.token = auth.obtener_token()
+            self.tokens.invalidar()
+            token = self.tokens.obtener()
             
-            print(f"✅ Token obtenido: {self.token[:50] if self.token else 'None'}...")
-            return True if self.token else False
+            logger.info("Token obtenido" if token else "El SAT no devolvió token")
+            return True if token else False
             
         except Exception as e:
-            print(f"❌ Error en autenticación: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.exception(f"Error en autenticación: {e}")
             return False
     
-    def solicitar_descarga(self, fecha_inicial, fecha_final, tipo_solicitud='CFDI', estado_comprobante=None):
+    def _con_token(self, operacion):
+        """
+        Ejecuta una llamada al SAT con un token vigente.
+        Si el SAT rechaza el token (falla de autenticación o CodEstatus 300), reautentica una sola vez.
+        """
+        try:
+            resultado = operacion(self.tokens.obtener())
+        except Exception as e:
+            if not es_error_autenticacion(e):
+                raise
+            logger.info(f"Token rechazado por el SAT ({e}), reautenticando...")
+            self.tokens.invalidar()
+            return operacion(self.tokens.obtener())
+        
+        if isinstance(resultado, dict) and resultado.get('cod_estatus') == COD_USUARIO_NO_VALIDO:
+            logger.info(f"SAT respondió {COD_USUARIO_NO_VALIDO} (usuario no válido), reautenticando...")
+            self.tokens.invalidar()
+            return operacion(self.tokens.obtener())
+        return resultado
+    
+    def solicitar_descarga(self, fecha_inicial, fecha_final, tipo_solicitud='CFDI', estado_comprobante=None, reutilizar=True):
         """
         Solicita descarga de facturas usando cfdiclient
         tipo_solicitud: 'emitidas' o 'recibidas'
         estado_comprobante: None (todos), 0 (canceladas), 1 (vigentes)
+        reutilizar: retomar una solicitud previa que cubra el mismo rango en lugar de crear otra
         """
         try:
-            if not self.token:
-                if not self.autenticar():
-                    return None
+            logger.info(f"Solicitando descarga de facturas {tipo_solicitud} para {self.rfc}: {fecha_inicial} - {fecha_final}",
+                        extra={'datos': {'estado_comprobante': estado_comprobante}})
             
-            print(f"📥 Solicitando descarga de facturas {tipo_solicitud}...")
-            print(f"📅 Desde: {fecha_inicial} hasta: {fecha_final}")
-            print(f"🔑 RFC: {self.rfc}")
-            if estado_comprobante is not None:
-                estado_texto = "Vigentes" if estado_comprobante == 1 else "Canceladas"
-                print(f"📋 Estado comprobante: {estado_texto} ({estado_comprobante})")
-            else:
-                print(f"📋 Estado comprobante: Todos")
+            # Cada solicitud cuenta contra el límite del RFC en el SAT: si ya hay una vigente
+            # que cubre el rango con el mismo filtro, se retoma su id en lugar de crear otra
+            if reutilizar:
+                previa = solicitudes_registry.buscar_reutilizable(
+                    self.rfc, tipo_solicitud, estado_comprobante, fecha_inicial, fecha_final
+                )
+                if previa:
+                    logger.info(f"Reutilizando solicitud {previa['id_solicitud']} ({previa['fecha_inicial']} - {previa['fecha_final']})")
+                    return {
+                        'cod_estatus': '5000',
+                        'id_solicitud': previa['id_solicitud'],
+                        'mensaje': 'Solicitud previa reutilizada',
+                        'reutilizada': True
+                    }
+            
+            # Revisar el presupuesto del RFC antes de gastar una solicitud en el SAT
+            admision = quota.reservar(self.rfc, tipo_solicitud)
+            if not admision['success']:
+                logger.warning(f"Solicitud no enviada al SAT: {admision['message']}")
+                return {
+                    'cod_estatus': quota.COD_CUOTA_LOCAL,
+                    'id_solicitud': None,
+                    'mensaje': admision['message'],
+                    'cuota': admision['cuota']
+                }
             
             # Usar la clase correcta según el tipo
             if tipo_solicitud == 'emitidas':
-                descarga = SolicitaDescargaEmitidos(self.fiel)
-                print(f"📤 Solicitando EMITIDAS con rfc_emisor={self.rfc}")
-                
                 # Construir parámetros según el estado
                 params = {
-                    'token': self.token,
                     'rfc_solicitante': self.rfc,
                     'fecha_inicial': fecha_inicial,
                     'fecha_final': fecha_final,
@@ -172,19 +316,14 @@ class SATClient:
                 # Si el usuario quiere canceladas, debe especificar '0' explícitamente
                 estado_final = estado_comprobante if estado_comprobante is not None else 1
                 params['estado_comprobante'] = str(estado_final)
-                estado_texto = "Vigentes" if estado_final == 1 else "Canceladas" if estado_final == 0 else "Todos"
-                print(f"🔧 Agregando filtro estado_comprobante = '{estado_final}' ({estado_texto})")
-                
-                print(f"📦 Parámetros de solicitud: {params}")
-                solicitud = descarga.solicitar_descarga(**params)
+                logger.debug("Parámetros de solicitud: %s", params)
+                solicitud = self._con_token(
+                    lambda token: self._servicio(SolicitaDescargaEmitidos).solicitar_descarga(token=token, **params)
+                )
             else:  # recibidas
-                descarga = SolicitaDescargaRecibidos(self.fiel)
-                print(f"📥 Solicitando RECIBIDAS con rfc_receptor={self.rfc}")
-                
                 # Para facturas recibidas, NO usar filtro de estado_comprobante
                 # porque el SAT no permite filtrar facturas canceladas por terceros
                 params = {
-                    'token': self.token,
                     'rfc_solicitante': self.rfc,
                     'fecha_inicial': fecha_inicial,
                     'fecha_final': fecha_final,
@@ -193,211 +332,207 @@ class SATClient:
                 
                 # IMPORTANTE: Para facturas recibidas, ignoramos estado_comprobante
                 # El SAT devuelve todas las facturas (vigentes y canceladas) automáticamente
-                print(f"� Parámetros de solicitud (SIN filtro estado_comprobante para recibidas): {params}")
-                solicitud = descarga.solicitar_descarga(**params)
+                logger.debug("Parámetros de solicitud (SIN filtro estado_comprobante para recibidas): %s", params)
+                solicitud = self._con_token(
+                    lambda token: self._servicio(SolicitaDescargaRecibidos).solicitar_descarga(token=token, **params)
+                )
+            
+            logger.info(f"Solicitud creada: {solicitud}")
+            quota.confirmar(admision['registro'], self.rfc, solicitud)
             
-            print(f"✅ Solicitud creada: {solicitud}")
+            if solicitud and solicitud.get('cod_estatus') in ('5000', '305'):
+                if solicitud.get('id_solicitud'):
+                    solicitudes_registry.registrar_solicitud(
+                        self.rfc, tipo_solicitud, estado_comprobante, fecha_inicial, fecha_final,
+                        solicitud['id_solicitud'], solicitud.get('cod_estatus')
+                    )
+                elif solicitud.get('cod_estatus') == '305':
+                    # Duplicada sin id: se busca la original en el registro sin importar su antigüedad
+                    previa = solicitudes_registry.buscar_reutilizable(
+                        self.rfc, tipo_solicitud, estado_comprobante, fecha_inicial, fecha_final, vigencia=None
+                    )
+                    if previa:
+                        logger.info(f"Solicitud duplicada, se retoma {previa['id_solicitud']}")
+                        solicitud['id_solicitud'] = previa['id_solicitud']
             return solicitud
             
         except Exception as e:
-            print(f"❌ Error al solicitar descarga: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.exception(f"Error al solicitar descarga: {e}")
             return None
     
     def verificar_solicitud(self, id_solicitud):
         """Verifica el estado de una solicitud de descarga"""
         try:
-            if not self.token:
-                if not self.autenticar():
-                    return None
+            logger.debug("Verificando solicitud: %s", id_solicitud)
             
-            print(f"🔍 Verificando solicitud: {id_solicitud}")
-            
-            verificacion = VerificaSolicitudDescarga(self.fiel)
-            resultado = verificacion.verificar_descarga(
-                self.token,
-                self.rfc,
-                id_solicitud
+            resultado = self._con_token(
+                lambda token: self._servicio(VerificaSolicitudDescarga).verificar_descarga(token, self.rfc, id_solicitud)
             )
             
-            print(f"✅ Verificación: {resultado}")
+            logger.info(f"Verificación: {resultado}")
+            solicitudes_registry.actualizar_verificacion(id_solicitud, resultado)
             return resultado
             
         except Exception as e:
-            print(f"❌ Error al verificar solicitud: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.exception(f"Error al verificar solicitud: {e}")
             return None
     
-    def descargar_paquetes(self, id_solicitud):
-        """Descarga los paquetes ZIP de una solicitud"""
-        try:
-            if not self.token:
-                if not self.autenticar():
-                    print("❌ No se pudo autenticar para descargar paquetes")
-                    return None
-            
-            print(f"📦 Descargando paquetes para solicitud: {id_solicitud}")
-            
-            descarga = DescargaMasiva(self.fiel)
-            
-            # El método correcto en cfdiclient es 'descargar', no 'descargar_paquetes'
+    def _descargar_paquete(self, paquete_id):
+        """Descarga un paquete a un archivo temporal, reintentando con espera exponencial"""
+        for intento in range(DESCARGA_REINTENTOS + 1):
             try:
-                # Obtener la lista de paquetes de la verificación
-                verificacion = self.verificar_solicitud(id_solicitud)
-                if not verificacion or 'paquetes' not in verificacion:
-                    print("⚠️ No hay paquetes disponibles para descargar")
-                    return []
-                
-                paquetes_ids = verificacion['paquetes']
-                print(f"📦 Paquetes encontrados: {len(paquetes_ids)}")
-                
-                paquetes_descargados = []
-                for paquete_id in paquetes_ids:
-                    try:
-                        print(f"⬇️ Descargando paquete: {paquete_id}")
-                        # El método correcto es 'descargar_paquete' (singular) según cfdiclient
-                        resultado = descarga.descargar_paquete(
-                            self.token,
-                            self.rfc,
-                            paquete_id
-                        )
-                        
-                        if resultado and 'paquete' in resultado:
-                            # El paquete viene en base64, necesitamos decodificarlo
-                            import base64
-                            paquete_b64 = resultado['paquete']
-                            paquete_bytes = base64.b64decode(paquete_b64)
-                            paquetes_descargados.append(paquete_bytes)
-                            print(f"✅ Paquete {paquete_id} descargado: {len(paquete_bytes)} bytes")
-                        else:
-                            print(f"⚠️ Paquete {paquete_id} sin contenido")
-                    except Exception as pe:
-                        print(f"❌ Error descargando paquete {paquete_id}: {pe}")
-                        continue
+                logger.debug("Descargando paquete: %s (intento %s)", paquete_id, intento + 1)
+                resultado = self._con_token(
+                    lambda token: self._servicio(DescargaMasiva, timeout=DESCARGA_TIMEOUT).descargar_paquete(
+                        token, self.rfc, paquete_id
+                    )
+                )
                 
-                print(f"✅ Total de paquetes descargados: {len(paquetes_descargados)}")
-                return paquetes_descargados
-                    
-            except AttributeError as ae:
-                print(f"⚠️ Error de atributo en descarga: {ae}")
-                import traceback
-                traceback.print_exc()
-                return []
-            except Exception as de:
-                print(f"❌ Error en descarga de paquetes: {de}")
-                import traceback
-                traceback.print_exc()
-                return []
+                # cfdiclient devuelve el contenido en 'paquete_b64'
+                paquete_b64 = (resultado.get('paquete_b64') or resultado.get('paquete')) if resultado else None
+                if paquete_b64:
+                    # El paquete viene en base64: se decodifica por bloques a un archivo temporal
+                    # y se suelta la cadena para no tener ambas copias en memoria
+                    del resultado
+                    with metrics.medir(metrics.ETAPA_SEGUNDOS, 'base64'):
+                        archivo = _decodificar_a_archivo(paquete_b64)
+                    del paquete_b64
+                    metrics.PAQUETE_BYTES.observar(archivo.tamano)
+                    logger.info(f"Paquete {paquete_id} descargado: {archivo.tamano} bytes")
+                    return archivo
+                logger.warning(f"Paquete {paquete_id} sin contenido: {resultado.get('mensaje') if resultado else ''}")
+            except Exception as pe:
+                logger.error(f"Error descargando paquete {paquete_id}: {pe}")
             
+            if intento < DESCARGA_REINTENTOS:
+                time.sleep(2 ** intento)
+        return None
+    
+    def iterar_paquetes(self, id_solicitud, paquetes_ids=None):
+        """
+        Descarga los paquetes de una solicitud en paralelo (hasta DESCARGA_WORKERS a la vez, en el
+        pool compartido del proceso) y entrega (paquete_id, archivo) conforme cada uno termina,
+        para parsearlo de inmediato.
+        El archivo es temporal (en memoria hasta PAQUETE_MEMORIA_MAXIMA, después en disco)
+        y quien lo recibe debe cerrarlo.
+        paquetes_ids: ids ya obtenidos en la verificación; si no se dan, se verifica de nuevo.
+        """
+        if paquetes_ids is None:
+            verificacion = self.verificar_solicitud(id_solicitud)
+            if not verificacion or 'paquetes' not in verificacion:
+                logger.warning("No hay paquetes disponibles para descargar")
+                return
+            paquetes_ids = verificacion['paquetes']
+        
+        logger.info(f"Descargando {len(paquetes_ids)} paquetes para solicitud {id_solicitud}")
+        if not paquetes_ids:
+            return
+        
+        # Obtener el token antes de repartir el trabajo, para que los hilos no compitan por autenticar
+        self.tokens.obtener()
+        
+        # Se encolan de a poco para que una solicitud grande no acapare el pool ni acumule
+        # paquetes descargados que todavía no se parsean
+        pendientes = list(paquetes_ids)
+        en_curso = {}
+        try:
+            while pendientes or en_curso:
+                while pendientes and len(en_curso) < max(1, DESCARGA_WORKERS):
+                    paquete_id = pendientes.pop(0)
+                    en_curso[_descargas.submit(self._descargar_paquete, paquete_id)] = paquete_id
+                terminados, _ = wait(en_curso, return_when=FIRST_COMPLETED)
+                for futuro in terminados:
+                    paquete_id = en_curso.pop(futuro)
+                    archivo = futuro.result()
+                    if archivo is not None:
+                        yield paquete_id, archivo
+        finally:
+            # Si quien consume abandona el generador, lo que sigue en vuelo se cancela o se cierra al terminar
+            for futuro in en_curso:
+                if not futuro.cancel():
+                    futuro.add_done_callback(_cerrar_descarga)
+    
+    def descargar_paquetes(self, id_solicitud, paquetes_ids=None):
+        """Descarga los paquetes ZIP de una solicitud"""
+        try:
+            paquetes_descargados = []
+            for _, archivo in self.iterar_paquetes(id_solicitud, paquetes_ids):
+                with archivo:
+                    paquetes_descargados.append(archivo.read())
+            logger.info(f"Total de paquetes descargados: {len(paquetes_descargados)}")
+            return paquetes_descargados
         except Exception as e:
-            print(f"❌ Error general al descargar paquetes: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.exception(f"Error general al descargar paquetes: {e}")
             return []
     
+    def iterar_facturas(self, id_solicitud, paquetes_ids=None, estadisticas=None):
+        """
+        Descarga los paquetes y entrega las facturas una por una.
+        Cada paquete se libera en cuanto se terminan de leer sus XML, así que la memoria
+        queda acotada por los paquetes en vuelo y no por toda la solicitud.
+        estadisticas: dict opcional donde se acumulan 'paquetes' y 'facturas' procesados.
+        """
+        if estadisticas is None:
+            estadisticas = {}
+        estadisticas.setdefault('paquetes', 0)
+        estadisticas.setdefault('facturas', 0)
+        
+        for paquete_id, archivo in self.iterar_paquetes(id_solicitud, paquetes_ids):
+            # Los XML originales se archivan conforme se parsean para no pedirlos otra vez al SAT
+            escritor = xml_archive.EscritorArchivo(self.rfc) if xml_archive.ARCHIVAR_XML else None
+            with archivo:
+                facturas_paquete = 0
+                # Solo se mide el parseo, no lo que hace quien consume las facturas
+                parseadas = metrics.medir_iterador(
+                    cfdi_parser.iterar_facturas_de_zip(archivo, con_xml=True), metrics.ETAPA_SEGUNDOS, 'parseo'
+                )
+                for factura, xml_content in parseadas:
+                    if escritor:
+                        escritor.agregar(factura.get('uuid'), xml_content)
+                    facturas_paquete += 1
+                    estadisticas['facturas'] += 1
+                    yield factura
+            if escritor:
+                escritor.confirmar()
+            metrics.FACTURAS_PARSEADAS.incrementar(valor=facturas_paquete)
+            estadisticas['paquetes'] += 1
+            logger.debug("Extraídas %s facturas del paquete %s", facturas_paquete, paquete_id)
+    
+    def iterar_facturas_de_zip(self, zip_data):
+        """Entrega una por una las facturas de un ZIP (bytes o archivo)"""
+        return cfdi_parser.iterar_facturas_de_zip(zip_data)
+    
     def parsear_facturas_de_zip(self, zip_data):
         """Extrae y parsea las facturas de un archivo ZIP"""
-        facturas = []
-        try:
-            # Abrir el ZIP desde bytes
-            with zipfile.ZipFile(io.BytesIO(zip_data)) as zip_file:
-                # Iterar sobre cada archivo XML en el ZIP
-                for filename in zip_file.namelist():
-                    if filename.endswith('.xml'):
-                        try:
-                            xml_content = zip_file.read(filename)
-                            factura = self.parsear_xml_factura(xml_content)
-                            if factura:
-                                facturas.append(factura)
-                        except Exception as e:
-                            print(f"⚠️ Error al parsear {filename}: {e}")
-                            continue
-        except Exception as e:
-            print(f"❌ Error al abrir ZIP: {e}")
-        
-        return facturas
+        return list(self.iterar_facturas_de_zip(zip_data))
     
     def parsear_xml_factura(self, xml_content):
         """Parsea un XML de factura y extrae la información principal"""
-        try:
-            # Parsear el XML
-            root = ET.fromstring(xml_content)
-            
-            # Namespaces del SAT
-            ns = {
-                'cfdi': 'http://www.sat.gob.mx/cfd/4',
-                'cfdi3': 'http://www.sat.gob.mx/cfd/3',
-                'tfd': 'http://www.sat.gob.mx/TimbreFiscalDigital'
-            }
-            
-            # Intentar con namespace 4.0 primero, luego 3.3
-            comprobante = root
-            
-            # Extraer datos del comprobante
-            fecha = comprobante.get('Fecha', '')
-            folio = comprobante.get('Folio', 'N/A')
-            serie = comprobante.get('Serie', '')
-            total = comprobante.get('Total', '0')
-            subtotal = comprobante.get('SubTotal', '0')
-            moneda = comprobante.get('Moneda', 'MXN')
-            tipo_comprobante = comprobante.get('TipoDeComprobante', 'I')
-            
-            # Emisor
-            emisor = comprobante.find('cfdi:Emisor', ns) or comprobante.find('cfdi3:Emisor', ns)
-            rfc_emisor = emisor.get('Rfc', '') if emisor is not None else ''
-            nombre_emisor = emisor.get('Nombre', '') if emisor is not None else ''
-            
-            # Receptor
-            receptor = comprobante.find('cfdi:Receptor', ns) or comprobante.find('cfdi3:Receptor', ns)
-            rfc_receptor = receptor.get('Rfc', '') if receptor is not None else ''
-            nombre_receptor = receptor.get('Nombre', '') if receptor is not None else ''
-            
-            # Timbre Fiscal (UUID)
-            complemento = comprobante.find('.//cfdi:Complemento', ns) or comprobante.find('.//cfdi3:Complemento', ns)
-            uuid = ''
-            fecha_cancelacion = None
-            if complemento is not None:
-                timbre = complemento.find('tfd:TimbreFiscalDigital', ns)
-                if timbre is not None:
-                    uuid = timbre.get('UUID', '')
-                    fecha_cancelacion = timbre.get('FechaCancelacion', None)
-            
-            # Determinar estado: si no tiene fecha de cancelación, está vigente
-            estado = 'Cancelado' if fecha_cancelacion else 'Vigente'
-            
-            return {
-                'uuid': uuid,
-                'fecha': fecha,
-                'serie': serie,
-                'folio': folio,
-                'rfcEmisor': rfc_emisor,
-                'nombreEmisor': nombre_emisor,
-                'rfcReceptor': rfc_receptor,
-                'nombreReceptor': nombre_receptor,
-                'subtotal': float(subtotal),
-                'total': float(total),
-                'moneda': moneda,
-                'tipoComprobante': tipo_comprobante,
-                'estado': estado,
-                'fechaCancelacion': fecha_cancelacion
-            }
-            
-        except Exception as e:
-            print(f"❌ Error al parsear XML: {e}")
-            return None
+        return cfdi_parser.extraer_factura(xml_content)
+
+# Facturas por bloque de una respuesta NDJSON y máximo por página al paginar
+FACTURAS_POR_BLOQUE = 200
+LIMITE_PAGINA_MAXIMO = int(os.environ.get('SAT_LIMITE_PAGINA', 5000))
 
 # Diccionario global para almacenar clientes SAT por RFC
-sat_clients = {}
+sat_clients = client_registry.RegistroClientes()
+
+def _metricas_clientes():
+    """Tamaño y contadores del registro de clientes para /metrics"""
+    estadisticas = sat_clients.estadisticas()
+    metrics.CLIENTES_SAT.fijar(estadisticas['clientes'])
+    for contador, resultado in (('aciertos', 'acierto'), ('fallos', 'fallo'),
+                                ('desalojos', 'desalojo'), ('vencidos', 'vencido')):
+        metrics.CACHE.fijar(estadisticas[contador], 'clientes_sat', resultado)
+
+metrics.agregar_recolector(_metricas_clientes)
 
 @app.route('/api/consultar-facturas', methods=['POST'])
 def consultar_facturas():
     """Endpoint para consultar facturas del SAT"""
     try:
-        print(f"📨 Recibiendo solicitud de consultar facturas...")
         data = request.json
-        print(f"Data recibida: {data}")
+        logger.debug("Data recibida", extra={'datos': data})
         
         rfc = data.get('rfc')
         tipo_consulta = data.get('tipo')  # 'emitidas' o 'recibidas'
@@ -405,14 +540,25 @@ def consultar_facturas():
         fecha_final = data.get('fechaFinal')
         usar_datos_guardados = data.get('usarDatosGuardados', False)
         estado_comprobante = data.get('estadoComprobante')  # None, 0 (canceladas), o 1 (vigentes)
+        forzar_descarga = data.get('forzarDescarga', False)  # Ignorar el almacén local
+        asincrono = data.get('asincrono', False)  # Encolar un job en lugar de esperar al SAT
+        # 'ndjson' responde una factura por línea conforme se leen; limite/cursor paginan por (fecha, uuid)
+        try:
+            formato, limite, despues_de = _parametros_listado(data)
+        except ValueError as e:
+            return jsonify({
+                'success': False,
+                'message': str(e)
+            }), 400
         
-        print(f"RFC: {rfc}, Tipo: {tipo_consulta}, Fechas: {fecha_inicial} - {fecha_final}")
-        print(f"Usar datos guardados: {usar_datos_guardados}, Estado comprobante: {estado_comprobante}")
+        logger.info(f"Consulta de facturas {tipo_consulta} para {rfc}: {fecha_inicial} - {fecha_final}",
+                    extra={'datos': {'usar_datos_guardados': usar_datos_guardados, 'estado_comprobante': estado_comprobante,
+                                     'forzar_descarga': forzar_descarga, 'asincrono': asincrono}})
         
         # Validar que las fechas no sean iguales (SAT requiere rango válido)
         if fecha_inicial and fecha_final and fecha_inicial >= fecha_final:
             error_msg = 'La fecha inicial debe ser anterior a la fecha final. El SAT requiere un rango de fechas válido.'
-            print(f"❌ {error_msg}")
+            logger.warning(error_msg)
             return jsonify({
                 'success': False,
                 'message': error_msg,
@@ -427,7 +573,7 @@ def consultar_facturas():
             if not fecha_final: missing.append('fecha final')
             
             error_msg = f'Faltan datos: {", ".join(missing)}'
-            print(f"❌ {error_msg}")
+            logger.warning(error_msg)
             
             return jsonify({
                 'success': False,
@@ -436,12 +582,10 @@ def consultar_facturas():
         
         # Si usamos datos guardados, cargar desde la base de datos
         if usar_datos_guardados and 'usuario_id' in session:
-            print(f"🔑 Cargando datos fiscales guardados para usuario {session['usuario_id']}")
+            logger.info(f"Cargando datos fiscales guardados para usuario {session['usuario_id']}")
             usuario_id = session['usuario_id']
             resultado = database.obtener_datos_fiscales(usuario_id)
             
-            print(f"🔑 Resultado de obtener_datos_fiscales: {resultado}")
-            
             if not resultado['success']:
                 return jsonify({
                     'success': False,
@@ -449,12 +593,11 @@ def consultar_facturas():
                 }), 400
             
             datos_fiscales = resultado['datos']
-            print(f"🔑 Datos fiscales encontrados: {len(datos_fiscales)} RFCs")
+            logger.debug("Datos fiscales encontrados: %s RFCs", len(datos_fiscales))
             
             # Buscar los datos del RFC especificado
             datos_rfc = None
             for datos in datos_fiscales:
-                print(f"🔍 Comparando: {datos['rfc']} con {rfc}")
                 if datos['rfc'] == rfc:
                     datos_rfc = datos
                     break
@@ -470,10 +613,7 @@ def consultar_facturas():
             key_path = datos_rfc['llave_path']
             password_fiscal = datos_rfc['password_encrypted']  # Ahora es la contraseña en texto plano
             
-            print(f"✅ Certificados guardados encontrados:")
-            print(f"   - Certificado: {cert_path}")
-            print(f"   - Llave: {key_path}")
-            print(f"   - Password: {'*' * len(password_fiscal)}")
+            logger.debug("Certificados guardados encontrados", extra={'datos': {'certificado_path': cert_path}})
             
             # Verificar que los archivos existan
             if not os.path.exists(cert_path) or not os.path.exists(key_path):
@@ -482,22 +622,27 @@ def consultar_facturas():
                     'message': 'Los archivos de certificados no existen. Vuelve a subirlos en tu perfil.'
                 }), 400
             
-            # Crear o recuperar cliente
-            if rfc not in sat_clients:
-                print(f"🔧 Inicializando nuevo cliente SAT con datos guardados")
-                client = SATClient(rfc, cert_path, key_path, password_fiscal)
-                if not client.inicializar_fiel():
-                    return jsonify({
-                        'success': False,
-                        'message': 'Error al inicializar FIEL con certificados guardados. Verifica que la contraseña sea correcta.'
-                    }), 400
-                sat_clients[rfc] = client
-                print(f"✅ Cliente SAT inicializado correctamente")
-            else:
-                print(f"♻️ Reutilizando cliente SAT existente")
-                client = sat_clients[rfc]
+            # Crear o recuperar cliente (solo un request por RFC inicializa la FIEL)
+            def crear_cliente():
+                logger.info("Inicializando nuevo cliente SAT con datos guardados")
+                nuevo = SATClient(rfc, cert_path, key_path, password_fiscal)
+                if not nuevo.inicializar_fiel():
+                    return None
+                logger.info("Cliente SAT inicializado correctamente")
+                return nuevo
+            
+            client = sat_clients.obtener_o_crear(rfc, crear_cliente)
+            if not client:
+                return jsonify({
+                    'success': False,
+                    'message': 'Error al inicializar FIEL con certificados guardados. Verifica que la contraseña sea correcta.'
+                }), 400
         else:
-            print(f"📂 Usando certificados subidos manualmente")
+            logger.debug("Usando certificados subidos manualmente")
+            # Los certificados de otro usuario no sirven para consultar (ni para leer su almacén local)
+            error = _error_acceso_rfc(rfc)
+            if error:
+                return error
             # Verificar que existan los certificados subidos temporalmente
             cert_path = f'certificados/{rfc}.cer'
             key_path = f'certificados/{rfc}.key'
@@ -508,25 +653,64 @@ def consultar_facturas():
                     'message': 'Primero debes subir los certificados'
                 }), 400
             
-            # Obtener o crear cliente SAT
-            if rfc not in sat_clients:
+            # Obtener cliente SAT; si los certificados se subieron en otro worker (o el cliente
+            # se descartó por inactividad) se vuelve a crear con la referencia compartida
+            def crear_cliente():
+                subidos = shared_state.obtener_certificados(rfc)
+                if not subidos:
+                    return None
+                logger.info("Inicializando cliente SAT con certificados subidos en otro worker")
+                nuevo = SATClient(rfc, subidos['certificado_path'], subidos['llave_path'], subidos['password'])
+                return nuevo if nuevo.inicializar_fiel() else None
+            
+            client = sat_clients.obtener_o_crear(rfc, crear_cliente)
+            if not client:
                 return jsonify({
                     'success': False,
                     'message': 'Cliente no inicializado. Sube los certificados primero.'
                 }), 400
-            
-            client = sat_clients[rfc]
         
         # Convertir fechas
         fecha_ini = datetime.strptime(fecha_inicial, '%Y-%m-%d')
         fecha_fin = datetime.strptime(fecha_final, '%Y-%m-%d')
         
+        # Si el rango ya se descargó completo, responder desde el almacén local sin ir al SAT.
+        # Un cursor indica que la primera página ya se descargó: las siguientes salen del almacén
+        if despues_de or (not forzar_descarga and invoice_store.rango_cubierto(rfc, tipo_consulta, estado_comprobante, fecha_ini, fecha_fin)):
+            logger.info("Rango ya descargado, respondiendo desde el almacén local")
+            metrics.CONSULTAS.incrementar('almacen')
+            return _respuesta_facturas(
+                rfc, tipo_consulta, estado_comprobante, fecha_ini, fecha_fin,
+                {'origen': 'local', 'id_solicitud': None},
+                formato, limite, despues_de
+            )
+        
+        # Modo asíncrono: el job hace solicitar → verificar → descargar en segundo plano
+        if asincrono:
+            metrics.CONSULTAS.incrementar('job')
+            job_id = jobs.crear_job(
+                client,
+                tipo_consulta,
+                fecha_ini,
+                fecha_fin,
+                estado_comprobante=estado_comprobante,
+                usuario_id=session.get('usuario_id')
+            )
+            return jsonify({
+                'success': True,
+                'job_id': job_id,
+                'estado': jobs.PENDIENTE,
+                'message': 'Descarga encolada. Consulta /api/descargas/<job_id> para ver el avance.'
+            }), 202
+        
         # Solicitar descarga con estado del comprobante
+        metrics.CONSULTAS.incrementar('sat')
         solicitud = client.solicitar_descarga(
             fecha_ini,
             fecha_fin,
             tipo_solicitud=tipo_consulta,
-            estado_comprobante=estado_comprobante
+            estado_comprobante=estado_comprobante,
+            reutilizar=not forzar_descarga
         )
         
         if not solicitud:
@@ -540,6 +724,10 @@ def consultar_facturas():
         id_solicitud = solicitud.get('id_solicitud')
         mensaje = solicitud.get('mensaje', '')
         
+        # Rechazada localmente: el presupuesto del RFC está por agotarse y no se envió al SAT
+        if cod_estatus == quota.COD_CUOTA_LOCAL:
+            return _respuesta_cuota_agotada(solicitud['cuota'], mensaje)
+        
         # Códigos de estatus del SAT:
         # 5000 = Solicitud aceptada
         # 5004 = No se encontraron CFDIs
@@ -547,49 +735,41 @@ def consultar_facturas():
         # 305 = Solicitud duplicada
         # 404 = Error no controlado (puede ser que no hay datos)
         
-        if cod_estatus == '5000':
+        # Una duplicada (305) con id se retoma igual que una aceptada
+        if cod_estatus == '5000' or (cod_estatus == '305' and id_solicitud):
             # Solicitud exitosa, verificar estado
             if id_solicitud:
                 verificacion = client.verificar_solicitud(id_solicitud)
                 
                 # Si la solicitud está lista (estado 3), descargar y parsear las facturas
-                facturas = []
-                if verificacion and verificacion.get('estado_solicitud') == '3':
-                    print(f"✅ Solicitud lista, descargando paquetes...")
-                    paquetes = client.descargar_paquetes(id_solicitud)
-                    
-                    if paquetes:
-                        print(f"📦 Procesando {len(paquetes)} paquetes...")
-                        for paquete_data in paquetes:
-                            try:
-                                # Cada paquete es un diccionario con la data del ZIP
-                                facturas_paquete = client.parsear_facturas_de_zip(paquete_data)
-                                facturas.extend(facturas_paquete)
-                                print(f"✅ Extraídas {len(facturas_paquete)} facturas del paquete")
-                            except Exception as e:
-                                print(f"⚠️ Error al procesar paquete: {e}")
-                                continue
-                        
-                        print(f"✅ Total de facturas parseadas: {len(facturas)}")
-                        
-                        # Filtrar facturas canceladas - solo mostrar vigentes por defecto
-                        facturas_originales = len(facturas)
-                        facturas = [f for f in facturas if f.get('estado') == 'Vigente']
-                        facturas_canceladas = facturas_originales - len(facturas)
-                        
-                        print(f"📊 Facturas vigentes: {len(facturas)}")
-                        print(f"📊 Facturas canceladas (filtradas): {facturas_canceladas}")
+                lista = verificacion and verificacion.get('estado_solicitud') == '3'
+                encabezado = {'solicitud': solicitud, 'verificacion': verificacion, 'id_solicitud': id_solicitud}
+                conteo = {'vigentes': 0, 'canceladas_filtradas': 0}
+                facturas_iter = _facturas_de_solicitud(
+                    client, rfc, tipo_consulta, estado_comprobante, fecha_ini, fecha_fin,
+                    id_solicitud, (verificacion.get('paquetes') or []) if lista else [], conteo
+                )
+                
+                if formato == 'ndjson' and not limite:
+                    # Cada factura se envía en cuanto se parsea, sin esperar a los demás paquetes
+                    vigentes = (f for f in facturas_iter if f.get('estado') == 'Vigente')
+                    return _respuesta_ndjson(encabezado, vigentes, lambda: conteo)
+                if formato == 'ndjson' or limite:
+                    # Paginado: se descarga todo al almacén y la página sale de ahí
+                    for _ in facturas_iter:
+                        pass
+                    return _respuesta_facturas(rfc, tipo_consulta, estado_comprobante, fecha_ini, fecha_fin,
+                                               encabezado, formato, limite)
                 
+                # Filtrar facturas canceladas - solo mostrar vigentes por defecto
+                facturas = [f for f in facturas_iter if f.get('estado') == 'Vigente']
                 return jsonify({
                     'success': True,
                     'solicitud': solicitud,
                     'verificacion': verificacion,
                     'id_solicitud': id_solicitud,
                     'facturas': facturas,
-                    'stats': {
-                        'vigentes': len(facturas),
-                        'canceladas_filtradas': facturas_canceladas if 'facturas_originales' in locals() else 0
-                    }
+                    'stats': conteo
                 })
             else:
                 return jsonify({
@@ -599,6 +779,8 @@ def consultar_facturas():
                     'id_solicitud': None
                 })
         elif cod_estatus == '5004':
+            # El SAT confirmó que no hay CFDIs: el rango también queda cubierto
+            invoice_store.registrar_cobertura(rfc, tipo_consulta, estado_comprobante, fecha_ini, fecha_fin)
             return jsonify({
                 'success': True,
                 'message': 'No se encontraron facturas para el período especificado',
@@ -614,44 +796,43 @@ def consultar_facturas():
                 'id_solicitud': id_solicitud
             })
         elif cod_estatus == '305':
-            # Solicitud duplicada - intentar verificar con el ID previo
-            if id_solicitud:
-                verificacion = client.verificar_solicitud(id_solicitud)
-                return jsonify({
-                    'success': True,
-                    'message': 'Solicitud duplicada encontrada',
-                    'solicitud': solicitud,
-                    'verificacion': verificacion,
-                    'id_solicitud': id_solicitud
-                })
-            else:
-                return jsonify({
-                    'success': False,
-                    'message': f'Solicitud duplicada: {mensaje}',
-                    'solicitud': solicitud
-                })
+            # Solicitud duplicada sin id en la respuesta ni en el registro local
+            return jsonify({
+                'success': False,
+                'message': f'Solicitud duplicada: {mensaje}',
+                'solicitud': solicitud
+            })
         elif cod_estatus == '301':
             # Error 301 - para recibidas significa hay facturas canceladas
             # El SAT NO permite consultar facturas recibidas si hay canceladas en el rango
             tipo_texto = 'emitidas' if tipo_consulta == 'emitidas' else 'recibidas'
             
-            print(f"⚠️ Error 301 recibido del SAT")
-            print(f"⚠️ Mensaje del SAT: {mensaje}")
-            print(f"⚠️ Estado comprobante enviado: {estado_comprobante}")
-            print(f"⚠️ Tipo de consulta: {tipo_consulta}")
+            logger.warning(f"Error 301 recibido del SAT: {mensaje}",
+                           extra={'datos': {'estado_comprobante': estado_comprobante, 'tipo': tipo_consulta}})
             
             # Para facturas RECIBIDAS con error 301, significa que hay canceladas
             # y el SAT no permite descargarlas junto con las vigentes
+            # El plan de descarga parte el rango en ventanas (por mes y más chicas si el SAT
+            # vuelve a rechazar) y junta los resultados en el almacén local
             if tipo_consulta == 'recibidas':
+                job_id = jobs.crear_job(
+                    client,
+                    tipo_consulta,
+                    fecha_ini,
+                    fecha_fin,
+                    estado_comprobante=estado_comprobante,
+                    usuario_id=session.get('usuario_id')
+                )
                 return jsonify({
-                    'success': False,
+                    'success': True,
                     'error_301_recibidas': True,
-                    'message': 'El SAT no permite descargar facturas recibidas cuando hay facturas canceladas en el rango de fechas',
-                    'sugerencia': 'Intenta reducir el rango de fechas a períodos más pequeños (por ejemplo, un mes a la vez)',
+                    'job_id': job_id,
+                    'estado': jobs.PENDIENTE,
+                    'message': 'El SAT rechazó el rango completo; se dividirá en períodos más pequeños en segundo plano. Consulta /api/descargas/<job_id> para ver el avance.',
                     'detalle': mensaje,
                     'solicitud': solicitud,
                     'cod_estatus': cod_estatus
-                }), 400
+                }), 202
             
             # Para emitidas, el error 301 puede significar sin facturas
             return jsonify({
@@ -664,9 +845,8 @@ def consultar_facturas():
             })
         else:
             # Otros códigos de error - también tratarlos como "sin facturas" si no es crítico
-            print(f"⚠️ Código de estado no manejado: {cod_estatus}")
-            print(f"⚠️ Mensaje: {mensaje}")
-            print(f"⚠️ ID Solicitud: {id_solicitud}")
+            logger.warning(f"Código de estado no manejado: {cod_estatus} ({mensaje})",
+                           extra={'datos': {'id_solicitud': id_solicitud}})
             
             # Código 5002 del SAT = Límite de solicitudes excedido
             if cod_estatus == '5002':
@@ -677,7 +857,8 @@ def consultar_facturas():
                     'detalle': mensaje,
                     'sugerencia': 'El SAT limita la cantidad de solicitudes por RFC. Este límite puede ser diario, mensual o de por vida dependiendo del tipo de cuenta.',
                     'solicitud': solicitud,
-                    'cod_estatus': cod_estatus
+                    'cod_estatus': cod_estatus,
+                    'cuota': quota.obtener_cuota(rfc)
                 }), 400
             
             # Código 404 del SAT = No hay facturas en el rango de fechas (respuesta legítima)
@@ -713,31 +894,394 @@ def consultar_facturas():
             }), 400
         
     except Exception as e:
-        print(f"❌ Error en consultar_facturas: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception(f"Error en consultar_facturas: {e}")
         return jsonify({
             'success': False,
             'message': f'Error del servidor: {str(e)}'
         }), 500
 
+def _facturas_de_solicitud(client, rfc, tipo, estado_comprobante, fecha_ini, fecha_fin, id_solicitud, paquetes_ids, conteo):
+    """
+    Descarga los paquetes de una solicitud terminada y entrega, conforme se parsean, las facturas
+    del rango pedido. Todo se guarda en el almacén local; conteo acumula vigentes y canceladas.
+    """
+    if not paquetes_ids:
+        return
+    logger.info("Solicitud lista, descargando paquetes...")
+    # Los paquetes se descargan en paralelo y sus facturas se parsean y guardan conforme van llegando
+    estadisticas = {'paquetes': 0, 'facturas': 0}
+    facturas_iter = client.iterar_facturas(id_solicitud, paquetes_ids, estadisticas)
+    for factura in invoice_store.guardar_en_lotes(rfc, tipo, facturas_iter, estado_comprobante):
+        # Una solicitud reutilizada puede cubrir un rango mayor: todo se guarda,
+        # pero solo se responde lo que cae en el rango pedido
+        if not invoice_store.en_rango(factura, fecha_ini, fecha_fin):
+            continue
+        conteo['vigentes' if factura.get('estado') == 'Vigente' else 'canceladas_filtradas'] += 1
+        yield factura
+    
+    if estadisticas['paquetes']:
+        logger.info(f"Total de facturas parseadas: {estadisticas['facturas']}")
+        
+        # Si llegaron todos los paquetes el rango queda cubierto en el almacén local
+        if estadisticas['paquetes'] == len(paquetes_ids):
+            invoice_store.registrar_cobertura(rfc, tipo, estado_comprobante, fecha_ini, fecha_fin, id_solicitud)
+        
+        logger.info(f"Facturas vigentes: {conteo['vigentes']}, canceladas (filtradas): {conteo['canceladas_filtradas']}")
+
+def _parametros_listado(parametros):
+    """(formato, limite, despues_de) de los parámetros de un listado de facturas; ValueError si no son válidos"""
+    formato = (parametros.get('formato') or 'json').lower()
+    if formato not in ('json', 'ndjson'):
+        raise ValueError("El formato debe ser 'json' o 'ndjson'")
+    limite = parametros.get('limite')
+    if limite in (None, ''):
+        limite = None
+    else:
+        try:
+            limite = int(limite)
+        except (TypeError, ValueError):
+            raise ValueError('El límite debe ser un número entero')
+        if limite < 1:
+            raise ValueError('El límite debe ser mayor que cero')
+        limite = min(limite, LIMITE_PAGINA_MAXIMO)
+    cursor = parametros.get('cursor')
+    return formato, limite, invoice_store.decodificar_cursor(cursor) if cursor else None
+
+def _respuesta_ndjson(encabezado, facturas, obtener_stats, limite=None):
+    """
+    Envía una línea con el encabezado, una línea por factura (en bloques) y una línea final con
+    las estadísticas y, si se paginó y hay más, el cursor de la siguiente página
+    """
+    def generar():
+        yield json.dumps({'success': True, **encabezado}, ensure_ascii=False, default=str) + '\n'
+        bloque = []
+        entregadas = 0
+        ultima = None
+        siguiente = None
+        for factura in facturas:
+            if limite and entregadas == limite:
+                siguiente = invoice_store.codificar_cursor(ultima)
+                break
+            bloque.append(json.dumps(factura, ensure_ascii=False))
+            entregadas += 1
+            ultima = factura
+            if len(bloque) >= FACTURAS_POR_BLOQUE:
+                yield '\n'.join(bloque) + '\n'
+                bloque = []
+        if bloque:
+            yield '\n'.join(bloque) + '\n'
+        yield json.dumps({'fin': True, 'entregadas': entregadas, 'stats': obtener_stats(),
+                          'siguiente_cursor': siguiente}) + '\n'
+    
+    return Response(stream_with_context(generar()), mimetype='application/x-ndjson')
+
+def _respuesta_facturas(rfc, tipo, estado_comprobante, fecha_ini, fecha_fin, encabezado, formato='json',
+                        limite=None, despues_de=None):
+    """
+    Responde las facturas vigentes del almacén local: JSON completo, una página, o NDJSON en streaming.
+    Solo las descargadas con el mismo filtro de estado: lo bajado como canceladas no se mezcla
+    con una consulta de vigentes (el XML no dice si la factura se canceló)
+    """
+    filtro = invoice_store.clave_estado(tipo, estado_comprobante)
+    conteo = invoice_store.contar_facturas(rfc, tipo, fecha_ini, fecha_fin, filtro=filtro)
+    vigentes = conteo.get('Vigente', 0)
+    stats = {'vigentes': vigentes, 'canceladas_filtradas': sum(conteo.values()) - vigentes}
+    # Se pide una factura de más para saber si hay otra página
+    facturas = invoice_store.iterar_facturas(
+        rfc, tipo, fecha_ini, fecha_fin, estado='Vigente', despues_de=despues_de,
+        limite=limite + 1 if limite else None, filtro=filtro
+    )
+    
+    if formato == 'ndjson':
+        return _respuesta_ndjson(encabezado, facturas, lambda: stats, limite)
+    
+    facturas = list(facturas)
+    respuesta = {'success': True, **encabezado, 'facturas': facturas, 'stats': stats}
+    if limite:
+        siguiente = None
+        if len(facturas) > limite:
+            facturas.pop()
+            siguiente = invoice_store.codificar_cursor(facturas[-1])
+        respuesta['siguiente_cursor'] = siguiente
+    return jsonify(respuesta)
+
+def _respuesta_cuota_agotada(cuota, mensaje):
+    """429 con el presupuesto del RFC y cuándo se puede volver a intentar"""
+    respuesta = jsonify({
+        'success': False,
+        'error_limite': True,
+        'message': mensaje,
+        'sugerencia': 'La solicitud no se envió al SAT para no agotar las solicitudes del RFC. '
+                      'Las consultas de rangos ya descargados siguen disponibles desde el almacén local.',
+        'cod_estatus': quota.COD_CUOTA_LOCAL,
+        'cuota': cuota
+    })
+    if cuota.get('reintentar_en'):
+        segundos = (datetime.strptime(cuota['reintentar_en'], '%Y-%m-%d %H:%M:%S') - datetime.now()).total_seconds()
+        respuesta.headers['Retry-After'] = str(max(int(segundos), 1))
+    return respuesta, 429
+
+def _obtener_job_autorizado(job_id):
+    """Regresa (job, respuesta_error); solo el usuario que creó el job puede consultarlo"""
+    job = jobs.obtener_job(job_id)
+    if not job:
+        return None, (jsonify({
+            'success': False,
+            'message': 'No existe el job solicitado'
+        }), 404)
+    if job['usuario_id'] is not None and job['usuario_id'] != session.get('usuario_id'):
+        return None, (jsonify({
+            'success': False,
+            'message': 'No tienes acceso a este job'
+        }), 403)
+    return job, None
+
+@app.route('/api/descargas/<job_id>', methods=['GET'])
+def estado_descarga(job_id):
+    """Consulta el estado de un job de descarga"""
+    job, error = _obtener_job_autorizado(job_id)
+    if error:
+        return error
+    return jsonify({
+        'success': True,
+        'job': job
+    })
+
+@app.route('/api/descargas/<job_id>/facturas', methods=['GET'])
+def facturas_descarga(job_id):
+    """Obtiene las facturas de un job completado (o parcial)"""
+    job, error = _obtener_job_autorizado(job_id)
+    if error:
+        return error
+    # En un job parcial las ventanas completadas ya están en el almacén; el job indica cuáles fallaron
+    if job['estado'] not in (jobs.COMPLETADO, jobs.PARCIAL):
+        return jsonify({
+            'success': False,
+            'estado': job['estado'],
+            'message': 'La descarga aún no termina' if job['estado'] != jobs.ERROR else (job['mensaje'] or 'La descarga falló')
+        }), 409
+    
+    try:
+        formato, limite, despues_de = _parametros_listado(request.args)
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
+    
+    fecha_ini, fecha_fin = jobs.rango_de_job(job)
+    return _respuesta_facturas(
+        job['rfc'],
+        job['tipo'],
+        job['estado_comprobante'],
+        fecha_ini,
+        fecha_fin,
+        {'job_id': job_id, 'id_solicitud': job['id_solicitud'], 'estado': job['estado'], 'mensaje': job['mensaje']},
+        formato, limite, despues_de
+    )
+
+def _rfc_autorizado(rfc):
+    """
+    Solo quien hace la petición: el usuario con datos fiscales guardados del RFC o que subió sus
+    certificados con sesión iniciada, o la misma sesión (sin cuenta) en la que se subieron.
+    Saber el RFC no basta: aparece impreso en cada CFDI
+    """
+    if rfc in session.get('rfcs_subidos', ()):
+        return True
+    usuario_id = session.get('usuario_id')
+    if usuario_id is None:
+        return False
+    if database.obtener_datos_fiscales(usuario_id, rfc)['success']:
+        return True
+    return shared_state.usuario_de_certificados(rfc) == usuario_id
+
+def _error_acceso_rfc(rfc, requiere_login=False):
+    """Respuesta de error si quien pide no tiene acceso al RFC, o None si lo tiene"""
+    if requiere_login and 'usuario_id' not in session:
+        return jsonify({
+            'success': False,
+            'message': 'Inicia sesión para consultar las facturas guardadas de un RFC'
+        }), 401
+    if not _rfc_autorizado(rfc):
+        return jsonify({
+            'success': False,
+            'message': 'No tienes acceso a este RFC'
+        }), 403
+    return None
+
+def _respuesta_exportacion(rfc, tipo, fecha_ini, fecha_fin, parametros, nombre, filtro=None):
+    """
+    Descarga en CSV o XLSX (streaming) de las facturas del almacén local de un rango
+    (solo las descargadas con el filtro de estado dado, si lo hay)
+    """
+    formato = (parametros.get('formato') or 'csv').lower()
+    if formato not in exporter.TIPOS_CONTENIDO:
+        return jsonify({
+            'success': False,
+            'message': "El formato debe ser 'csv' o 'xlsx'"
+        }), 400
+    try:
+        columnas = exporter.elegir_columnas(parametros.get('columnas'))
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
+    # Por defecto solo vigentes, igual que la consulta; estado=todas incluye las canceladas
+    estado = None if parametros.get('estado') == 'todas' else 'Vigente'
+    
+    facturas = invoice_store.iterar_facturas(rfc, tipo, fecha_ini, fecha_fin, estado=estado, filtro=filtro)
+    respuesta = Response(
+        stream_with_context(exporter.exportar(facturas, formato, columnas)),
+        mimetype=exporter.TIPOS_CONTENIDO[formato]
+    )
+    respuesta.headers['Content-Disposition'] = f'attachment; filename="{nombre}.{formato}"'
+    return respuesta
+
+@app.route('/api/exportar-facturas', methods=['GET'])
+def exportar_facturas():
+    """Exporta a CSV o XLSX las facturas ya descargadas de un RFC (almacén local)"""
+    rfc = request.args.get('rfc')
+    tipo = request.args.get('tipo')
+    fecha_inicial = request.args.get('fechaInicial')
+    fecha_final = request.args.get('fechaFinal')
+    if not all([rfc, tipo, fecha_inicial, fecha_final]):
+        return jsonify({
+            'success': False,
+            'message': 'Faltan datos: rfc, tipo, fechaInicial y fechaFinal son obligatorios'
+        }), 400
+    error = _error_acceso_rfc(rfc, requiere_login=True)
+    if error:
+        return error
+    try:
+        fecha_ini = datetime.strptime(fecha_inicial, '%Y-%m-%d')
+        # Mismo rango que /api/consultar-facturas con las mismas fechas
+        fecha_fin = datetime.strptime(fecha_final, '%Y-%m-%d')
+    except ValueError:
+        return jsonify({
+            'success': False,
+            'message': 'Las fechas deben tener formato AAAA-MM-DD'
+        }), 400
+    
+    return _respuesta_exportacion(rfc, tipo, fecha_ini, fecha_fin, request.args,
+                                  f'facturas_{tipo}_{rfc}_{fecha_inicial}_{fecha_final}')
+
+@app.route('/api/descargas/<job_id>/exportar', methods=['GET'])
+def exportar_descarga(job_id):
+    """Exporta a CSV o XLSX las facturas de un job completado (o parcial)"""
+    job, error = _obtener_job_autorizado(job_id)
+    if error:
+        return error
+    if job['estado'] not in (jobs.COMPLETADO, jobs.PARCIAL):
+        return jsonify({
+            'success': False,
+            'estado': job['estado'],
+            'message': 'La descarga aún no termina'
+        }), 409
+    
+    fecha_ini, fecha_fin = jobs.rango_de_job(job)
+    return _respuesta_exportacion(job['rfc'], job['tipo'], fecha_ini, fecha_fin, request.args,
+                                  f"facturas_{job['tipo']}_{job['rfc']}_{job_id}",
+                                  filtro=invoice_store.clave_estado(job['tipo'], job['estado_comprobante']))
+
+@app.route('/api/buscar-facturas', methods=['GET'])
+def buscar_facturas():
+    """
+    Búsqueda en las facturas almacenadas de un RFC: texto libre (q) sobre nombres, RFC, serie y folio,
+    más filtros por tipo, fechas (desde/hasta), total (totalMin/totalMax), contraparte, moneda,
+    tipoComprobante y estado. Regresa una página, el total y conteos por faceta (solo en la primera
+    página: con cursor total y facetas vienen en null, ya se tienen de la primera).
+    """
+    rfc = request.args.get('rfc')
+    if not rfc:
+        return jsonify({
+            'success': False,
+            'message': 'Falta el RFC'
+        }), 400
+    error = _error_acceso_rfc(rfc, requiere_login=True)
+    if error:
+        return error
+    
+    filtros = {campo: request.args.get(campo) for campo in (
+        'q', 'tipo', 'desde', 'hasta', 'contraparte', 'serie', 'folio', 'moneda', 'tipoComprobante', 'estado'
+    )}
+    try:
+        for campo in ('totalMin', 'totalMax'):
+            valor = request.args.get(campo)
+            filtros[campo] = float(valor) if valor not in (None, '') else None
+        limite = int(request.args.get('limite') or 50)
+        cursor = request.args.get('cursor')
+        despues_de = invoice_store.decodificar_cursor(cursor) if cursor else None
+    except ValueError:
+        return jsonify({
+            'success': False,
+            'message': 'Parámetros de búsqueda inválidos (totalMin, totalMax, limite o cursor)'
+        }), 400
+    
+    resultado = invoice_search.buscar(
+        rfc, filtros, limite=max(limite, 1), despues_de=despues_de,
+        descendente=request.args.get('orden', 'desc') != 'asc', contar=despues_de is None
+    )
+    return jsonify({'success': True, **resultado})
+
+@app.route('/api/xml/<rfc>/<uuid>', methods=['GET'])
+def obtener_xml(rfc, uuid):
+    """Regresa el XML original de una factura desde el archivo local"""
+    error = _error_acceso_rfc(rfc, requiere_login=True)
+    if error:
+        return error
+    xml = xml_archive.obtener_xml(rfc, uuid)
+    if xml is None:
+        return jsonify({
+            'success': False,
+            'message': 'El XML no está en el archivo local; vuelve a descargar el período que lo contiene'
+        }), 404
+    respuesta = Response(xml, mimetype='application/xml')
+    respuesta.headers['Content-Disposition'] = f'inline; filename="{uuid.upper()}.xml"'
+    return respuesta
+
+@app.route('/api/xml/<rfc>', methods=['POST'])
+def exportar_xmls(rfc):
+    """ZIP con los XML originales de varios UUID ({"uuids": [...]}) desde el archivo local"""
+    error = _error_acceso_rfc(rfc, requiere_login=True)
+    if error:
+        return error
+    uuids = (request.json or {}).get('uuids')
+    if not uuids or not isinstance(uuids, list):
+        return jsonify({
+            'success': False,
+            'message': 'Se requiere la lista de uuids'
+        }), 400
+    
+    respuesta = Response(stream_with_context(xml_archive.exportar_zip(rfc, uuids)), mimetype='application/zip')
+    respuesta.headers['Content-Disposition'] = f'attachment; filename="xml_{rfc}.zip"'
+    return respuesta
+
+@app.route('/api/cuota/<rfc>', methods=['GET'])
+def consultar_cuota(rfc):
+    """Consulta cuántas solicitudes al SAT le quedan a un RFC"""
+    error = _error_acceso_rfc(rfc)
+    if error:
+        return error
+    
+    return jsonify({
+        'success': True,
+        'cuota': quota.obtener_cuota(rfc)
+    })
+
 @app.route('/api/subir-certificados', methods=['POST'])
 def subir_certificados():
     """Endpoint para subir certificados del SAT"""
     try:
-        print(f"📨 Recibiendo solicitud de subir certificados...")
-        print(f"Form data: {request.form}")
-        print(f"Files: {request.files}")
         
         rfc = request.form.get('rfc')
         password = request.form.get('password')
         cert_file = request.files.get('certificado')
         key_file = request.files.get('llave')
         
-        print(f"RFC: {rfc}")
-        print(f"Password: {'***' if password else 'None'}")
-        print(f"Certificado: {cert_file.filename if cert_file else 'None'}")
-        print(f"Llave: {key_file.filename if key_file else 'None'}")
+        logger.info(f"Subiendo certificados para RFC: {rfc}",
+                    extra={'datos': {'certificado': cert_file.filename if cert_file else None,
+                                     'password': bool(password)}})
         
         if not all([rfc, password, cert_file, key_file]):
             missing = []
@@ -747,7 +1291,7 @@ def subir_certificados():
             if not key_file: missing.append('llave')
             
             error_msg = f'Faltan: {", ".join(missing)}'
-            print(f"❌ {error_msg}")
+            logger.warning(error_msg)
             
             return jsonify({
                 'success': False,
@@ -761,10 +1305,11 @@ def subir_certificados():
         cert_path = f'certificados/{rfc}.cer'
         key_path = f'certificados/{rfc}.key'
         
+        fiel_cache.invalidar(key_path)
         cert_file.save(cert_path)
         key_file.save(key_path)
         
-        print(f"📁 Certificados guardados para RFC: {rfc}")
+        logger.info(f"Certificados guardados para RFC: {rfc}")
         
         # Crear cliente SAT
         client = SATClient(rfc, cert_path, key_path, password)
@@ -779,8 +1324,13 @@ def subir_certificados():
                 'message': 'Certificados o contraseña inválidos'
             }), 400
         
-        # Guardar cliente en memoria
-        sat_clients[rfc] = client
+        # Guardar cliente en memoria (reemplaza al anterior del mismo RFC) y publicar los
+        # certificados para que los demás workers puedan crear el suyo
+        sat_clients.registrar(rfc, client)
+        shared_state.registrar_certificados(rfc, cert_path, key_path, password,
+                                            usuario_id=session.get('usuario_id'))
+        # Quien subió una FIEL válida puede consultar el RFC desde esta sesión
+        session['rfcs_subidos'] = sorted(set(session.get('rfcs_subidos', [])) | {rfc})
         
         return jsonify({
             'success': True,
@@ -788,9 +1338,7 @@ def subir_certificados():
         })
         
     except Exception as e:
-        print(f"❌ Error al subir certificados: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception(f"Error al subir certificados: {e}")
         return jsonify({
             'success': False,
             'message': f'Error al procesar certificados: {str(e)}'
@@ -804,31 +1352,30 @@ def subir_certificados():
 def register():
     """Registrar nuevo usuario"""
     try:
-        print("📝 Recibiendo solicitud de registro...")
         data = request.get_json()
-        print(f"Datos recibidos: {data}")
+        logger.debug("Datos recibidos", extra={'datos': data})
         
         nombre = data.get('nombre')
         email = data.get('email')
         telefono = data.get('telefono')
         password = data.get('password')
         
-        print(f"Nombre: {nombre}, Email: {email}, Telefono: {telefono}")
         
         if not all([nombre, email, password]):
-            print("❌ Faltan datos requeridos")
+            logger.warning("Faltan datos requeridos")
             return jsonify({
                 'success': False,
                 'message': 'Faltan datos requeridos'
             }), 400
         
-        print(f"🔐 Intentando registrar usuario: {email}")
+        logger.info(f"Intentando registrar usuario: {email}")
         resultado = database.registrar_usuario(nombre, email, telefono, password)
         
         if resultado['success']:
             usuario_id = resultado['usuario_id']
-            # Limpiar sesión anterior
+            # Limpiar sesión anterior y cambiar su id: un id fijado antes del login no queda autenticado
             session.clear()
+            app.session_interface.regenerar(session)
             # Crear sesión permanente
             session.permanent = True
             session['usuario_id'] = usuario_id
@@ -836,8 +1383,7 @@ def register():
             session['nombre'] = nombre
             session.modified = True  # Forzar guardado de sesión
             
-            print(f"✅ Usuario registrado exitosamente: ID {usuario_id}")
-            print(f"Session guardada: {dict(session)}")
+            logger.info(f"Usuario registrado exitosamente: ID {usuario_id}")
             
             return jsonify({
                 'success': True,
@@ -845,16 +1391,14 @@ def register():
                 'usuario_id': usuario_id
             })
         else:
-            print(f"⚠️ Error en registro: {resultado.get('message', 'Error desconocido')}")
+            logger.warning(f"Error en registro: {resultado.get('message', 'Error desconocido')}")
             return jsonify({
                 'success': False,
                 'message': resultado.get('message', 'Error al registrar usuario')
             }), 400
             
     except Exception as e:
-        print(f"❌ Error al registrar usuario: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception(f"Error al registrar usuario: {e}")
         return jsonify({
             'success': False,
             'message': f'Error al registrar: {str(e)}'
@@ -864,27 +1408,25 @@ def register():
 def login():
     """Iniciar sesión"""
     try:
-        print("🔑 Recibiendo solicitud de login...")
         data = request.get_json()
         email = data.get('email')
         password = data.get('password')
         
-        print(f"Email: {email}")
         
         if not all([email, password]):
-            print("❌ Faltan credenciales")
+            logger.warning("Faltan credenciales")
             return jsonify({
                 'success': False,
                 'message': 'Email y contraseña son requeridos'
             }), 400
         
         resultado = database.validar_login(email, password)
-        print(f"Resultado validación: {resultado}")
         
         if resultado.get('success'):
             usuario = resultado['usuario']
-            # Limpiar sesión anterior
+            # Limpiar sesión anterior y cambiar su id: un id fijado antes del login no queda autenticado
             session.clear()
+            app.session_interface.regenerar(session)
             # Crear sesión permanente
             session.permanent = True
             session['usuario_id'] = usuario['id']
@@ -892,9 +1434,7 @@ def login():
             session['nombre'] = usuario['nombre']
             session.modified = True  # Forzar guardado de sesión
             
-            print(f"✅ Login exitoso para: {email}")
-            print(f"Session guardada: {dict(session)}")
-            print(f"Session ID: {session.get('_id', 'No ID')}")
+            logger.info(f"Login exitoso para: {email}")
             
             return jsonify({
                 'success': True,
@@ -902,16 +1442,14 @@ def login():
                 'usuario': usuario
             })
         else:
-            print(f"⚠️ Login fallido para: {email}")
+            logger.warning(f"Login fallido para: {email}")
             return jsonify({
                 'success': False,
                 'message': resultado.get('message', 'Email o contraseña incorrectos')
             }), 401
             
     except Exception as e:
-        print(f"❌ Error al iniciar sesión: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception(f"Error al iniciar sesión: {e}")
         return jsonify({
             'success': False,
             'message': f'Error al iniciar sesión: {str(e)}'
@@ -920,22 +1458,53 @@ def login():
 # Middleware para debuggear cookies y sesión
 @app.before_request
 def log_request_info():
-    print(f"\n{'='*60}")
-    print(f"📨 REQUEST: {request.method} {request.path}")
-    print(f"Origin: {request.headers.get('Origin', 'No origin')}")
-    print(f"Cookies recibidas: {dict(request.cookies)}")
-    print(f"Session antes: {dict(session)}")
-    print(f"{'='*60}\n")
+    metrics.asegurar_publicador()
+    metrics.HTTP_EN_CURSO.sumar(1)
+    g.inicio_peticion = time.perf_counter()
+    # El detalle (cookies, sesión) solo se arma para una muestra de requests con DEBUG activo
+    g.registrar_detalle = logging_setup.muestrear(logger)
+    if g.registrar_detalle:
+        logger.debug(f"REQUEST: {request.method} {request.path}", extra={'datos': {
+            'origin': request.headers.get('Origin'),
+            'cookies': dict(request.cookies),
+            'sesion': dict(session)
+        }})
 
 @app.after_request
 def log_response_info(response):
-    print(f"\n{'='*60}")
-    print(f"📤 RESPONSE: {response.status}")
-    print(f"Set-Cookie headers: {response.headers.getlist('Set-Cookie')}")
-    print(f"Session después: {dict(session)}")
-    print(f"{'='*60}\n")
+    if g.get('registrar_detalle'):
+        logger.debug(f"RESPONSE: {response.status} {request.method} {request.path}", extra={'datos': {
+            'set_cookie': response.headers.getlist('Set-Cookie'),
+            'sesion': dict(session)
+        }})
+    g.codigo_respuesta = response.status_code
     return response
 
+@app.teardown_request
+def medir_peticion(error=None):
+    # teardown corre aunque la vista lance una excepción (after_request no)
+    if 'inicio_peticion' not in g:
+        return
+    metrics.HTTP_EN_CURSO.sumar(-1)
+    metrics.HTTP_SEGUNDOS.observar(
+        time.perf_counter() - g.inicio_peticion,
+        request.url_rule.rule if request.url_rule else 'sin_ruta',
+        request.method,
+        g.get('codigo_respuesta', 500)
+    )
+
+@app.route('/metrics', methods=['GET'])
+def metricas():
+    """Métricas de la API y del SAT en formato de texto de Prometheus (ver metrics.py)"""
+    if metrics.METRICAS_TOKEN and not hmac.compare_digest(
+        request.headers.get('Authorization', ''), f'Bearer {metrics.METRICAS_TOKEN}'
+    ):
+        return jsonify({
+            'success': False,
+            'message': 'No autorizado'
+        }), 401
+    return Response(metrics.exponer(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 @app.route('/api/logout', methods=['POST'])
 def logout():
     """Cerrar sesión"""
@@ -948,12 +1517,9 @@ def logout():
 @app.route('/api/session', methods=['GET'])
 def check_session():
     """Verificar si hay sesión activa"""
-    print(f"🔍 Verificando sesión...")
-    print(f"Session data: {dict(session)}")
-    print(f"¿Tiene usuario_id?: {'usuario_id' in session}")
     
     if 'usuario_id' in session:
-        print(f"✅ Sesión activa para usuario: {session.get('email')}")
+        logger.debug("Sesión activa para usuario: %s", session.get('email'))
         return jsonify({
             'success': True,
             'logged_in': True,
@@ -961,7 +1527,7 @@ def check_session():
             'email': session['email']
         })
     else:
-        print(f"❌ No hay sesión activa")
+        logger.debug("No hay sesión activa")
         return jsonify({
             'success': True,
             'logged_in': False
@@ -979,7 +1545,7 @@ def guardar_fiscales():
             }), 401
         
         usuario_id = session['usuario_id']
-        print(f"💾 Guardando datos fiscales para usuario {usuario_id}...")
+        logger.info(f"Guardando datos fiscales para usuario {usuario_id}...")
         
         # Obtener datos del formulario
         rfc = request.form.get('rfc')
@@ -987,9 +1553,7 @@ def guardar_fiscales():
         cert_file = request.files.get('certificado')
         key_file = request.files.get('llave')
         
-        print(f"💾 RFC: {rfc}")
-        print(f"💾 Certificado: {cert_file.filename if cert_file else 'None'}")
-        print(f"💾 Llave: {key_file.filename if key_file else 'None'}")
+        logger.debug("Datos fiscales recibidos", extra={'datos': {'rfc': rfc, 'certificado': cert_file.filename if cert_file else None}})
         
         if not all([rfc, password, cert_file, key_file]):
             return jsonify({
@@ -1008,7 +1572,7 @@ def guardar_fiscales():
         cert_data = cert_file.read()
         key_data = key_file.read()
         
-        print(f"💾 Datos leídos - Cert: {len(cert_data)} bytes, Key: {len(key_data)} bytes")
+        logger.debug("Datos leídos - Cert: %s bytes, Key: %s bytes", len(cert_data), len(key_data))
         
         # Guardar datos fiscales
         resultado = database.guardar_datos_fiscales(
@@ -1019,9 +1583,12 @@ def guardar_fiscales():
             password
         )
         
-        print(f"💾 Resultado: {resultado}")
+        logger.info(f"Resultado: {resultado.get('message')}")
         
         if resultado['success']:
+            # Los archivos se sobrescribieron: la FIEL y el cliente anteriores ya no aplican
+            fiel_cache.invalidar(resultado['llave_path'])
+            sat_clients.descartar(rfc)
             return jsonify({
                 'success': True,
                 'message': 'Datos fiscales guardados correctamente'
@@ -1033,9 +1600,7 @@ def guardar_fiscales():
             }), 500
             
     except Exception as e:
-        print(f"❌ Error al guardar datos fiscales: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception(f"Error al guardar datos fiscales: {e}")
         return jsonify({
             'success': False,
             'message': f'Error al guardar datos: {str(e)}'
@@ -1046,62 +1611,37 @@ def obtener_fiscales():
     """Obtener datos fiscales guardados del usuario"""
     try:
         # Debug: Imprimir toda la sesión
-        print(f"🔍 DEBUG - Session completa: {dict(session)}")
-        print(f"🔍 DEBUG - Cookies recibidas: {request.cookies}")
-        print(f"🔍 DEBUG - Headers: {dict(request.headers)}")
-        
         # Verificar sesión
         if 'usuario_id' not in session:
-            print("❌ No hay usuario_id en sesión")
+            logger.debug("No hay usuario_id en sesión")
             return jsonify({
                 'success': False,
                 'message': 'Debes iniciar sesión'
             }), 401
         
         usuario_id = session['usuario_id']
-        print(f"📊 Obteniendo datos fiscales para usuario {usuario_id}...")
-        
-        # Debug: Verificar directamente en la BD
-        import sqlite3
-        print(f"🔍 DEBUG - Verificando BD directamente desde server.py")
-        print(f"🔍 DEBUG - DB_PATH: {database.DB_PATH}")
-        try:
-            conn = sqlite3.connect(database.DB_PATH, timeout=30)
-            cursor = conn.cursor()
-            cursor.execute('SELECT usuario_id, rfc, certificado_path FROM datos_fiscales')
-            todos_registros = cursor.fetchall()
-            print(f"🔍 DEBUG - TODOS los registros en datos_fiscales: {todos_registros}")
-            cursor.execute('SELECT usuario_id, rfc FROM datos_fiscales WHERE usuario_id = ?', (usuario_id,))
-            registros_usuario = cursor.fetchall()
-            print(f"🔍 DEBUG - Registros para usuario {usuario_id}: {registros_usuario}")
-            conn.close()
-        except Exception as db_error:
-            print(f"❌ DEBUG - Error verificando BD: {db_error}")
+        logger.debug("Obteniendo datos fiscales para usuario %s", usuario_id)
         
-        print(f"🔍 DEBUG - Llamando a database.obtener_datos_fiscales({usuario_id})...")
         resultado = database.obtener_datos_fiscales(usuario_id)
-        print(f"📊 Resultado de la consulta: {resultado}")
         
         if resultado['success']:
             # La función devuelve {'success': True, 'datos': [...]}
             datos = resultado.get('datos', [])
-            print(f"✅ {len(datos)} RFCs encontrados")
+            logger.debug("%s RFCs encontrados", len(datos))
             
             return jsonify({
                 'success': True,
                 'datos_fiscales': datos
             })
         else:
-            print(f"❌ No se encontraron datos fiscales: {resultado.get('message')}")
+            logger.info(f"No se encontraron datos fiscales: {resultado.get('message')}")
             return jsonify({
                 'success': True,
                 'datos_fiscales': []
             })
         
     except Exception as e:
-        print(f"❌ Error al obtener datos fiscales: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception(f"Error al obtener datos fiscales: {e}")
         return jsonify({
             'success': False,
             'message': f'Error al obtener datos: {str(e)}'
@@ -1110,5 +1650,5 @@ def obtener_fiscales():
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5001))
     debug = os.environ.get('DEBUG', 'True') == 'True'
-    print(f"🚀 Servidor SAT iniciado en puerto {port}")
+    logger.info(f"Servidor SAT iniciado en puerto {port}")
     app.run(debug=debug, host='0.0.0.0', port=port)
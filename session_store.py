@@ -0,0 +1,209 @@
+import logging
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from itsdangerous import BadSignature, Signer
+from werkzeug.datastructures import CallbackDict
+import database
+
+logger = logging.getLogger(__name__)
+
+# 'sqlite' (compartido entre los workers de un mismo host) o 'memoria' (LRU dentro del proceso)
+BACKEND_SESION = os.environ.get('SESSION_BACKEND', 'sqlite')
+# Sesiones que conserva el backend en memoria antes de descartar las menos usadas
+MAX_SESIONES_MEMORIA = int(os.environ.get('SESSION_MAX_MEMORIA', 10000))
+INTERVALO_LIMPIEZA = int(os.environ.get('SESSION_INTERVALO_LIMPIEZA', 600))  # segundos
+# Una sesión sin cambios solo se vuelve a escribir para extender su vigencia cuando ya
+# pasó esta fracción de PERMANENT_SESSION_LIFETIME desde la última escritura
+FRACCION_RENOVACION = 0.1
+
+_serializador = TaggedJSONSerializer()
+
+class SesionServidor(CallbackDict, SessionMixin):
+    """Sesión cuyo contenido vive en el servidor; la cookie solo lleva el id firmado"""
+
+    def __init__(self, datos=None, sid=None, nueva=False, expira=None):
+        def al_modificar(_):
+            self.modified = True
+        super().__init__(datos, al_modificar)
+        self.sid = sid
+        self.new = nueva
+        self.expira = expira
+        self.modified = False
+
+class AlmacenSqlite:
+    """Sesiones en la base de SQLite; los workers del mismo host ven las mismas sesiones"""
+
+    def __init__(self):
+        conn = database.obtener_conexion()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS sesiones (
+                id TEXT PRIMARY KEY,
+                datos TEXT NOT NULL,
+                expira REAL NOT NULL
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_sesiones_expira ON sesiones (expira)')
+        conn.commit()
+
+    def obtener(self, sid):
+        row = database.obtener_conexion().execute(
+            'SELECT datos, expira FROM sesiones WHERE id = ? AND expira > ?', (sid, time.time())
+        ).fetchone()
+        return (row[0], row[1]) if row else None
+
+    def guardar(self, sid, datos, expira):
+        with database.obtener_conexion() as conn:
+            conn.execute('''
+                INSERT INTO sesiones (id, datos, expira) VALUES (?, ?, ?)
+                ON CONFLICT(id) DO UPDATE SET datos = excluded.datos, expira = excluded.expira
+            ''', (sid, datos, expira))
+
+    def borrar(self, sid):
+        with database.obtener_conexion() as conn:
+            conn.execute('DELETE FROM sesiones WHERE id = ?', (sid,))
+
+    def limpiar(self):
+        with database.obtener_conexion() as conn:
+            return conn.execute('DELETE FROM sesiones WHERE expira <= ?', (time.time(),)).rowcount
+
+class AlmacenMemoria:
+    """Sesiones en un LRU del proceso: sin I/O, pero cada worker tiene las suyas"""
+
+    def __init__(self, maximo=MAX_SESIONES_MEMORIA):
+        self.maximo = maximo
+        self._sesiones = OrderedDict()
+        self._lock = threading.Lock()
+
+    def obtener(self, sid):
+        with self._lock:
+            entrada = self._sesiones.get(sid)
+            if entrada is None:
+                return None
+            if entrada[1] <= time.time():
+                del self._sesiones[sid]
+                return None
+            self._sesiones.move_to_end(sid)
+            return entrada
+
+    def guardar(self, sid, datos, expira):
+        with self._lock:
+            self._sesiones[sid] = (datos, expira)
+            self._sesiones.move_to_end(sid)
+            while len(self._sesiones) > self.maximo:
+                self._sesiones.popitem(last=False)
+
+    def borrar(self, sid):
+        with self._lock:
+            self._sesiones.pop(sid, None)
+
+    def limpiar(self):
+        ahora = time.time()
+        with self._lock:
+            vencidas = [sid for sid, (_, expira) in self._sesiones.items() if expira <= ahora]
+            for sid in vencidas:
+                del self._sesiones[sid]
+        return len(vencidas)
+
+class InterfazSesion(SessionInterface):
+    """SessionInterface de Flask sobre un almacén con vigencia (TTL) por sesión"""
+
+    def __init__(self, almacen, intervalo_limpieza=INTERVALO_LIMPIEZA):
+        self.almacen = almacen
+        self.intervalo_limpieza = intervalo_limpieza
+        self._pid_limpieza = None
+        self._lock = threading.Lock()
+
+    def _asegurar_limpieza(self):
+        # El hilo se arranca en el proceso que atiende requests (no sobrevive a un fork con --preload)
+        if self._pid_limpieza == os.getpid():
+            return
+        with self._lock:
+            if self._pid_limpieza != os.getpid():
+                self._pid_limpieza = os.getpid()
+                threading.Thread(
+                    target=_limpiar_periodicamente, args=(self.almacen, self.intervalo_limpieza),
+                    name='limpieza-sesiones', daemon=True
+                ).start()
+
+    def _firmador(self, app):
+        return Signer(app.secret_key, salt='sat-session', key_derivation='hmac')
+
+    def open_session(self, app, request):
+        self._asegurar_limpieza()
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if cookie:
+            try:
+                sid = self._firmador(app).unsign(cookie).decode()
+            except BadSignature:
+                sid = None
+            entrada = self.almacen.obtener(sid) if sid else None
+            if entrada:
+                return SesionServidor(_serializador.loads(entrada[0]), sid=sid, expira=entrada[1])
+        return SesionServidor(sid=secrets.token_urlsafe(32), nueva=True)
+
+    def regenerar(self, session):
+        """
+        Da un id nuevo a la sesión al cambiar de privilegios (login) para evitar fijación de sesión:
+        el registro del id anterior se borra y al guardar la sesión se firma la cookie con el nuevo
+        """
+        if not session.new:
+            self.almacen.borrar(session.sid)
+        session.sid = secrets.token_urlsafe(32)
+        session.modified = True
+
+    def save_session(self, app, session, response):
+        nombre = self.get_cookie_name(app)
+        dominio = self.get_cookie_domain(app)
+        ruta = self.get_cookie_path(app)
+
+        # Sesión vaciada (logout): se borra del almacén y del navegador
+        if not session:
+            if session.modified and not session.new:
+                self.almacen.borrar(session.sid)
+                response.delete_cookie(nombre, domain=dominio, path=ruta)
+            return
+
+        vigencia = app.permanent_session_lifetime.total_seconds()
+        ahora = time.time()
+        # Sin cambios y escrita hace poco: ni escritura al almacén ni Set-Cookie
+        renovar = session.expira is None or session.expira - ahora < vigencia * (1 - FRACCION_RENOVACION)
+        if not (session.modified or session.new or renovar):
+            return
+        if app.config.get('SESSION_PERMANENT', True) and not session.permanent:
+            session.permanent = True
+
+        self.almacen.guardar(session.sid, _serializador.dumps(dict(session)), ahora + vigencia)
+        response.set_cookie(
+            nombre,
+            self._firmador(app).sign(session.sid).decode(),
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=dominio,
+            path=ruta,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+            partitioned=self.get_cookie_partitioned(app)
+        )
+
+def _limpiar_periodicamente(almacen, intervalo):
+    while True:
+        time.sleep(intervalo)
+        try:
+            borradas = almacen.limpiar()
+            if borradas:
+                logger.info(f"Sesiones vencidas eliminadas: {borradas}")
+        except Exception as e:
+            logger.error(f"Error al limpiar sesiones: {e}")
+
+def configurar_sesiones(app, backend=None):
+    """Instala el almacén de sesiones en la app; la limpieza de vencidas corre en segundo plano"""
+    backend = backend or BACKEND_SESION
+    almacen = AlmacenMemoria() if backend == 'memoria' else AlmacenSqlite()
+    app.session_interface = InterfazSesion(almacen)
+    logger.info(f"Sesiones en backend '{backend}'")
+    return almacen
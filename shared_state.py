@@ -0,0 +1,171 @@
+import logging
+import os
+import time
+import database
+import fiel_cache
+
+logger = logging.getLogger(__name__)
+
+# Segundos que un worker puede tardar autenticando antes de que otro lo intente por su cuenta
+DURACION_RECLAMO = int(os.environ.get('SAT_TOKEN_RECLAMO', 30))
+# Cada cuánto revisa un worker en espera si ya se publicó el token
+INTERVALO_ESPERA = 0.25
+
+def init_db():
+    """Crea las tablas de estado compartido entre los workers del mismo host"""
+    conn = database.obtener_conexion()
+    cursor = conn.cursor()
+    # Token vigente por RFC y, mientras alguien autentica, hasta cuándo le pertenece la renovación
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS tokens_sat (
+            rfc TEXT PRIMARY KEY,
+            token TEXT,
+            emitido REAL,
+            expira REAL,
+            reclamado_hasta REAL DEFAULT 0
+        )
+    ''')
+    # Certificados subidos con /api/subir-certificados, para que cualquier worker cree el cliente
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS certificados_subidos (
+            rfc TEXT PRIMARY KEY,
+            certificado_path TEXT NOT NULL,
+            llave_path TEXT NOT NULL,
+            password_cifrado BLOB NOT NULL,
+            usuario_id INTEGER,
+            fecha_subida TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.commit()
+    # Quién subió los certificados (para autorizar el acceso a los datos del RFC); las filas
+    # anteriores quedan sin dueño y no autorizan a nadie
+    with database.cambio_de_esquema(conn):
+        columnas = {row[1] for row in cursor.execute('PRAGMA table_info(certificados_subidos)')}
+        if 'usuario_id' not in columnas:
+            cursor.execute('ALTER TABLE certificados_subidos ADD COLUMN usuario_id INTEGER')
+    # fiel_cache.init_db() ya corrió: sin clave maestra las contraseñas se guardan tal cual
+    if not fiel_cache.cifrado_activo():
+        logger.warning("FIEL_CACHE_CLAVE no está configurada (o es inválida): la contraseña de las "
+                       "FIEL subidas se guarda SIN cifrar en certificados_subidos")
+    logger.info("Estado compartido entre workers inicializado")
+
+class TokenCompartido:
+    """Token del SAT de un RFC publicado en SQLite para todos los workers (ver sat_token.GestorToken)"""
+
+    def __init__(self, rfc, duracion_reclamo=DURACION_RECLAMO):
+        self.rfc = rfc
+        self.duracion_reclamo = duracion_reclamo
+        self._reclamado = False
+
+    def leer(self):
+        """(token, emitido, expira) publicado para el RFC, o None"""
+        try:
+            row = database.obtener_conexion().execute(
+                'SELECT token, emitido, expira FROM tokens_sat WHERE rfc = ? AND token IS NOT NULL', (self.rfc,)
+            ).fetchone()
+            return tuple(row) if row else None
+        except Exception as e:
+            logger.error(f"Error al leer token compartido de {self.rfc}: {e}")
+            return None
+
+    def publicar(self, token, emitido, expira):
+        try:
+            with database.obtener_conexion() as conn:
+                conn.execute('''
+                    INSERT INTO tokens_sat (rfc, token, emitido, expira) VALUES (?, ?, ?, ?)
+                    ON CONFLICT(rfc) DO UPDATE SET token = excluded.token, emitido = excluded.emitido,
+                                                   expira = excluded.expira
+                ''', (self.rfc, token, emitido, expira))
+        except Exception as e:
+            logger.error(f"Error al publicar token de {self.rfc}: {e}")
+
+    def descartar(self, token):
+        """Borra el token publicado solo si sigue siendo el que el SAT rechazó"""
+        try:
+            with database.obtener_conexion() as conn:
+                conn.execute('UPDATE tokens_sat SET token = NULL WHERE rfc = ? AND token = ?', (self.rfc, token))
+        except Exception as e:
+            logger.error(f"Error al descartar token de {self.rfc}: {e}")
+
+    def reclamar(self):
+        """True si este worker se queda con la renovación (nadie más la tiene o la suya venció)"""
+        ahora = time.time()
+        try:
+            with database.obtener_conexion() as conn:
+                conn.execute('INSERT OR IGNORE INTO tokens_sat (rfc) VALUES (?)', (self.rfc,))
+                cursor = conn.execute(
+                    'UPDATE tokens_sat SET reclamado_hasta = ? WHERE rfc = ? AND reclamado_hasta < ?',
+                    (ahora + self.duracion_reclamo, self.rfc, ahora)
+                )
+            self._reclamado = cursor.rowcount == 1
+        except Exception as e:
+            logger.error(f"Error al reclamar renovación de token de {self.rfc}: {e}")
+            self._reclamado = False
+        return self._reclamado
+
+    def liberar(self):
+        if not self._reclamado:
+            return
+        self._reclamado = False
+        try:
+            with database.obtener_conexion() as conn:
+                conn.execute('UPDATE tokens_sat SET reclamado_hasta = 0 WHERE rfc = ?', (self.rfc,))
+        except Exception as e:
+            logger.error(f"Error al liberar renovación de token de {self.rfc}: {e}")
+
+    def esperar(self, adoptar):
+        """Espera a que el worker que reclamó publique su token; regresa lo que devuelva adoptar()"""
+        limite = time.time() + self.duracion_reclamo
+        while time.time() < limite:
+            time.sleep(INTERVALO_ESPERA)
+            if adoptar():
+                return True
+            row = database.obtener_conexion().execute(
+                'SELECT reclamado_hasta FROM tokens_sat WHERE rfc = ?', (self.rfc,)
+            ).fetchone()
+            # El otro worker terminó sin publicar (falló la autenticación): intentar aquí
+            if not row or row[0] < time.time():
+                return False
+        return False
+
+def registrar_certificados(rfc, cert_path, key_path, password, usuario_id=None):
+    """
+    Publica dónde están los certificados subidos de un RFC y su contraseña (cifrada si hay clave
+    maestra), junto con el usuario que los subió (None si no había sesión iniciada)
+    """
+    password_cifrado = fiel_cache.cifrar(password.encode())
+    with database.obtener_conexion() as conn:
+        conn.execute('''
+            INSERT INTO certificados_subidos (rfc, certificado_path, llave_path, password_cifrado, usuario_id)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(rfc) DO UPDATE SET
+                certificado_path = excluded.certificado_path,
+                llave_path = excluded.llave_path,
+                password_cifrado = excluded.password_cifrado,
+                usuario_id = excluded.usuario_id,
+                fecha_subida = CURRENT_TIMESTAMP
+        ''', (rfc, cert_path, key_path, password_cifrado, usuario_id))
+
+def usuario_de_certificados(rfc):
+    """Usuario que subió los certificados vigentes del RFC, o None (sin certificados o subidos sin sesión)"""
+    row = database.obtener_conexion().execute(
+        'SELECT usuario_id FROM certificados_subidos WHERE rfc = ?', (rfc,)
+    ).fetchone()
+    return row[0] if row else None
+
+def obtener_certificados(rfc):
+    """Regresa {'certificado_path', 'llave_path', 'password'} de los certificados subidos, o None"""
+    try:
+        row = database.obtener_conexion().execute(
+            'SELECT certificado_path, llave_path, password_cifrado FROM certificados_subidos WHERE rfc = ?', (rfc,)
+        ).fetchone()
+        if not row:
+            return None
+        return {
+            'certificado_path': row[0],
+            'llave_path': row[1],
+            'password': fiel_cache.descifrar(row[2]).decode()
+        }
+    except Exception as e:
+        logger.error(f"Error al obtener certificados subidos de {rfc}: {e}")
+        return None
@@ -0,0 +1,113 @@
+import logging
+import os
+import sqlite3
+import database
+import invoice_store
+
+logger = logging.getLogger(__name__)
+
+# Horas durante las que una solicitud del SAT se puede retomar: los paquetes de una
+# solicitud terminada solo están disponibles para descarga 72 horas
+VIGENCIA_SOLICITUD = int(os.environ.get('SAT_SOLICITUD_VIGENCIA', 72))
+
+# EstadoSolicitud con los que la solicitud ya no sirve (4 = Error, 5 = Rechazada, 6 = Vencida)
+ESTADOS_SAT_NO_REUTILIZABLES = ('4', '5', '6')
+
+def init_db():
+    """Crea la tabla de solicitudes hechas al SAT"""
+    conn = database.obtener_conexion()
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS solicitudes_sat (
+            id_solicitud TEXT PRIMARY KEY,
+            rfc TEXT NOT NULL,
+            tipo TEXT NOT NULL,
+            estado_comprobante TEXT NOT NULL,
+            fecha_inicial TEXT NOT NULL,
+            fecha_final TEXT NOT NULL,
+            estado_sat TEXT,
+            cod_estatus TEXT,
+            paquetes TEXT,
+            numero_cfdis INTEGER,
+            fecha_creacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            fecha_actualizacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_solicitudes_rfc_tipo
+        ON solicitudes_sat (rfc, tipo, estado_comprobante, fecha_inicial)
+    ''')
+    conn.commit()
+    logger.info("Registro de solicitudes del SAT inicializado")
+
+def _fila_a_solicitud(row):
+    solicitud = dict(row)
+    solicitud['paquetes'] = solicitud['paquetes'].split(',') if solicitud['paquetes'] else []
+    return solicitud
+
+def registrar_solicitud(rfc, tipo, estado_comprobante, fecha_inicial, fecha_final, id_solicitud, cod_estatus=None):
+    """Guarda una solicitud aceptada por el SAT para poder retomarla después"""
+    try:
+        with database.obtener_conexion() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT OR IGNORE INTO solicitudes_sat
+                    (id_solicitud, rfc, tipo, estado_comprobante, fecha_inicial, fecha_final, estado_sat, cod_estatus)
+                VALUES (?, ?, ?, ?, ?, ?, '1', ?)
+            ''', (id_solicitud, rfc, tipo, invoice_store.clave_estado(tipo, estado_comprobante),
+                  fecha_inicial.strftime(invoice_store.FORMATO_FECHA), fecha_final.strftime(invoice_store.FORMATO_FECHA), cod_estatus))
+        return True
+    except Exception as e:
+        logger.error(f"Error al registrar solicitud {id_solicitud}: {e}")
+        return False
+
+def actualizar_verificacion(id_solicitud, verificacion):
+    """Actualiza el estado y los paquetes de una solicitud con lo que respondió VerificaSolicitudDescarga"""
+    if not verificacion:
+        return
+    try:
+        with database.obtener_conexion() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE solicitudes_sat
+                SET estado_sat = COALESCE(?, estado_sat),
+                    cod_estatus = COALESCE(?, cod_estatus),
+                    paquetes = COALESCE(?, paquetes),
+                    numero_cfdis = COALESCE(?, numero_cfdis),
+                    fecha_actualizacion = CURRENT_TIMESTAMP
+                WHERE id_solicitud = ?
+            ''', (verificacion.get('estado_solicitud'), verificacion.get('cod_estatus'),
+                  ','.join(verificacion['paquetes']) if verificacion.get('paquetes') else None,
+                  verificacion.get('numero_cfdis'), id_solicitud))
+    except Exception as e:
+        logger.error(f"Error al actualizar solicitud {id_solicitud}: {e}")
+
+def buscar_reutilizable(rfc, tipo, estado_comprobante, fecha_inicial, fecha_final, vigencia=VIGENCIA_SOLICITUD):
+    """
+    Busca una solicitud previa que cubra [fecha_inicial, fecha_final] con el mismo filtro.
+    Prefiere la coincidencia exacta y después el rango más corto que lo contenga.
+    Con vigencia=None no se descartan las solicitudes por antigüedad.
+    """
+    consulta = '''
+        SELECT * FROM solicitudes_sat
+        WHERE rfc = ? AND tipo = ? AND estado_comprobante = ?
+          AND fecha_inicial <= ? AND fecha_final >= ?
+          AND (estado_sat IS NULL OR estado_sat NOT IN ({}))
+    '''.format(','.join('?' * len(ESTADOS_SAT_NO_REUTILIZABLES)))
+    parametros = [rfc, tipo, invoice_store.clave_estado(tipo, estado_comprobante),
+                  fecha_inicial.strftime(invoice_store.FORMATO_FECHA), fecha_final.strftime(invoice_store.FORMATO_FECHA),
+                  *ESTADOS_SAT_NO_REUTILIZABLES]
+    if vigencia is not None:
+        consulta += " AND fecha_creacion >= datetime('now', ?)"
+        parametros.append(f'-{vigencia} hours')
+    consulta += ' ORDER BY julianday(fecha_final) - julianday(fecha_inicial), fecha_creacion DESC LIMIT 1'
+
+    try:
+        cursor = database.obtener_conexion().cursor()
+        cursor.row_factory = sqlite3.Row
+        cursor.execute(consulta, parametros)
+        row = cursor.fetchone()
+        return _fila_a_solicitud(row) if row else None
+    except Exception as e:
+        logger.error(f"Error al buscar solicitudes previas: {e}")
+        return None
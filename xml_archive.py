@@ -0,0 +1,250 @@
+import hashlib
+import logging
+import mmap
+import os
+import re
+import threading
+import zipfile
+import zlib
+from collections import OrderedDict
+import database
+from exporter import SalidaEnBloques
+
+try:
+    import fcntl
+except ImportError:  # Windows: solo se coordina entre hilos del mismo proceso
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# XML originales de los paquetes, comprimidos en archivos .pack por RFC (solo se agregan datos)
+ARCHIVO_XML_DIR = os.environ.get('SAT_ARCHIVO_XML_DIR', os.path.join(os.path.dirname(__file__), 'archivo_xml'))
+ARCHIVAR_XML = os.environ.get('SAT_ARCHIVAR_XML', 'True') == 'True'
+# Al pasar este tamaño se empieza un .pack nuevo
+TAMANO_MAXIMO_PACK = int(os.environ.get('SAT_ARCHIVO_PACK_MAX', 256 * 1024 * 1024))
+# Bytes de XML (sin comprimir) que junta un escritor antes de revisar cuáles faltan, comprimirlos
+# y agregarlos al .pack
+TAMANO_ESCRITURA = 8 * 1024 * 1024
+NIVEL_COMPRESION = 6
+# .pack mapeados en memoria que conserva cada worker (cada mapa ocupa un descriptor de archivo)
+MAPAS_ABIERTOS = int(os.environ.get('SAT_ARCHIVO_MAPAS', 8))
+
+_locks_rfc = {}
+_locks_lock = threading.Lock()
+_mapas = OrderedDict()  # (rfc, pack) -> mmap de solo lectura; el menos usado al inicio
+_mapas_lock = threading.Lock()
+
+def init_db():
+    """Crea el índice UUID → (pack, desplazamiento, longitud, sha256) de los XML archivados"""
+    conn = database.obtener_conexion()
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS xml_archivo (
+            rfc TEXT NOT NULL,
+            uuid TEXT NOT NULL,
+            pack INTEGER NOT NULL,
+            desplazamiento INTEGER NOT NULL,
+            longitud INTEGER NOT NULL,
+            sha256 TEXT,
+            fecha_archivo TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (rfc, uuid)
+        )
+    ''')
+    conn.commit()
+    # Bases en las que se quitó la columna: se vuelve a agregar (las filas anteriores quedan sin
+    # huella y no participan en la deduplicación). Dentro de la transacción, para que dos workers
+    # que arrancan juntos no la agreguen ambos
+    with database.cambio_de_esquema(conn):
+        columnas = [fila[1] for fila in cursor.execute('PRAGMA table_info(xml_archivo)')]
+        if 'sha256' not in columnas:
+            cursor.execute('ALTER TABLE xml_archivo ADD COLUMN sha256 TEXT')
+        # Contenido ya archivado del RFC, aunque llegue con otro UUID
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_xml_archivo_sha256 ON xml_archivo (rfc, sha256)')
+    logger.info("Índice del archivo de XML inicializado")
+
+def _lock_rfc(rfc):
+    with _locks_lock:
+        return _locks_rfc.setdefault(rfc, threading.Lock())
+
+def _ruta_pack(rfc, pack):
+    # El RFC forma parte de la ruta: no debe poder salir del directorio del archivo
+    if not re.fullmatch(r'[A-Z0-9&Ñ]+', rfc, re.IGNORECASE):
+        raise ValueError(f'RFC inválido para el archivo de XML: {rfc!r}')
+    return os.path.join(ARCHIVO_XML_DIR, rfc, f'{pack:05d}.pack')
+
+def _pack_actual(rfc):
+    """Número del .pack al que se agregan datos (el más reciente mientras no pase del máximo)"""
+    directorio = os.path.dirname(_ruta_pack(rfc, 0))
+    os.makedirs(directorio, exist_ok=True)
+    packs = sorted(int(nombre[:-5]) for nombre in os.listdir(directorio) if nombre.endswith('.pack'))
+    if not packs:
+        return 0
+    ultimo = packs[-1]
+    return ultimo + 1 if os.path.getsize(_ruta_pack(rfc, ultimo)) >= TAMANO_MAXIMO_PACK else ultimo
+
+class EscritorArchivo:
+    """
+    Agrega los XML de un RFC al archivo. Los junta por bloques y por cada bloque consulta una sola
+    vez cuáles UUID ya estaban archivados y qué contenidos (sha256) ya están en el .pack: un
+    contenido repetido solo se indexa apuntando a la copia existente. El índice se actualiza
+    después de escribir, así que un XML indexado siempre está completo.
+    """
+
+    def __init__(self, rfc):
+        self.rfc = rfc
+        self._pendientes = []  # (uuid, xml) sin comprimir
+        self._tamano = 0
+        self._vistos = set()
+        self.archivados = 0
+
+    def agregar(self, uuid, xml):
+        if not uuid:
+            return
+        uuid = uuid.upper()
+        if uuid in self._vistos:
+            return
+        self._vistos.add(uuid)
+        self._pendientes.append((uuid, xml))
+        self._tamano += len(xml)
+        if self._tamano >= TAMANO_ESCRITURA:
+            self.confirmar()
+
+    def _consultar(self, columnas, campo, valores):
+        """Filas (columnas) del RFC cuyo campo está en valores, con una consulta por cada 500"""
+        conn = database.obtener_conexion()
+        filas = []
+        for inicio in range(0, len(valores), 500):
+            lote = valores[inicio:inicio + 500]
+            filas += conn.execute(f'''
+                SELECT {columnas} FROM xml_archivo WHERE rfc = ? AND {campo} IN ({','.join('?' * len(lote))})
+            ''', (self.rfc, *lote)).fetchall()
+        return filas
+
+    def confirmar(self):
+        """Escribe al .pack lo pendiente cuyo contenido no estaba archivado e indexa sus UUID"""
+        if not self._pendientes:
+            return
+        existentes = {fila[0] for fila in self._consultar('uuid', 'uuid', [uuid for uuid, _ in self._pendientes])}
+        nuevos = [(uuid, xml, hashlib.sha256(xml).hexdigest())
+                  for uuid, xml in self._pendientes if uuid not in existentes]
+        self._pendientes = []
+        self._tamano = 0
+        if not nuevos:
+            return
+
+        # huella -> (pack, desplazamiento, longitud) del contenido que ya está en algún .pack
+        ubicaciones = {huella: (pack, desplazamiento, longitud) for huella, pack, desplazamiento, longitud
+                       in self._consultar('sha256, pack, desplazamiento, longitud', 'sha256',
+                                          list({huella for _, _, huella in nuevos}))}
+        buffer = bytearray()
+        en_buffer = {}  # huella -> (desplazamiento en el buffer, longitud); repetidos del bloque una vez
+        por_escribir = []  # (uuid, huella)
+        filas = []
+        for uuid, xml, huella in nuevos:
+            if huella in ubicaciones:
+                filas.append((self.rfc, uuid, *ubicaciones[huella], huella))
+                continue
+            if huella not in en_buffer:
+                comprimido = zlib.compress(xml, NIVEL_COMPRESION)
+                en_buffer[huella] = (len(buffer), len(comprimido))
+                buffer += comprimido
+            por_escribir.append((uuid, huella))
+
+        if buffer:
+            with _lock_rfc(self.rfc):
+                pack = _pack_actual(self.rfc)
+                with open(_ruta_pack(self.rfc, pack), 'ab') as archivo:
+                    # Entre workers del mismo host el .pack se bloquea mientras se agrega
+                    if fcntl:
+                        fcntl.flock(archivo, fcntl.LOCK_EX)
+                    try:
+                        inicio = archivo.seek(0, os.SEEK_END)
+                        archivo.write(buffer)
+                        archivo.flush()
+                    finally:
+                        if fcntl:
+                            fcntl.flock(archivo, fcntl.LOCK_UN)
+            for uuid, huella in por_escribir:
+                desplazamiento, longitud = en_buffer[huella]
+                filas.append((self.rfc, uuid, pack, inicio + desplazamiento, longitud, huella))
+        # OR IGNORE: otro worker pudo archivar el mismo UUID entre la consulta y la escritura
+        with database.obtener_conexion() as conn:
+            conn.executemany('''
+                INSERT OR IGNORE INTO xml_archivo (rfc, uuid, pack, desplazamiento, longitud, sha256)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', filas)
+        self.archivados += len(filas)
+
+def _leer(rfc, pack, desplazamiento, longitud):
+    """
+    XML de un .pack mapeado en memoria. Se conservan a lo más MAPAS_ABIERTOS mapas por worker
+    (el menos usado se cierra); si el .pack creció desde que se mapeó, se vuelve a mapear
+    """
+    clave = (rfc, pack)
+    fin = desplazamiento + longitud
+    with _mapas_lock:
+        mapa = _mapas.get(clave)
+        if mapa is None or len(mapa) < fin:
+            if mapa is not None:
+                mapa.close()
+            with open(_ruta_pack(rfc, pack), 'rb') as archivo:
+                mapa = mmap.mmap(archivo.fileno(), 0, access=mmap.ACCESS_READ)
+            _mapas[clave] = mapa
+            while len(_mapas) > MAPAS_ABIERTOS:
+                _mapas.popitem(last=False)[1].close()
+        _mapas.move_to_end(clave)
+        # La copia se hace con el lock: otro hilo podría cerrar este mapa al desalojarlo
+        comprimido = mapa[desplazamiento:fin]
+    return zlib.decompress(comprimido)
+
+def _olvidar_mapas():
+    # Tras un fork el lock pudo quedar tomado por un hilo que no existe en el hijo
+    global _mapas, _mapas_lock
+    _mapas, _mapas_lock = OrderedDict(), threading.Lock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_olvidar_mapas)
+
+def obtener_xml(rfc, uuid):
+    """XML original (bytes) de un UUID archivado, o None si no está"""
+    row = database.obtener_conexion().execute(
+        'SELECT pack, desplazamiento, longitud FROM xml_archivo WHERE rfc = ? AND uuid = ?', (rfc, uuid.upper())
+    ).fetchone()
+    if not row:
+        return None
+    return _leer(rfc, *row)
+
+def iterar_xmls(rfc, uuids=None):
+    """
+    Entrega (uuid, xml) de los UUID pedidos que estén archivados (o de todo el RFC), en el orden
+    del archivo para que la lectura sea secuencial; sirve también para volver a parsear sin ir al SAT
+    """
+    conn = database.obtener_conexion()
+    if uuids is None:
+        filas = conn.execute('''
+            SELECT uuid, pack, desplazamiento, longitud FROM xml_archivo WHERE rfc = ?
+            ORDER BY pack, desplazamiento
+        ''', (rfc,))
+    else:
+        uuids = list(dict.fromkeys(u.upper() for u in uuids))
+        filas = []
+        for inicio in range(0, len(uuids), 500):
+            lote = uuids[inicio:inicio + 500]
+            filas += conn.execute(f'''
+                SELECT uuid, pack, desplazamiento, longitud FROM xml_archivo
+                WHERE rfc = ? AND uuid IN ({','.join('?' * len(lote))})
+            ''', (rfc, *lote)).fetchall()
+        filas.sort(key=lambda fila: (fila[1], fila[2]))
+    for uuid, pack, desplazamiento, longitud in filas:
+        yield uuid, _leer(rfc, pack, desplazamiento, longitud)
+
+def exportar_zip(rfc, uuids):
+    """ZIP con los XML pedidos, generado por bloques de bytes conforme se leen del archivo"""
+    salida = SalidaEnBloques()
+    with zipfile.ZipFile(salida, 'w', zipfile.ZIP_DEFLATED) as paquete:
+        for uuid, xml in iterar_xmls(rfc, uuids):
+            paquete.writestr(f'{uuid}.xml', xml)
+            datos = salida.vaciar()
+            if datos:
+                yield datos
+    yield salida.vaciar()